@@ -0,0 +1,262 @@
+"""
+Load generator and latency benchmark for a local Raft cluster.
+
+Starts an N-node cluster of Server.py processes (or targets a running one with
+--nodes 0), drives a read/write mix over a key distribution with a number of
+concurrent clients through RPCHandler, and reports throughput and latency
+percentiles. Results can be saved as JSON and compared against a previous run:
+
+    python Benchmark.py --nodes 3 --clients 16 --duration 20 --read-ratio 0.9 \\
+        --distribution zipf --output bench.json --baseline previous.json
+"""
+from Address import Address
+from utils.RPCHandler import RPCHandler
+from messages.Base import ResponseStatus
+from messages.Execute import ExecuteRequest
+from itertools import accumulate
+from typing import Dict, List
+import argparse
+import asyncio
+import bisect
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import time
+
+
+class KeyGenerator:
+    """ Picks benchmark keys with a uniform, zipf (skewed) or sequential distribution """
+    def __init__(self, distribution: str, key_count: int, zipf_s: float, rng: random.Random):
+        self.distribution = distribution
+        self.key_count = key_count
+        self.rng = rng
+        self.next_key = 0
+        if distribution == "zipf":
+            self.cum_weights = list(accumulate(1 / (rank ** zipf_s) for rank in range(1, key_count + 1)))
+
+    def next(self) -> str:
+        if self.distribution == "uniform":
+            idx = self.rng.randrange(self.key_count)
+        elif self.distribution == "zipf":
+            idx = bisect.bisect_left(self.cum_weights, self.rng.random() * self.cum_weights[-1])
+        else:
+            idx = self.next_key
+            self.next_key = (self.next_key + 1) % self.key_count
+        return f"key{idx}"
+
+
+def percentile(ordered: List[float], p: float) -> float:
+    if not ordered:
+        return 0.0
+    return ordered[max(1, math.ceil(p / 100 * len(ordered))) - 1]
+
+def summarize(latencies: List[float]) -> Dict[str, float]:
+    ordered = sorted(latencies)
+    return {
+        "count": len(ordered),
+        "mean_ms": 1000 * sum(ordered) / len(ordered) if ordered else 0.0,
+        "p50_ms": 1000 * percentile(ordered, 50),
+        "p99_ms": 1000 * percentile(ordered, 99),
+        "p999_ms": 1000 * percentile(ordered, 99.9),
+        "max_ms": 1000 * ordered[-1] if ordered else 0.0,
+    }
+
+
+class Cluster:
+    """
+    N local Server.py processes, the first one founds the cluster and the rest join
+    it, or with bootstrap all start at once from the shared member list
+    """
+    def __init__(self, host: str, base_port: int, nodes: int):
+        self.addrs = [Address(host, base_port + i) for i in range(nodes)]
+        self.processes: List[subprocess.Popen] = []
+
+    def __storage_paths(self):
+        return [f"storage/{addr.ip}_{addr.port}.json" for addr in self.addrs]
+
+    def start(self, join_delay: float, bootstrap: bool = False):
+        self.__clean_storage()
+        members = ",".join(map(str, self.addrs))
+        for i, addr in enumerate(self.addrs):
+            args = [sys.executable, "Server.py", addr.ip, str(addr.port)]
+            if bootstrap:
+                args += ["--members", members]
+            elif i > 0:
+                args += [self.addrs[0].ip, str(self.addrs[0].port)]
+            # the nodes log every RPC, don't let a full pipe stall them
+            self.processes.append(subprocess.Popen(args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+            if not bootstrap:
+                time.sleep(join_delay)
+
+    def stop(self):
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            try:
+                process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        self.__clean_storage()
+
+    def __clean_storage(self):
+        for path in self.__storage_paths():
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class Benchmark:
+    def __init__(self, args: argparse.Namespace, leader: Address):
+        self.args = args
+        self.leader = leader
+        self.rng = random.Random(args.seed)
+        self.keys = KeyGenerator(args.distribution, args.keys, args.zipf_s, self.rng)
+        self.value = "x" * args.value_size
+        self.latencies: Dict[str, List[float]] = {"get": [], "set": []}
+        self.errors = 0
+        self.rpc_handler = RPCHandler("Benchmark")
+
+    async def __execute(self, command: str) -> bool:
+        response = await self.rpc_handler.async_request(self.leader, "execute", ExecuteRequest({
+            "command": command,
+            "value": "",
+        }), self.args.timeout)
+        if response is None or response["status"] != ResponseStatus.SUCCESS.value:
+            return False
+        # keep talking to whoever answered, RPCHandler follows redirects
+        self.leader = Address(**response["address"])
+        return True
+
+    async def wait_for_leader(self, timeout: float):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if await self.__execute("ping"):
+                return
+            await asyncio.sleep(0.5)
+        raise TimeoutError(f"No leader answered at {self.leader} within {timeout}s")
+
+    async def preload(self):
+        for i in range(0, self.args.keys, self.args.clients):
+            await asyncio.gather(*(self.__execute(f"set key{idx} {self.value}") for idx in range(i, min(i + self.args.clients, self.args.keys))))
+
+    async def __client(self, deadline: float, record_after: float):
+        while time.time() < deadline:
+            op = "get" if self.rng.random() < self.args.read_ratio else "set"
+            key = self.keys.next()
+            command = f"get {key}" if op == "get" else f"set {key} {self.value}"
+            start = time.perf_counter()
+            ok = await self.__execute(command)
+            elapsed = time.perf_counter() - start
+            if time.time() < record_after:
+                continue
+            if ok:
+                self.latencies[op].append(elapsed)
+            else:
+                self.errors += 1
+
+    async def run(self) -> Dict:
+        await self.wait_for_leader(self.args.startup_timeout)
+        if self.args.preload:
+            await self.preload()
+
+        start = time.time()
+        record_after = start + self.args.warmup
+        deadline = record_after + self.args.duration
+        await asyncio.gather(*(self.__client(deadline, record_after) for _ in range(self.args.clients)))
+        await self.rpc_handler.close()
+        measured = time.time() - record_after
+
+        all_latencies = self.latencies["get"] + self.latencies["set"]
+        return {
+            "ops": len(all_latencies),
+            "errors": self.errors,
+            "duration_s": measured,
+            "ops_per_sec": len(all_latencies) / measured,
+            "latency": {
+                "all": summarize(all_latencies),
+                "get": summarize(self.latencies["get"]),
+                "set": summarize(self.latencies["set"]),
+            },
+        }
+
+
+def git_revision() -> str | None:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+def print_report(report: Dict, baseline: Dict | None):
+    results = report["results"]
+    print(f"\nops: {results['ops']}  errors: {results['errors']}  duration: {results['duration_s']:.2f}s")
+    print(f"throughput: {results['ops_per_sec']:.1f} ops/sec")
+    print(f"{'op':<6}{'count':>8}{'p50 ms':>10}{'p99 ms':>10}{'p999 ms':>10}{'max ms':>10}")
+    for op, stats in results["latency"].items():
+        print(f"{op:<6}{stats['count']:>8}{stats['p50_ms']:>10.2f}{stats['p99_ms']:>10.2f}{stats['p999_ms']:>10.2f}{stats['max_ms']:>10.2f}")
+
+    if baseline is not None:
+        base = baseline["results"]
+        def change(new: float, old: float) -> str:
+            return f"{100 * (new - old) / old:+.1f}%" if old else "n/a"
+        print(f"\nvs baseline {baseline.get('revision')}:")
+        print(f"  throughput {change(results['ops_per_sec'], base['ops_per_sec'])}")
+        for key in ("p50_ms", "p99_ms", "p999_ms"):
+            print(f"  {key} {change(results['latency']['all'][key], base['latency']['all'][key])}")
+
+def parse_args(argv: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Raft KV cluster load generator and latency benchmark")
+    parser.add_argument("--nodes", type=int, default=3, help="local nodes to start, 0 to target a running cluster at --host/--base-port")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--base-port", type=int, default=7100)
+    parser.add_argument("--clients", type=int, default=8, help="concurrent client coroutines")
+    parser.add_argument("--duration", type=float, default=10, help="measured seconds")
+    parser.add_argument("--warmup", type=float, default=2, help="seconds of load before measuring")
+    parser.add_argument("--read-ratio", type=float, default=0.5, help="fraction of operations that are reads")
+    parser.add_argument("--distribution", choices=["uniform", "zipf", "sequential"], default="uniform")
+    parser.add_argument("--zipf-s", type=float, default=1.1, help="zipf exponent, higher is more skewed")
+    parser.add_argument("--keys", type=int, default=1000, help="size of the key space")
+    parser.add_argument("--value-size", type=int, default=16, help="bytes per written value")
+    parser.add_argument("--no-preload", dest="preload", action="store_false", help="don't write every key before the run")
+    parser.add_argument("--timeout", type=float, default=5, help="per operation RPC timeout in seconds")
+    parser.add_argument("--startup-timeout", type=float, default=30)
+    parser.add_argument("--join-delay", type=float, default=1, help="seconds between starting nodes")
+    parser.add_argument("--bootstrap", action="store_true", help="start every node at once from a static member list instead of joining them one by one")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--baseline", help="JSON results of a previous run to compare with")
+    return parser.parse_args(argv)
+
+def main(argv: List[str]):
+    args = parse_args(argv)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+
+    cluster = Cluster(args.host, args.base_port, args.nodes)
+    try:
+        if args.nodes > 0:
+            print(f"Starting {args.nodes} node cluster at {args.host}:{args.base_port}...")
+            cluster.start(args.join_delay, args.bootstrap)
+        print(f"Running {args.clients} clients for {args.duration}s ({args.warmup}s warmup)...")
+        results = asyncio.run(Benchmark(args, Address(args.host, args.base_port)).run())
+    finally:
+        cluster.stop()
+
+    report = {
+        "revision": git_revision(),
+        "timestamp": time.time(),
+        "config": {name: value for name, value in vars(args).items() if name not in ("output", "baseline")},
+        "results": results,
+    }
+    print_report(report, baseline)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"\nResults saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,46 @@
+"""
+Bulk import and export of the KV store through the leader, without one set
+command per key. An import sends the file in chunks, each installed by the
+leader as a single log entry. An export writes the store as of one committed
+log index. Files are JSONL of {"key": k, "value": v}, gzip compressed when the
+name ends in .gz:
+
+    python Bulk.py import keys.jsonl localhost:8101 localhost:8102
+    python Bulk.py export backup.jsonl.gz localhost:8101
+"""
+from Address import Address
+from Client import Client
+from typing import List
+import argparse
+import asyncio
+import json
+import sys
+
+
+def parse_args(argv: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Bulk import and export of the Raft KV store")
+    parser.add_argument("mode", choices=["import", "export"])
+    parser.add_argument("file", help="JSONL file to read or write, .gz for gzip")
+    parser.add_argument("nodes", nargs="+", help="cluster nodes as ip:port, any of them leads to the leader")
+    parser.add_argument("--chunk-size", type=int, default=Client.IMPORT_CHUNK_SIZE, help="keys per import entry")
+    parser.add_argument("--page-size", type=int, default=1000, help="keys per export page")
+    return parser.parse_args(argv)
+
+async def run(args: argparse.Namespace):
+    nodes = [Address(node.rsplit(":", 1)[0], int(node.rsplit(":", 1)[1])) for node in args.nodes]
+    client = Client("localhost", 0, nodes)
+    try:
+        if args.mode == "import":
+            result = await client.import_file(args.file, chunk_size=args.chunk_size)
+        else:
+            result = await client.export_file(args.file, page_size=args.page_size)
+    finally:
+        await client.rpc_handler.close()
+    print(json.dumps(result))
+
+def main(argv: List[str]):
+    asyncio.run(run(parse_args(argv)))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,73 +1,358 @@
-from flask import Flask, request
-from flask_cors import CORS  # Import CORS
 import sys
+import gzip
+import json
+import time
+import uuid
+import random
+import asyncio
 from Address import Address
 from app import KVStore
-from typing import List
+from typing import IO, AsyncIterator, Callable, Dict, List
+from urllib.parse import parse_qs
 from utils.RPCHandler import RPCHandler
+from utils.AsyncHTTP import read_http_message, build_http_message, build_chunked_head, build_chunk
 from messages.Execute import ExecuteRequest, ExecuteResponse
-from messages.Base import ResponseStatus
-
-_kvStore : KVStore
+from messages.ReadLog import LogEntry, ReadLogRequest
+from messages.Watch import ChangeEntry, WatchRequest
+from messages.Bulk import ImportRequest, ExportRequest
+from messages.Base import BaseMessage, BaseResponse, ResponseStatus
 
 class Client:
-    rpc_handler: RPCHandler
-    client_addr: Address
+    """
+    HTTP gateway in front of the cluster. It remembers the current leader and every
+    node it has heard of, keeps pooled keep-alive connections to them through
+    RPCHandler, and retries with exponential backoff while leadership moves. All
+    requests are served concurrently from one asyncio event loop.
+
+    Every command is sent in the gateway's client session with its own sequence
+    number, and a retry reuses it, so the leader answers a retried write from its
+    session table instead of applying it twice. That makes short timeouts safe.
+    """
+    RETRY_COUNT = 8
+    RPC_TIMEOUT = 0.5
+    # Bulk requests carry thousands of keys, they get longer to be applied
+    BULK_TIMEOUT = 10
+    IMPORT_CHUNK_SIZE = 5000
+    # Seconds a watch long poll waits at the node for a change
+    WATCH_WAIT = 30
+    BACKOFF_BASE = 0.05
+    BACKOFF_MAX = 2
+    CORS_HEADERS = {
+        "Access-Control-Allow-Origin": "*",
+        "Access-Control-Allow-Methods": "GET, POST, OPTIONS",
+        "Access-Control-Allow-Headers": "Content-Type",
+    }
 
-    def __init__(self, client_ip: str, client_port: int):
-        Client.rpc_handler = RPCHandler(f"Client.py")
-        Client.client_addr = Address(client_ip, client_port)
-        print(f"Client started at {client_ip}:{client_port}\n")
+    def __init__(self, client_ip: str, client_port: int, nodes: List[Address] = None):
+        self.rpc_handler = RPCHandler("Client.py")
+        self.client_addr = Address(client_ip, client_port)
+        self.leader: Address | None = None
+        self.nodes: List[Address] = list(nodes or [])
+        self.server: asyncio.AbstractServer = None
+        self.client_id: str = uuid.uuid4().hex
+        self.seq: int = 0
+        # sequence numbers sent but not answered yet
+        self.pending: set[int] = set()
 
     @staticmethod
-    def _execute(server_address: Address, command: str) -> str:
-        # Executing the request
+    def is_request_log(command: str) -> bool:
+        """ request_log [start] [limit] [term] """
+        command_parts = command.split()
+        return len(command_parts) in range(1, 5) and command_parts[0] == "request_log" and \
+            all(part.isascii() and part.isdigit() for part in command_parts[1:])
+
+    def __remember(self, addr: Address):
+        if addr not in self.nodes:
+            self.nodes.append(addr)
+
+    def __backoff(self, attempt: int) -> float:
+        # full jitter, so clients retrying after a failover don't hit the new leader in lockstep
+        return random.uniform(0, min(Client.BACKOFF_MAX, Client.BACKOFF_BASE * 2 ** attempt))
+
+    def __acked(self) -> int:
+        """ Highest seq that got its response along with every seq before it """
+        return min(self.pending) - 1 if self.pending else self.seq
+
+    async def execute(self, command: str, server_address: Address | None = None) -> ExecuteResponse:
+        self.seq += 1
+        seq = self.seq
+        self.pending.add(seq)
+        try:
+            return await self.__execute(command, seq, server_address)
+        finally:
+            self.pending.discard(seq)
+
+    async def __execute(self, command: str, seq: int, server_address: Address | None) -> ExecuteResponse:
         req = ExecuteRequest({
-            "command": command,  # Remove unnecessary spaces
-            "value": ""
+            "command": command,
+            "value": "",
+            "client_id": self.client_id,
+            "seq": seq,
         })
-        print(server_address)
-        resp = Client.rpc_handler.request(server_address, "execute", req)
-        # Redirect to leader
-        if (resp["status"] == ResponseStatus.REDIRECTED.value) :
-            print("Redirected to leader")
-            resp = Client.rpc_handler.request(resp["address"], "execute", req)
-        return resp
+        return await self.__call_leader("execute", req, server_address, lambda: req.update(acked=self.__acked()))
 
-# Flask Server
+    async def __call_leader(self, rpc_name: str, req: BaseMessage, server_address: Address | None = None,
+                            before_attempt: Callable[[], None] = None, timeout: float = RPC_TIMEOUT) -> BaseResponse:
+        """ Sends a request to the leader, following it and backing off while leadership moves """
+        if server_address is not None:
+            self.__remember(server_address)
 
-app = Flask(__name__)
-CORS(app)  # Apply CORS to the Flask app
+        target = self.leader or server_address or (self.nodes[0] if self.nodes else None)
+        if target is None:
+            raise Exception("No cluster node known, pass an address")
 
-@app.route('/')
-def hello_world():
-    return 'Hello, World!'
+        response = None
+        for attempt in range(Client.RETRY_COUNT):
+            if before_attempt is not None:
+                before_attempt()
+            response = await self.rpc_handler.async_request(target, rpc_name, req, timeout)
+            if response is not None and response["status"] in (ResponseStatus.SUCCESS.value, ResponseStatus.FAILED.value):
+                # RPCHandler followed any redirect, whoever answered is the leader
+                self.leader = Address(response["address"]["ip"], response["address"]["port"])
+                self.__remember(self.leader)
+                return response
+
+            if response is None or response["status"] == ResponseStatus.REDIRECTED.value:
+                # node down, partitioned or without a leader, forget the cached leader and try the next node
+                print(f"No leader reached through {target}, retrying...")
+                self.leader = None
+                if self.nodes:
+                    target = self.nodes[(self.nodes.index(target) + 1) % len(self.nodes) if target in self.nodes else 0]
+            else:
+                # leadership transfer in progress or the leader is over capacity, it says when to come back
+                print(f"{target} answered {response['status']}: {response.get('reason')}, retrying...")
+            await asyncio.sleep(max(self.__backoff(attempt), response.get("retry_after", 0) if response else 0))
+
+        return response or BaseResponse({
+            "status": ResponseStatus.FAILED.value,
+            "address": target,
+            "reason": f"No leader answered after {Client.RETRY_COUNT} attempts",
+        })
+
+    async def import_file(self, path: str, server_address: Address | None = None, chunk_size: int = IMPORT_CHUNK_SIZE) -> Dict:
+        """
+        Bulk loads a JSONL file (gzip compressed if it ends in .gz) of {"key": k, "value": v}
+        objects or [k, v] pairs, chunk_size keys per import_data request, each chunk one
+        log entry. Returns the key count, the bytes read and the throughput
+        """
+        start, keys, nbytes = time.perf_counter(), 0, 0
+        with Client.__open(path, "rt") as file:
+            chunk: List[List[str]] = []
+            for line in file:
+                nbytes += len(line)
+                if not line.strip():
+                    continue
+                item = json.loads(line)
+                chunk.append([item["key"], item["value"]] if isinstance(item, dict) else item)
+                if len(chunk) == chunk_size:
+                    keys += await self.__import_chunk(chunk, server_address)
+                    chunk = []
+            if chunk:
+                keys += await self.__import_chunk(chunk, server_address)
+        return Client.__throughput(keys, nbytes, time.perf_counter() - start)
+
+    async def __import_chunk(self, items: List[List[str]], server_address: Address | None) -> int:
+        # a chunk gets a seq like a command, so a retry of an import that was already
+        # applied doesn't install the pairs again over newer writes
+        self.seq += 1
+        seq = self.seq
+        self.pending.add(seq)
+        try:
+            req = ImportRequest({"items": items, "client_id": self.client_id, "seq": seq})
+            response = await self.__call_leader("import_data", req, server_address,
+                                                lambda: req.update(acked=self.__acked()), timeout=Client.BULK_TIMEOUT)
+        finally:
+            self.pending.discard(seq)
+        if response["status"] != ResponseStatus.SUCCESS.value:
+            raise Exception(f"Import failed: {response.get('reason')}")
+        return response["data"]
+
+    async def export_file(self, path: str, server_address: Address | None = None, page_size: int = 1000) -> Dict:
+        """
+        Writes the whole store, as of one committed log index, to a JSONL file of
+        {"key": k, "value": v} objects (gzip compressed if it ends in .gz), one page of
+        export_data at a time. Returns the index, key count, bytes written and throughput
+        """
+        start, keys, nbytes = time.perf_counter(), 0, 0
+        req = ExportRequest({"limit": page_size})
+        with Client.__open(path, "wt") as file:
+            while True:
+                response = await self.__call_leader("export_data", req, server_address, timeout=Client.BULK_TIMEOUT)
+                if response["status"] != ResponseStatus.SUCCESS.value:
+                    raise Exception(f"Export failed: {response.get('reason')}")
+                for key, value in response["items"]:
+                    line = json.dumps({"key": key, "value": value}) + "\n"
+                    file.write(line)
+                    nbytes += len(line)
+                keys += len(response["items"])
+                if response["next"] is None:
+                    break
+                req.update(export_id=response["export_id"], cursor=response["next"])
+        return {"index": response["index"], **Client.__throughput(keys, nbytes, time.perf_counter() - start)}
+
+    @staticmethod
+    def __open(path: str, mode: str) -> IO:
+        # level 1 like utils/Compression, the default level makes the export CPU bound
+        return gzip.open(path, mode, compresslevel=1) if path.endswith(".gz") else open(path, mode)
+
+    @staticmethod
+    def __throughput(keys: int, nbytes: int, seconds: float) -> Dict:
+        return {
+            "keys": keys,
+            "bytes": nbytes,
+            "seconds": round(seconds, 3),
+            "keys_per_second": round(keys / seconds, 1) if seconds > 0 else 0.0,
+            "mb_per_second": round(nbytes / seconds / 1e6, 3) if seconds > 0 else 0.0,
+        }
+
+    async def iter_log(self, address: Address | None = None, start: int = 0, term: int | None = None,
+                       page_size: int = 100) -> AsyncIterator[LogEntry]:
+        """
+        Streams the log of a node (the leader by default) page by page with the
+        read_log RPC, so only one page is held in memory on either side
+        """
+        target = address or self.leader or (self.nodes[0] if self.nodes else None)
+        if target is None:
+            raise Exception("No cluster node known, pass an address")
+
+        next_index = start
+        while next_index is not None:
+            req = ReadLogRequest({"start": next_index, "limit": page_size})
+            if term is not None:
+                req["term"] = term
+            response = await self.rpc_handler.async_request(target, "read_log", req, Client.RPC_TIMEOUT)
+            if response is None:
+                raise Exception(f"No response from {target} reading the log at index {next_index}")
+            for entry in response["entries"]:
+                yield entry
+            next_index = response["next"]
+
+    async def watch(self, address: Address | None = None, start: int = 0, keys: List[str] | None = None,
+                    prefix: str | None = None) -> AsyncIterator[ChangeEntry]:
+        """
+        Yields committed changes from index start on, forever, by long polling the
+        watch RPC. The index of the last change plus one resumes the stream later.
+        When the node stops answering the next known node is asked from the same
+        index, committed entries are the same on every node
+        """
+        target = address or self.leader or (self.nodes[0] if self.nodes else None)
+        if target is None:
+            raise Exception("No cluster node known, pass an address")
+
+        next_index, attempt = start, 0
+        while True:
+            req = WatchRequest({"start": next_index, "wait": Client.WATCH_WAIT})
+            if keys:
+                req["keys"] = keys
+            if prefix is not None:
+                req["prefix"] = prefix
+            response = await self.rpc_handler.async_request(target, "watch", req, Client.WATCH_WAIT + Client.RPC_TIMEOUT)
+            if response is None or response["status"] != ResponseStatus.SUCCESS.value:
+                if self.nodes:
+                    target = self.nodes[(self.nodes.index(target) + 1) % len(self.nodes) if target in self.nodes else 0]
+                await asyncio.sleep(self.__backoff(attempt))
+                attempt += 1
+                continue
+
+            attempt = 0
+            for entry in response["entries"]:
+                yield entry
+            next_index = response["next"]
+
+    # HTTP server
+
+    async def __stream(self, writer: asyncio.StreamWriter, path: str, query: str):
+        """
+        GET /log?address=ip:port&start=0&term=1 streams the log and
+        GET /watch?address=ip:port&start=0&key=k1&key=k2&prefix=p the committed changes,
+        as newline delimited JSON
+        """
+        params = parse_qs(query)
+        writer.write(build_chunked_head("HTTP/1.1 200 OK", {"Content-Type": "application/x-ndjson", **Client.CORS_HEADERS}))
+        try:
+            address = None
+            if "address" in params:
+                ip, port = params["address"][0].rsplit(":", 1)
+                address = Address(ip, int(port))
+            start = int(params["start"][0]) if "start" in params else 0
+            if path == "/log":
+                entries = self.iter_log(address, start, int(params["term"][0]) if "term" in params else None)
+            else:
+                entries = self.watch(address, start, params.get("key"), params["prefix"][0] if "prefix" in params else None)
+            async for entry in entries:
+                writer.write(build_chunk(json.dumps(entry).encode() + b"\n"))
+                await writer.drain()
+        except Exception as e:
+            # the status line is already out, report the error as the last line
+            writer.write(build_chunk(json.dumps({"error": str(e)}).encode() + b"\n"))
+        writer.write(build_chunk(b""))
+        await writer.drain()
+
+    async def __handle(self, method: str, path: str, body: bytes) -> tuple[str, Dict]:
+        if method == "OPTIONS":
+            return "204 No Content", None
+        if method == "GET" and path == "/":
+            return "200 OK", "Hello, World!"
+        if method != "POST" or path != "/execute_command":
+            return "404 Not Found", {"error": "Not found"}
+
+        try:
+            data = json.loads(body)
+            command: str = data['command']
+            print(command)
+
+            # Is INVALID COMMAND??
+            if not KVStore.is_valid_command(command) and not Client.is_request_log(command):
+                raise Exception("Invalid command")
+
+            _address = Address(data['address']['ip'], int(data['address']['port'])) if 'address' in data else None
+            return "200 OK", await self.execute(command, _address)
+        except Exception as e:
+            # make response 400
+            return "400 Bad Request", {"error": str(e)}
+
+    async def __handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                start_line, headers, body = await read_http_message(reader)
+                method, target = (start_line.split(" ") + ["", ""])[:2]
+                path, _, query = target.partition("?")
+                if method == "GET" and path in ("/log", "/watch"):
+                    await self.__stream(writer, path, query)
+                    if headers.get("connection", "").lower() == "close":
+                        break
+                    continue
+                status, result = await self.__handle(method, path, body)
+                if isinstance(result, str):
+                    payload, content_type = result.encode(), "text/html; charset=utf-8"
+                else:
+                    payload, content_type = (json.dumps(result).encode() if result is not None else b""), "application/json"
+                writer.write(build_http_message(f"HTTP/1.1 {status}", {"Content-Type": content_type, **Client.CORS_HEADERS}, payload))
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self):
+        self.server = await asyncio.start_server(self.__handle_connection, self.client_addr.ip, self.client_addr.port)
+        print(f"Client started at {self.client_addr.ip}:{self.client_addr.port}\n")
+        try:
+            async with self.server:
+                await self.server.serve_forever()
+        finally:
+            await self.rpc_handler.close()
 
-@app.route('/execute_command', methods=['POST'])
-def execute_command():
-    try:
-        print(request)
-        data = request.get_json()
-        command: str = data['command']
-        print(command)
-
-        # Is INVALID COMMAND??
-        if(_kvStore._execute_single_command(command) == "Invalid command" and command != "request_log"):
-            # throw an exception
-            raise Exception("Invalid command")
-        
-        _address = Address(data['address']['ip'], int(data['address']['port']))
-        response = Client._execute(_address, command)
-        return response
-    except Exception as e:
-        # make response 400
-        return {"error": str(e)}, 400
 
 if __name__ == "__main__":
     if len(sys.argv) < 3:
-        print("Client.py [client_ip] [client_port]")
+        print("Client.py [client_ip] [client_port] [node_ip:node_port ...]")
         sys.exit(1)
 
-    Client(sys.argv[1], int(sys.argv[2]))
-    _kvStore = KVStore()
-    app.run(host=sys.argv[1], port=int(sys.argv[2]))
\ No newline at end of file
+    nodes = [Address(node.rsplit(":", 1)[0], int(node.rsplit(":", 1)[1])) for node in sys.argv[3:]]
+    try:
+        asyncio.run(Client(sys.argv[1], int(sys.argv[2]), nodes).serve())
+    except KeyboardInterrupt:
+        pass
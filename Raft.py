@@ -1,36 +1,68 @@
 import asyncio
-from threading import Thread
-from xmlrpc.client import ServerProxy
-from typing import Any, List, Set, TypedDict, Dict
+from typing import Any, Awaitable, List, Set, TypedDict, Dict
 from enum import Enum
 from Address import Address
 import time
-import socket
 import json
 import random
+import bisect
 from structs import AppendEntry
 from structs.NodeType import NodeType
 from app import KVStore
 from structs.Log import Log
+from structs.LogStore import LogStore
 from structs.ColorLog import ColorLog
 
 from messages.Base import BaseMessage, BaseResponse, ResponseStatus
 from messages.Execute import ExecuteRequest, ExecuteResponse
+from messages.ReadLog import LogEntry, ReadLogRequest, ReadLogResponse
+from messages.Watch import ChangeEntry, WatchRequest, WatchResponse
+from messages.Bulk import ImportRequest, ImportResponse, ExportRequest, ExportResponse
 from utils.MessageParser import MessageParser
-from utils.RPCHandler import RPCHandler
+from utils.Transport import Transport, RPCTransport
 from StableStorage import StableStorage
+from RaftConfig import RaftConfig
+from structs.LatencyWindow import LatencyWindow
+from structs.TokenBucket import TokenBucket
+from utils.Metrics import MetricsRegistry
+from utils.Tracer import Tracer
+from utils import Compression
 import math
+from collections import OrderedDict
 
 class RaftNode:
-    HEARTBEAT_INTERVAL = 1
     RETRY_COUNT = 15
-    ELECTION_TIMEOUT_MIN = 35
-    ELECTION_TIMEOUT_MAX = 60
-    RPC_TIMEOUT = 0.5
+    # A learner is promoted to voter once its log is at most this many entries behind the leader
+    LEARNER_PROMOTION_THRESHOLD = 10
+    # Log entries with this command carry a cluster configuration instead of a KV command
+    CONFIG_COMMAND = "config"
+    # Log reads answer in bounded pages, like KVStore range queries
+    LOG_PAGE_SIZE = 100
+    MAX_LOG_PAGE_SIZE = 1000
+    # Committed entries a watch call looks at before answering, and its longest long-poll
+    WATCH_SCAN_LIMIT = 10000
+    MAX_WATCH_WAIT = 60
+    # Keys per export page, and exports kept open at once (the oldest is dropped) for at most EXPORT_TTL idle seconds
+    EXPORT_PAGE_SIZE = 1000
+    MAX_EXPORT_PAGE_SIZE = 10000
+    MAX_EXPORTS = 4
+    EXPORT_TTL = 60
+    # Deadlines of internode RPCs are the RTT derived rpc_timeout times this factor, joining
+    # waits for the leader to append and persist the new configuration
+    RPC_TIMEOUT_FACTORS = {"apply_membership": 10}
+    # RPCs clients call, served from the RPC server's client worker pool. Every other RPC
+    # is internode traffic and is served first, so client load can't starve heartbeats. They do
+    # their work before returning and return a coroutine only to wait for a commit or a change
+    CLIENT_RPCS = frozenset({"execute", "import_data", "export_data", "read_log", "watch"})
+    # Transfer and restore rate budgeted for a store snapshot on top of the heartbeat RPC timeout
+    SNAPSHOT_BYTES_PER_SECOND = 5_000_000
+    # Clients whose request rate is tracked, the least recently seen is forgotten first
+    MAX_RATE_LIMITED_CLIENTS = 10000
     _LOG_ROLE = {
         NodeType.FOLLOWER: ColorLog._CYAN.value + "[Follower]" + ColorLog._ENDC.value,
         NodeType.CANDIDATE: ColorLog._MAGENTA.value + "[Candidate]" + ColorLog._ENDC.value,
         NodeType.LEADER: ColorLog._BLUE.value + "[Leader]" + ColorLog._ENDC.value,
+        NodeType.LEARNER: ColorLog._GREEN.value + "[Learner]" + ColorLog._ENDC.value,
     }
     
     
@@ -38,186 +70,475 @@ class RaftNode:
         FOLLOWER = 1
         CANDIDATE = 2
         LEADER = 3
+        LEARNER = 4
 
     class StableVars(TypedDict):
         election_term: int
         voted_for: Address     
-        log: List[Log] 
+        log: LogStore
         commit_length: int
 
-    def __init__(self, application: KVStore, addr: Address, contact_addr: Address = None):
-        socket.setdefaulttimeout(RaftNode.RPC_TIMEOUT)
+    """
+    All Raft state is owned by the asyncio event loop the node runs on: RPC handlers
+    and the role loops started by run() execute on that loop only, and every RPC to
+    other nodes is awaited without blocking it. The transport, stable storage, clock
+    and random source can be swapped out, utils/SimNetwork.py uses that to run whole
+    clusters in memory on a virtual clock
+    """
+    def __init__(self, application: KVStore, addr: Address, contact_addr: Address = None, config: RaftConfig = None,
+                 transport: Transport = None, stable_storage: StableStorage = None, clock = time.time, rng: random.Random = None):
+        self.clock                                  = clock
+        self.rng:                 random.Random     = rng or random.Random()
         self.address:             Address           = addr
+        self.contact_addr:        Address           = contact_addr
         self.type:                NodeType          = NodeType.FOLLOWER
-        self.log:                 List[Log]         = []
         self.app:                 KVStore           = application
         self.election_term:       int               = 0
         self.cluster_addr_list:   List[Address]     = []
+        self.cluster_learner_list: List[Address]    = []
+        # Voters of the previous configuration while a joint consensus change is in progress
+        self.joint_addr_list:     List[Address]     = None
+        self.config_index:        int               = -1
         self.cluster_leader_addr: Address           = None
-        self.heartbeat_time:      float             = time.time()
-        self.timeout_time:        float             = time.time() + RaftNode.ELECTION_TIMEOUT_MIN + (RaftNode.ELECTION_TIMEOUT_MAX - RaftNode.ELECTION_TIMEOUT_MIN) * random.random()
+        # Timing starts from the configured values and follows the observed RTT when adaptive
+        self.config:              RaftConfig        = config or RaftConfig()
+        self.initial_members:     List[Address]     = RaftNode.parse_members(self.config.initial_members)
+        self.heartbeat_interval:  float             = self.config.heartbeat_interval
+        self.election_timeout_min: float            = self.config.election_timeout_min
+        self.election_timeout_max: float            = self.config.election_timeout_max
+        self.rpc_timeout:         float             = self.config.rpc_timeout
+        self.rtt:                 Dict[Address, LatencyWindow] = {}
+        self.heartbeat_time:      float             = self.clock()
+        self.timeout_time:        float             = self.clock() + self.election_timeout_min + (self.election_timeout_max - self.election_timeout_min) * self.rng.random()
         """ DELETE FOR LATER, DEBUGGING TIME"""
-        self.debug_time:         float             = time.time()
-        self.current_time:        float             = time.time()
+        self.debug_time:         float             = self.clock()
+        self.current_time:        float             = self.clock()
         self.votes_received:    Set[Address] 
         self.ack_length:        Dict[Address, int]  = {}
         self.sent_length:       Dict[Address, int]  = {}
+        # Check-quorum and leader lease bookkeeping
+        self.leader_contact_time: float             = self.clock()
+        self.leader_since:        float             = self.clock()
+        self.last_ack_time:       Dict[Address, float] = {}
+        # Leadership transfer, target is set on the leader and the flag on the follower taking over
+        self.transfer_target:     Address           = None
+        self.transfer_election:   bool              = False
+        self.transfer_task:       asyncio.Task      = None
+        # Set and replaced whenever the commit length advances, wakes up long-polling watchers
+        self.commit_event:        asyncio.Event     = asyncio.Event()
+        # Set by execute so the leader replicates new entries right away instead of on the next heartbeat
+        self.replicate_event:     asyncio.Event     = asyncio.Event()
+        # Log length known to be on our own disk, the leader only counts itself toward a
+        # commit quorum up to here, while its writes run alongside the AppendEntries
+        self.durable_length:      int               = 0
+        self.append_times:        Dict[int, float]  = {}
+        self.tracer:              Tracer            = Tracer(self.config.trace_capacity, self.config.tracing)
+        # Replication payloads are compressed with our codec for peers that advertised they can decode it
+        self.codec:               Compression.Codec = Compression.get_codec(self.config.compression)
+        self.peer_codecs:         Dict[Address, List[str]] = {}
+        self.packed_cache:        Dict[str, tuple]  = {}
+        # Store copies of running exports by export id, oldest first
+        self.exports:             OrderedDict[str, Dict] = OrderedDict()
+        # [term, log length] of the leader store snapshot we restored last, and of the one each follower holds
+        self.store_version:       List[int]         = None
+        self.peer_store_versions: Dict[Address, List[int]] = {}
+        # Request rate of each client session, for the per-client rate limit
+        self.client_buckets:      OrderedDict[str, TokenBucket] = OrderedDict()
+        self.metrics:             MetricsRegistry   = MetricsRegistry()
+        self.__init_metrics()
 
         # Get state from stable storage
-        self.__fetch_stable_storage()
+        self.__fetch_stable_storage(stable_storage)
         
         # Additional vars
         self.message_parser: MessageParser = MessageParser()
-        self.rpc_handler: RPCHandler = RPCHandler()
-        
-        if contact_addr is None:
-            self.cluster_addr_list.append(self.address)
+        self.transport: Transport = transport or RPCTransport()
+
+    """
+    Joins the cluster (or founds it when there is no contact address, or starts as one
+    of the initial_members of a statically configured cluster) and then drives the
+    loop of whatever role the node currently has, until the task is cancelled
+    """
+    async def run(self):
+        if self.initial_members:
+            self.__bootstrap(self.initial_members)
+            self.__initialize_as_follower()
+        elif self.contact_addr is None:
+            if self.config_index < 0:
+                self.cluster_addr_list.append(self.address)
             self.__initialize_as_leader()
         else:
-            self.__try_to_apply_membership(contact_addr)
-            self.__initialize_as_follower()
+            await self.__try_to_apply_membership(self.contact_addr)
+            if self.type == NodeType.LEARNER:
+                self.__initialize_as_learner()
+            else:
+                self.__initialize_as_follower()
+
+        try:
+            while True:
+                if self.type == NodeType.LEADER:
+                    await self.__leader_heartbeat()
+                elif self.type == NodeType.LEARNER:
+                    await self.__learner_catch_up()
+                elif self.type == NodeType.CANDIDATE:
+                    await self.__start_election()
+                else:
+                    await self.__follower_timeout()
+        finally:
+            await self.transport.close()
+            self.stable_storage.flush()
 
-    def __fetch_stable_storage(self):
-        self.stable_storage = StableStorage[RaftNode.StableVars](self.address)
+    @staticmethod
+    def parse_members(members: str) -> List[Address]:
+        """ "ip:port,ip:port" to addresses """
+        return [Address(member.rsplit(":", 1)[0], int(member.rsplit(":", 1)[1]))
+                for member in members.split(",") if member.strip()]
+
+    def __bootstrap(self, members: List[Address]):
+        """
+        Static bootstrap: every initial member starts with the same configuration
+        entry at index 0, in term 0, committed from the start, so the members elect a
+        leader among themselves right away instead of joining one after another
+        """
+        if self.address not in members:
+            raise ValueError(f"{self.address} is not one of the initial members {members}")
+        with self.stable_storage as stable_vars:
+            if len(stable_vars["log"]) > 0:
+                # restarted, the log already has the configuration
+                return
+            stable_vars["log"].append(Log({
+                "term": 0,
+                "command": RaftNode.CONFIG_COMMAND,
+                "value": json.dumps({"voters": members, "learners": [], "old_voters": None}),
+            }))
+            stable_vars["commit_length"] = 1
+            self.stable_storage.storeAll(stable_vars)
+            self.durable_length = 1
+            self.__apply_config(stable_vars["log"])
+        self.__print_log(f"Bootstrapping a cluster of {members}")
+
+    def __fetch_stable_storage(self, stable_storage: StableStorage = None):
+        self.stable_storage = stable_storage or StableStorage[RaftNode.StableVars](self.address, self.metrics, tracer=self.tracer)
+        self.stable_storage.tracer = self.tracer
+        self.stable_storage.codec = self.codec
+        self.stable_storage.compression_threshold = self.config.compression_threshold
+        self.stable_storage.decoder = RaftNode.__decode_stable
         loaded = self.stable_storage.try_load()
         if loaded is not None:
             self.__print_log(f"Loaded stable storage: {loaded}")
+            self.__apply_config(loaded["log"])
+            self.durable_length = len(loaded["log"])
             return
 
         self.__init_stable()
 
+    @staticmethod
+    def __decode_stable(data) -> StableVars:
+        data["log"] = LogStore.from_data(data["log"])
+        return data
+
     def __init_stable(self):
         data = RaftNode.StableVars({
             'election_term': 0,
             'voted_for': None,
-            'log': [],
+            'log': LogStore(),
             'commit_length': 0,
         })
         self.stable_storage.storeAll(data)
 
+    def __init_metrics(self):
+        self.append_entries_latency = self.metrics.histogram("raft_append_entries_latency_seconds", "Round trip time of heartbeat/AppendEntries RPCs per peer")
+        self.append_entries_failures = self.metrics.counter("raft_append_entries_failures_total", "Heartbeat/AppendEntries RPCs that got no response per peer")
+        self.commit_lag = self.metrics.gauge("raft_commit_lag_entries", "Committed entries the leader has not seen acknowledged by each follower")
+        self.elections = self.metrics.counter("raft_elections_total", "Elections this node ran as a candidate by result")
+        self.election_duration = self.metrics.histogram("raft_election_duration_seconds", "Time from becoming candidate until winning or stepping down")
+        self.execute_latency = self.metrics.histogram("raft_execute_latency_seconds", "Time to handle an execute RPC by command")
+        self.commit_latency = self.metrics.histogram("raft_commit_latency_seconds", "Time from the leader appending an entry until it commits")
+        self.execute_rejected = self.metrics.counter("raft_execute_rejected_total", "Writes turned away by admission control by reason")
+        self.uncommitted_bytes = self.metrics.gauge("raft_uncommitted_bytes", "Payload bytes of the entries not committed yet")
+        self.execute_duplicates = self.metrics.counter("raft_execute_duplicates_total", "Retried client requests answered from the session table")
+        self.bulk_keys = self.metrics.counter("kv_bulk_keys_total", "Keys moved by bulk import and export by direction")
+        self.session_count = self.metrics.gauge("kv_client_sessions", "Client sessions in the KV store")
+        self.log_length = self.metrics.gauge("raft_log_entries", "Entries in the log")
+        self.log_bytes = self.metrics.gauge("raft_log_memory_bytes", "Memory held by the in-memory log columns")
+        self.commit_length_gauge = self.metrics.gauge("raft_commit_length", "Entries known to be committed")
+        self.term_gauge = self.metrics.gauge("raft_term", "Current election term")
+        self.leader_gauge = self.metrics.gauge("raft_is_leader", "1 if this node is the leader")
+        self.key_count = self.metrics.gauge("kv_keys", "Keys in the KV store")
+        self.metrics.add_collector(self.__collect_metrics)
+
+    def __collect_metrics(self):
+        with self.stable_storage as stable_vars:
+            log_length = len(stable_vars["log"])
+            log_bytes = stable_vars["log"].nbytes
+            uncommitted_bytes = stable_vars["log"].payload_bytes(stable_vars["commit_length"])
+            commit_length = stable_vars["commit_length"]
+        self.log_length.set(log_length)
+        self.log_bytes.set(log_bytes)
+        self.uncommitted_bytes.set(uncommitted_bytes)
+        self.commit_length_gauge.set(commit_length)
+        self.term_gauge.set(self.election_term)
+        self.leader_gauge.set(1 if self.type == NodeType.LEADER else 0)
+        self.key_count.set(len(self.app.store))
+        self.session_count.set(len(self.app.sessions))
+
+        self.commit_lag.clear()
+        if self.type == NodeType.LEADER:
+            for addr in self.__member_addrs():
+                if addr != self.address:
+                    self.commit_lag.set(max(0, commit_length - self.ack_length.get(addr, 0)), follower=addr)
+
     def __print_log(self, text: str):
         print(ColorLog.colorize(f"[{self.address}]", ColorLog._BLUE) + f"[{time.strftime('%H:%M:%S')}]" + RaftNode._LOG_ROLE[self.type] + " " + text)
 
     def __initialize_as_leader(self):
         self.cluster_leader_addr = self.address
         self.type = NodeType.LEADER
-        request = {
-            "cluster_leader_addr": self.address
-        }
-        self.heartbeat_thread = Thread(target=asyncio.run, args=[self.__leader_heartbeat()])
-        #make sure handle dropped connection
-        socket.setdefaulttimeout(10*RaftNode.RPC_TIMEOUT)
-        self.heartbeat_thread.start()
+        self.transfer_election = False
+        self.leader_since = self.clock()
+        self.last_ack_time = {}
+        self.sent_length = {}
+        self.append_times = {}
+        self.peer_store_versions = {}
 
     def __initialize_as_follower(self):
         self.type = NodeType.FOLLOWER
-        self.election_term = 0
-        self.voted_for = None
-        self.follower_timeout_thread = Thread(target=asyncio.run, args=[self.__follower_timeout()])
+        self.transfer_election = False
+        with self.stable_storage as stable_vars:
+            self.election_term = stable_vars["election_term"]
+            self.voted_for = stable_vars["voted_for"]
         self.randomize_timeout()
-        #make sure handle dropped connection
-        socket.setdefaulttimeout(10*RaftNode.RPC_TIMEOUT)
-        self.follower_timeout_thread.start()
-    
+
+    def __initialize_as_learner(self):
+        self.type = NodeType.LEARNER
+
+    async def __learner_catch_up(self):
+        self.__print_log("Initialize as learner node, waiting to catch up with the leader...")
+        while self.type == NodeType.LEARNER:
+            await asyncio.sleep(self.heartbeat_interval / 10)
+
+        self.__print_log(ColorLog.colorize("Promoted to voting member", ColorLog._GREEN))
+        self.__initialize_as_follower()
 
     async def __leader_heartbeat(self):
-        #restore socket timeout
-        socket.setdefaulttimeout(RaftNode.RPC_TIMEOUT)
         # log initialization
         self.__print_log("Initialize as leader node...")
         while self.type == NodeType.LEADER:
-            if time.time() - self.heartbeat_time > RaftNode.HEARTBEAT_INTERVAL:
+            if self.replicate_event.is_set() or self.clock() - self.heartbeat_time >= self.heartbeat_interval:
                 self.__print_log("Sending heartbeat...")
-                for addr in self.cluster_addr_list:
-                    if self.address != addr:
-                        self.send_heartbeat_msg(addr)
-                self.heartbeat_time = time.time()
+                self.replicate_event.clear()
+                self.heartbeat_time = self.clock()
+                with self.tracer.span("heartbeat.round"):
+                    await self.__send_heartbeats()
+                self.__tune_timing()
 
-            if self.election_term == 0xDEAD: 
-                self.__print_log("Stopping Leader Server...")
-                break
+                if self.type == NodeType.LEADER and not self.__check_quorum():
+                    self.__print_log(ColorLog.colorize("[CHECK QUORUM] ", ColorLog._RED) + "Lost contact with the majority, stepping down...")
+                    self.type = NodeType.FOLLOWER
+
+            try:
+                await asyncio.wait_for(self.replicate_event.wait(), max(0, self.heartbeat_time + self.heartbeat_interval - self.clock()))
+            except asyncio.TimeoutError:
+                pass
+
+        # stepped down, either from check-quorum or after seeing a higher term
+        if self.type == NodeType.FOLLOWER:
+            self.__initialize_as_follower()
+
+    async def __gather_until(self, decided, coros):
+        # stop waiting for slow or unreachable peers once the outcome is known
+        tasks = [asyncio.ensure_future(coro) for coro in coros]
+        pending = set(tasks)
+        try:
+            while pending and not decided():
+                _, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def __send_heartbeats(self, addrs: List[Address] = None):
+        peers = [addr for addr in (addrs or self.__member_addrs()) if addr != self.address]
+        # the store snapshot is the same for every follower, serialize it once per round
+        # and only when a follower doesn't have the current one yet
+        store = None
+        with self.stable_storage as stable_vars:
+            version = [stable_vars["election_term"], len(stable_vars["log"])]
+            if any(self.peer_store_versions.get(addr) != version for addr in peers):
+                store = (version, json.dumps(self.app.snapshot()))
+        await asyncio.gather(*(self.send_heartbeat_msg(addr, store) for addr in peers))
 
     async def __follower_timeout(self):
-        #restore socket timeout
-        socket.setdefaulttimeout(RaftNode.RPC_TIMEOUT)
         # log initialization
         self.__print_log("Initialize as follower node...")
         while self.type == NodeType.FOLLOWER:
-            if time.time() > self.timeout_time:
-                self.__print_log(ColorLog.colorize("[TIMEOUT] ", ColorLog._RED) + "Timeout has occured, changing to candidate...")
+            if self.transfer_election:
+                # the leader handed over leadership, no need to ask for permission first
+                self.__print_log(ColorLog.colorize("[TIMEOUT NOW] ", ColorLog._RED) + "Leadership transferred, changing to candidate...")
                 self.type = NodeType.CANDIDATE
-                break
+                return
 
-            if self.election_term == 0xDEAD: 
-                self.__print_log("Stopping Follower Server...")
+            if self.clock() > self.timeout_time:
+                if self.address not in self.__voter_addrs():
+                    # removed from the cluster, don't disturb the remaining members
+                    self.randomize_timeout()
+                    continue
+                self.__print_log(ColorLog.colorize("[TIMEOUT] ", ColorLog._RED) + "Timeout has occured, starting pre-vote...")
+                pre_vote_start = self.clock()
+                if not await self.__pre_vote():
+                    # a majority still hears from a leader or has a newer log, don't disrupt it
+                    self.__print_log("Pre-vote rejected, staying as follower...")
+                    self.randomize_timeout()
+                    continue
+                if self.type != NodeType.FOLLOWER:
+                    return
+                if self.leader_contact_time >= pre_vote_start:
+                    # another node won while we waited for slow pre-vote responses
+                    self.__print_log("Heard from a new leader during pre-vote, staying as follower...")
+                    continue
+                self.__print_log("Pre-vote granted, changing to candidate...")
+                self.type = NodeType.CANDIDATE
                 return
-        
-        self.election_term += 1
-        self.__print_log(ColorLog.colorize(f"Starting election for term {self.election_term}...", ColorLog._MAGENTA))
-        await self.__start_election()
+
+            await asyncio.sleep(self.heartbeat_interval / 10)
 
     async def __start_election(self):
-        #randomize timeout
-        self.randomize_timeout()
+        election_start = self.clock()
+        try:
+            await self.__run_election()
+        finally:
+            self.election_duration.observe(self.clock() - election_start)
+            self.elections.inc(result="won" if self.type == NodeType.LEADER else "lost")
 
-        # initialize voting
-        self.voted_for = self.address
-        while(time.time() < self.timeout_time):
-            self.votes_received = set()
-            self.__print_log(f"Voted for {self.address}")
-            self.votes_received.add(self.address)
-            self.__print_log(f"Sending vote requests to other nodes...")
-            for addr in self.cluster_addr_list:
-                if self.address != addr:
-                    await self.send_vote_request(addr)
+    async def __run_election(self):
+        while self.type == NodeType.CANDIDATE:
+            self.election_term += 1
+            self.__print_log(ColorLog.colorize(f"Starting election for term {self.election_term}...", ColorLog._MAGENTA))
+            #randomize timeout
+            self.randomize_timeout()
+
+            # initialize voting
+            self.voted_for = self.address
+            with self.stable_storage as stable_vars:
+                stable_vars["election_term"] = self.election_term
+                stable_vars["voted_for"] = self.address
+                self.stable_storage.storeAll(stable_vars)
+
+            while self.type == NodeType.CANDIDATE and self.clock() < self.timeout_time:
+                self.votes_received = set()
+                self.__print_log(f"Voted for {self.address}")
+                self.votes_received.add(self.address)
+                if self.__has_quorum(self.votes_received):
+                    self.type = NodeType.LEADER
+                else:
+                    self.__print_log(f"Sending vote requests to other nodes...")
+                    await self.__gather_until(lambda: self.type != NodeType.CANDIDATE,
+                                              (self.send_vote_request(addr) for addr in self.__voter_addrs() if addr != self.address))
 
                 # after voting, check if the node has won the election
                 if(self.type == NodeType.FOLLOWER):
                     return self.__initialize_as_follower()
                 elif(self.type == NodeType.LEADER):
                     return self.__initialize_as_leader()
-                elif (time.time() > self.timeout_time):
-                    break
-            self.__print_log(f"Vote results: {self.votes_received}")
-            self.__print_log("retrying election...")
-
-            if self.election_term == 0xDEAD: 
-                self.__print_log("Stopping Follower Server...")
-                return
-        
+                self.__print_log(f"Vote results: {self.votes_received}")
+                self.__print_log("retrying election...")
+                await asyncio.sleep(self.heartbeat_interval)
 
+            if(self.type == NodeType.CANDIDATE):
+                self.__print_log(ColorLog.colorize("[TIMEOUT]", ColorLog._RED) + " Timeout Occured, retrying election for next term...")
 
-        if(self.type == NodeType.CANDIDATE):
-            self.__print_log(ColorLog.colorize("[TIMEOUT]", ColorLog._RED) + " Timeout Occured, retrying election for next term...")
-            self.election_term += 1
-            self.__print_log(ColorLog.colorize(f"Starting election for term {self.election_term}...", ColorLog._MAGENTA))
-            return await self.__start_election()
-        else:
-            return #finish election
+        if(self.type == NodeType.FOLLOWER):
+            self.__initialize_as_follower()
 
     async def send_vote_request(self, addr: Address):
         with self.stable_storage as stable_vars:
-            stable_vars["election_term"] = self.election_term
-            request : BaseMessage = {
-                "candidate_addr": self.address,
-                "election_term": self.election_term,
+            last_term, last_index = self.__last_log_info(stable_vars["log"])
+        election_term = self.election_term
+        request : BaseMessage = {
+            "candidate_addr": self.address,
+            "election_term": election_term,
+            "last_term": last_term,
+            "last_index": last_index,
+            "leadership_transfer": self.transfer_election,
+        }
+        try:
+            response = await self.__send_request(request, "vote", addr)
+        except Exception as e:
+            self.__print_log(f"Failed to get response from {addr} for vote request")
+            return
+
+        # if response["election_term"] > stable_vars["election_term"]: # get heartbeats from other node leader
+        if response["election_term"] > self.election_term:
+            with self.stable_storage as stable_vars:
+                stable_vars.update({
+                    "election_term": response["election_term"],
+                    "voted_for": None,
+                })
+                self.stable_storage.storeAll(stable_vars)
+            self.election_term = response["election_term"]
+            self.type = NodeType.FOLLOWER
+            self.votes_received = set()
+            return
+
+        # the election is over or moved on to another term while waiting
+        if self.type != NodeType.CANDIDATE or self.election_term != election_term:
+            return
+
+        # unsuccessful vote request
+        if response["status"] != ResponseStatus.SUCCESS.value:
+            self.__print_log(f"Failed to get voting from {addr} for vote request")
+            self.__print_log(f"Reason: {response['reason']}")
+            return
+
+        self.votes_received.add(addr)
+        self.__print_log(ColorLog.colorize(f"Received vote from {addr}", ColorLog._GREEN))
+        if self.__has_quorum(self.votes_received):
+            self.type = NodeType.LEADER
+            self.__print_log("Election won, changing to leader...")
+            self.__print_log(f"Voting result: {self.votes_received}")
+
+    async def send_heartbeat_msg(self, addr: Address, store: tuple = None):
+        with self.stable_storage as stable_vars:
+            prev_last_index = min(self.sent_length.get(addr, 0), len(stable_vars["log"]))
+            # every change of the store comes with a log entry, so (term, log length)
+            # identifies the leader's store and a follower that has it gets no snapshot
+            version = [stable_vars["election_term"], len(stable_vars["log"])]
+            if self.peer_store_versions.get(addr) == version:
+                store = (None, None)
+            elif store is None or store[0] != version:
+                store = (version, json.dumps(self.app.snapshot()))
+            request = {
+                "leader_addr": self.address,
+                "election_term": stable_vars["election_term"],
+                "prev_last_term": stable_vars["log"].term(prev_last_index - 1) if prev_last_index > 0 else 0,
+                "prev_last_index": prev_last_index,
+                "entries": stable_vars["log"][prev_last_index:],
+                "leader_commit": stable_vars["commit_length"],
+                "app_store" : store[1],
+                "store_version": store[0],
+                # followers derive their election timeout from the leader's heartbeat interval
+                "heartbeat_interval": self.heartbeat_interval,
             }
-            try:
-                if(self.type == NodeType.FOLLOWER):
-                    return
-                response = self.__send_request(request, "vote", addr)
-            except Exception as e:
-                self.__print_log(f"Failed to get response from {addr} for vote request")
-                return
-            
-            # unsuccessful vote request
-            if response["status"] != ResponseStatus.SUCCESS.value:
-                self.__print_log(f"Failed to get voting from {addr} for vote request")
-                self.__print_log(f"Reason: {response['reason']}")
-                return
+        self.__pack_heartbeat(request, addr)
+
+        # a large snapshot takes a while to send and to restore, give it time on top of the RTT based deadline
+        timeout = self.rpc_timeout + len(store[1] or "") / RaftNode.SNAPSHOT_BYTES_PER_SECOND
+        rtt = self.rtt.setdefault(addr, LatencyWindow(self.config.rtt_window))
+        sent_time = self.clock()
+        try:
+            with self.tracer.span("replication.rpc"):
+                response = await self.__send_request(request, "heartbeat", addr, timeout)
+            rtt.record(self.clock() - sent_time)
+            self.append_entries_latency.observe(self.clock() - sent_time, peer=addr)
+        except Exception as e:
+            # no RTT sample for lost heartbeats, during a partition they would stretch the
+            # election timeout and delay check-quorum stepping the isolated leader down
+            self.append_entries_failures.inc(peer=addr)
+            self.__print_log(f"Got an exception when sending heartbeat to {addr}. Something went wrong")
+            self.__print_log(f"Exception: {e}")
+            return
 
-            # if response["election_term"] > stable_vars["election_term"]: # get heartbeats from other node leader
-            if response["election_term"] > self.election_term:
+        with self.stable_storage as stable_vars:
+            if response["election_term"] > stable_vars["election_term"]:
                 stable_vars.update({
                     "election_term": response["election_term"],
                     "voted_for": None,
@@ -228,61 +549,26 @@ class RaftNode:
                 self.votes_received = set()
                 return
 
-            if(self.type == NodeType.FOLLOWER):
+            if response["status"] != ResponseStatus.SUCCESS.value or self.type != NodeType.LEADER \
+                    or request["election_term"] != stable_vars["election_term"]:
                 return
 
-            if response["status"] == ResponseStatus.SUCCESS.value:
-                self.votes_received.add(addr)
-                self.__print_log(ColorLog.colorize(f"Received vote from {addr}", ColorLog._GREEN))
-                if len(self.votes_received) >= math.floor(len(self.cluster_addr_list) / 2) + 1:
-                    self.type = NodeType.LEADER
-                    self.__print_log("Election won, changing to leader...")
-                    self.__print_log(f"Voting result: {self.votes_received}")
-                    return
-    
-
-    def send_heartbeat_msg(self, addr: Address):
-        with self.stable_storage as stable_vars:
-            prev_last_index = self.sent_length.get(addr, 0)
-            next_index = stable_vars["log"][prev_last_index:]
-            prev_last_term = stable_vars["log"][prev_last_index - 1]["term"] if prev_last_index > 0 else 0
-
-            try:
-                _dict_to_str : str = json.dumps(self.app.store)
-                response = self.__send_request({
-                    "leader_addr": self.address,
-                    "election_term": stable_vars["election_term"],
-                    "prev_last_term": prev_last_term,
-                    "prev_last_index": prev_last_index,
-                    "entries": next_index,
-                    "leader_commit": stable_vars["commit_length"],
-                    "app_store" : _dict_to_str
-                }, "heartbeat", addr)
-                if response is None:
-                    self.__print_log(f"No response from {addr} for heartbeat.")
-                    return
-                if response["status"] != ResponseStatus.SUCCESS.value:
-                    return
-            except Exception as e:
-                self.__print_log(f"Got an exception when sending heartbeat to {addr}. Something went wrong")
-                self.__print_log(f"Exception: {e}")
-                return
-            
+            if "codecs" in response:
+                self.peer_codecs[addr] = response["codecs"]
+            self.peer_store_versions[addr] = response.get("store_version")
+            # follower acknowledged us as leader for this term, counts toward check-quorum
+            self.last_ack_time[addr] = self.clock()
             ack = response["ack"]
-            if response["election_term"] == stable_vars["election_term"] and self.type == NodeType.LEADER and response.get("sync"):
+            if response.get("sync"):
                 if ack >= self.ack_length.get(addr, 0):
                     self.ack_length[addr] = ack
                     self.sent_length[addr] = ack
                     self.__commit_log(stable_vars)
-                
-            elif response["election_term"] > stable_vars["election_term"]:
-                stable_vars.update({
-                    "election_term": response["election_term"] + 1,
-                    "voted_for": None,
-                })
-                self.stable_storage.storeAll(stable_vars)
-                self.type = NodeType.FOLLOWER
-                self.votes_received = set()
+                if addr in self.cluster_learner_list and ack >= len(stable_vars["log"]) - RaftNode.LEARNER_PROMOTION_THRESHOLD:
+                    self.__promote_learner(addr, stable_vars)
+            else:
+                # log mismatch at prev_last_index, walk back one entry and retry on the next heartbeat
+                self.sent_length[addr] = max(0, prev_last_index - 1)
 
 
     """
@@ -295,41 +581,31 @@ class RaftNode:
                 req = self.message_parser.deserialize(req)
                 
                 # make sure that the new follower is not already in the cluster
-                # self.cluster_addr_list.append(Address(**req["address"]))
-                if Address(**req["address"]) in self.cluster_addr_list:
+                new_addr = Address(**req["address"])
+                if new_addr in self.__member_addrs():
                     response = {
                         "status": ResponseStatus.SUCCESS.value,
                         "address": self.address,
                         "cluster_addr_list": self.cluster_addr_list,
+                        "cluster_learner_list": self.cluster_learner_list,
+                        "learner": new_addr in self.cluster_learner_list,
                         "reason": "Already in the cluster",
-                        "log": self.log
                     }
                     return self.message_parser.serialize(response)
 
-                self.cluster_addr_list.append(Address(**req["address"]))
+                # new nodes join as learners and don't count toward quorum until they caught up,
+                # learners don't vote so this doesn't need a joint configuration
+                with self.stable_storage as stable_vars:
+                    self.__append_config(stable_vars, self.cluster_addr_list, self.cluster_learner_list + [new_addr], self.joint_addr_list)
                 response = {
                     "status": ResponseStatus.SUCCESS.value,
                     "address": self.address,
                     "cluster_addr_list": self.cluster_addr_list,
+                    "cluster_learner_list": self.cluster_learner_list,
+                    "learner": True,
                     "reason": "Success applying membership",
-                    "log": self.log
                 }
-                self.__print_log(f"Accepted a new follower : {req['address']['ip']}:{req['address']['port']}")
-
-                # iterate for every node in the cluster to update the membership of the cluster
-                for addr in self.cluster_addr_list:
-                    if addr != self.address and addr != Address(**req["address"]):
-                        self.__print_log(ColorLog._MAGENTA.value + f" Updating membership for {addr} " + ColorLog._ENDC.value)
-                        # reset socket timeout for updating membership
-                        socket.setdefaulttimeout(10*RaftNode.RPC_TIMEOUT)
-                        try:
-                            res = self.__send_request({"address": Address(**req["address"])}, "update_membership", addr)
-                        except:
-                            pass
-                        #restore socket timeout
-                        socket.setdefaulttimeout(RaftNode.RPC_TIMEOUT)
-       
-                        
+                self.__print_log(f"Accepted a new learner : {req['address']['ip']}:{req['address']['port']}")
                 return self.message_parser.serialize(response)
             else:
                 response = {
@@ -348,24 +624,115 @@ class RaftNode:
         
 
     """
-    RPC Method to update new membership in the cluster (for Follower/Candidate)
+    RPC Method to remove a node from the cluster. Learners are dropped right away,
+    voters go through a joint configuration so both the old and the new majority
+    agree on the change
     """
-    def update_membership(self, req) :
-        # self.__print_log("Updating membership")
-        # self.__print_log(ColorLog._MAGENTA.value + req + ColorLog._ENDC.value)
-        if self.type == NodeType.FOLLOWER:
-            req = self.message_parser.deserialize(req)
-            self.__print_log(ColorLog._MAGENTA.value + f" Received new membership: {req['address']['ip']}:{req['address']['port']} " + ColorLog._ENDC.value)
-            _new_addr = Address(**req["address"])
-            self.cluster_addr_list.append(_new_addr)
+    def remove_membership(self, req) :
+        req = self.message_parser.deserialize(req)
+        if self.type != NodeType.LEADER:
+            return self.message_parser.serialize(BaseResponse({
+                "status": ResponseStatus.REDIRECTED.value,
+                "address": self.cluster_leader_addr,
+                "reason": "NOT LEADER",
+            }))
+
+        addr = Address(**req["address"])
+        with self.stable_storage as stable_vars:
+            if addr in self.cluster_learner_list:
+                learners = [learner for learner in self.cluster_learner_list if learner != addr]
+                self.__append_config(stable_vars, self.cluster_addr_list, learners, self.joint_addr_list)
+                status, reason = ResponseStatus.SUCCESS, "Learner removed"
+            elif addr not in self.cluster_addr_list:
+                status, reason = ResponseStatus.FAILED, "Not a member of the cluster"
+            elif len(self.cluster_addr_list) == 1:
+                status, reason = ResponseStatus.FAILED, "Can't remove the last voting member"
+            elif self.__config_change_pending(stable_vars):
+                status, reason = ResponseStatus.ONPROCESS, "Another membership change is in progress"
+            else:
+                voters = [voter for voter in self.cluster_addr_list if voter != addr]
+                self.__append_config(stable_vars, voters, self.cluster_learner_list, self.cluster_addr_list)
+                status, reason = ResponseStatus.SUCCESS, "Membership change started"
+        self.__print_log(f"Remove membership {addr}: {reason}")
+        return self.message_parser.serialize(BaseResponse({
+            "status": status.value,
+            "address": self.address,
+            "reason": reason,
+        }))
+
+    def __promote_learner(self, addr: Address, stable_vars: StableVars):
+        if self.__config_change_pending(stable_vars):
+            return
+        self.__print_log(ColorLog.colorize(f"Learner {addr} caught up, promoting to voting member", ColorLog._GREEN))
+        learners = [learner for learner in self.cluster_learner_list if learner != addr]
+        self.__append_config(stable_vars, self.cluster_addr_list + [addr], learners, self.cluster_addr_list)
+
+    """
+    Configuration entries. The latest config entry in the log is in effect as soon as
+    it is appended, committed or not. A voter change first appends a joint entry
+    (old_voters set) and the leader appends the final entry once the joint one commits
+    """
+    def __append_config(self, stable_vars: StableVars, voters: List[Address], learners: List[Address], old_voters: List[Address] = None):
+        log = Log({
+            "term": stable_vars["election_term"],
+            "command": RaftNode.CONFIG_COMMAND,
+            "value": json.dumps({
+                "voters": voters,
+                "learners": learners,
+                "old_voters": old_voters,
+            }),
+        })
+        stable_vars["log"].append(log)
+        self.stable_storage.storeAll(stable_vars)
+        self.durable_length = len(stable_vars["log"])
+        self.__apply_config(stable_vars["log"])
+        self.__print_log(ColorLog.colorize(f"Appended configuration {log['value']}", ColorLog._MAGENTA))
+
+    def __apply_config(self, log: LogStore):
+        self.config_index = -1
+        for i in range(len(log) - 1, -1, -1):
+            if log.command(i) == RaftNode.CONFIG_COMMAND:
+                self.config_index = i
+                break
+        if self.config_index < 0:
+            return
+
+        config = json.loads(log[self.config_index]["value"])
+        self.cluster_addr_list = [Address(**addr) for addr in config["voters"]]
+        self.cluster_learner_list = [Address(**addr) for addr in config["learners"]]
+        self.joint_addr_list = [Address(**addr) for addr in config["old_voters"]] if config["old_voters"] is not None else None
+        if self.type == NodeType.LEARNER and self.address in self.cluster_addr_list:
+            self.type = NodeType.FOLLOWER
+
+    def __config_change_pending(self, stable_vars: StableVars) -> bool:
+        return self.joint_addr_list is not None or self.config_index >= stable_vars["commit_length"]
+
+    def __on_commit(self, stable_vars: StableVars):
+        if self.config_index < 0 or self.config_index >= stable_vars["commit_length"]:
+            return
+        if self.joint_addr_list is not None:
+            # joint configuration is committed, move on to the new configuration alone
+            self.__append_config(stable_vars, self.cluster_addr_list, self.cluster_learner_list)
+        elif self.address not in self.cluster_addr_list and self.type == NodeType.LEADER:
+            self.__print_log("Removed from the cluster, stepping down...")
+            self.type = NodeType.FOLLOWER
+
+    def __voter_addrs(self) -> List[Address]:
+        voters = list(self.cluster_addr_list)
+        for addr in self.joint_addr_list or []:
+            if addr not in voters:
+                voters.append(addr)
+        return voters
+
+    def __member_addrs(self) -> List[Address]:
+        return self.__voter_addrs() + [addr for addr in self.cluster_learner_list if addr not in self.cluster_addr_list]
 
-    
     """
     Method to try to apply membership to the cluster when initializing a new node, 
     # Params:
     - contact_addr: Address , Leader of the cluster
     """
-    def __try_to_apply_membership(self, contact_addr: Address):
+    async def __try_to_apply_membership(self, contact_addr: Address):
         redirected_addr = contact_addr
         retry_count = 0
         response = {
@@ -375,70 +742,107 @@ class RaftNode:
                 "port": contact_addr.port,
             }
         }
-        while response["status"] != "success":
+        while response is None or response["status"] != "success":
             try:
-                response = self.__send_request({"address": self.address}, "apply_membership", redirected_addr)
+                response = await self.__send_request({"address": self.address}, "apply_membership", redirected_addr)
                 redirected_addr = Address(response["address"]["ip"], response["address"]["port"])
             except:
                 if retry_count < RaftNode.RETRY_COUNT:
                     self.__print_log("Didn't get response from leader, retrying...")
-                    time.sleep(RaftNode.HEARTBEAT_INTERVAL)
+                    await asyncio.sleep(self.heartbeat_interval)
                     retry_count += 1
                 else:
                     self.__print_log(ColorLog.colorize(f"Leader failed to respond {RaftNode.RETRY_COUNT} times, aborting membership application", ColorLog._RED))
                     exit()
         if response["status"] == "success":
-            self.log = response["log"]
             # self.cluster_addr_list = response["cluster_addr_list"]
             # make response["cluster_addr_list"] as list of Address
-            for addr in response["cluster_addr_list"]:
-                self.cluster_addr_list.append(Address(**addr))
+            self.cluster_addr_list = [Address(**addr) for addr in response["cluster_addr_list"]]
+            self.cluster_learner_list = [Address(**addr) for addr in response.get("cluster_learner_list", [])]
+            if response.get("learner", False):
+                self.type = NodeType.LEARNER
             self.cluster_leader_addr = Address(response["address"]["ip"], response["address"]["port"])
             self.__print_log(f"Current leader: {self.cluster_leader_addr}")
 
-    def __send_request(self, request: BaseMessage, rpc_name: str, addr: Address) -> "json":
-        self.__print_log(f"Sent request to {addr} : {request}")
-        self.__print_log(f"RPC Name: {rpc_name}")
-        response = self.rpc_handler.request(addr, rpc_name, request)
-        if response is None:
-            raise Exception(" " + ColorLog._WARNING.value + f"Failed to get a response from {addr} for {rpc_name} request" + ColorLog._ENDC.value + " ")
-        self.__print_log(f"Received response from {addr} : {response}")
-        return response
-    
-    async def __send_request_async(self, request: BaseMessage, rpc_name: str, addr: Address) -> "json":
-        self.__print_log(f"Sent async request to {addr} : {request}")
-        self.__print_log(f"RPC Name: {rpc_name}")
-        response = await self.rpc_handler.async_request(addr, rpc_name, request)
+    async def __send_request(self, request: BaseMessage, rpc_name: str, addr: Address, timeout: float = None) -> "json":
+        # heartbeats carry the whole log and store snapshot several times a second, don't dump them
+        verbose = rpc_name != "heartbeat"
+        if verbose:
+            self.__print_log(f"Sent request to {addr} : {request}")
+            self.__print_log(f"RPC Name: {rpc_name}")
+        timeout = timeout or self.rpc_timeout * RaftNode.RPC_TIMEOUT_FACTORS.get(rpc_name, 1)
+        response = await self.transport.request(addr, rpc_name, request, timeout)
         if response is None:
             raise Exception(" " + ColorLog._WARNING.value + f"Failed to get a response from {addr} for {rpc_name} request" + ColorLog._ENDC.value + " ")
-        self.__print_log(f"Received response from {addr} : {response}")
+        if verbose:
+            self.__print_log(f"Received response from {addr} : {response}")
         return response
 
     """
     Internode RPC Method to send heartbeat to other nodes
     """
     def heartbeat(self, json_request: str) -> "json":
-        self.type = NodeType.FOLLOWER # make sure when receiving heartbeat, the node is a follower
-        self.randomize_timeout()
-        request = self.message_parser.deserialize(json_request)
+        with self.tracer.span("heartbeat"):
+            with self.tracer.span("deserialize"):
+                request = self.message_parser.deserialize(json_request)
+                self.__unpack_heartbeat(request)
+            return self.__heartbeat(request)
+
+    def __pack_heartbeat(self, request, addr: Address):
+        if self.codec is None or self.codec.name not in self.peer_codecs.get(addr, []):
+            return
+        packed_entries = Compression.pack(json.dumps(request["entries"]), self.codec, self.config.compression_threshold)
+        if isinstance(packed_entries, dict):
+            request["entries"] = packed_entries
+        # the same store snapshot goes to every peer in a round, compress it once
+        if request["app_store"] is None:
+            return
+        cached_store, packed_store = self.packed_cache.get("app_store", (None, None))
+        if cached_store != request["app_store"]:
+            packed_store = Compression.pack(request["app_store"], self.codec, self.config.compression_threshold)
+            self.packed_cache["app_store"] = (request["app_store"], packed_store)
+        request["app_store"] = packed_store
+
+    def __unpack_heartbeat(self, request):
+        if isinstance(request["entries"], dict):
+            request["entries"] = json.loads(Compression.unpack(request["entries"]))
+        if request.get("app_store") is not None:
+            request["app_store"] = Compression.unpack(request["app_store"])
+
+    def __heartbeat(self, request) -> "json":
         self.__print_log(f"Received heartbeat from {Address(**request['leader_addr'])}")
         with self.stable_storage as stable_vars:
-            if request["election_term"] == stable_vars["election_term"]:
-                self.type = NodeType.FOLLOWER
-                self.cluster_leader_addr = Address(**request["leader_addr"])
-                self.votes_received = set()
-            elif request["election_term"] > stable_vars["election_term"]:
+            if request["election_term"] < stable_vars["election_term"]:
+                # stale leader, our term in the response makes it step down
+                return self.message_parser.serialize({
+                    "heartbeat_response": "nack",
+                    "address": self.address,
+                    "status": ResponseStatus.FAILED.value,
+                    "election_term": stable_vars["election_term"],
+                    "reason": "Stale election term",
+                    "ack": 0,
+                    "sync": False,
+                })
+
+            if self.type != NodeType.LEARNER:
+                self.type = NodeType.FOLLOWER # make sure when receiving heartbeat, the node is a follower
+            if self.config.adaptive and "heartbeat_interval" in request:
+                self.__set_heartbeat_interval(request["heartbeat_interval"])
+            self.randomize_timeout()
+            self.leader_contact_time = self.clock()
+            self.cluster_leader_addr = Address(**request["leader_addr"])
+            self.votes_received = set()
+            if request["election_term"] > stable_vars["election_term"]:
                 stable_vars.update({
                     "election_term": request["election_term"],
                     "voted_for": None,
                 })
+                self.election_term = request["election_term"]
                 self.stable_storage.storeAll(stable_vars)
-      
-            all_sync = (
-                                (request["prev_last_index"] == 0 or stable_vars["log"][request["prev_last_index"]-1]["term"] == stable_vars["election_term"] ) and 
-                (len(stable_vars["log"]) >= request["prev_last_index"])
-            )  and (
-                request["prev_last_index"] == 0 or stable_vars["log"][request["prev_last_index"]-1]["term"] == request["prev_last_term"]
+
+            prev_last_index = request["prev_last_index"]
+            all_sync = len(stable_vars["log"]) >= prev_last_index and (
+                prev_last_index == 0 or stable_vars["log"].term(prev_last_index - 1) == request["prev_last_term"]
             )
             
             response = {
@@ -448,14 +852,22 @@ class RaftNode:
                 "election_term": stable_vars["election_term"],
                 "reason": "",
                 "ack": 5,
+                # tells the leader which compressed payloads we can decode
+                "codecs": Compression.available(),
+                # and which store snapshot we already hold
+                "store_version": self.store_version,
             }
             if all_sync:
-                self.__append_entries(request["entries"], request["prev_last_index"], request["leader_commit"], stable_vars)
+                with self.tracer.span("log.append"):
+                    self.__append_entries(request["entries"], request["prev_last_index"], request["leader_commit"], stable_vars)
                 ack = int(request["prev_last_index"]) + len(request["entries"])
                 response["ack"] = ack
                 response["sync"] = True
-                _store_response : dict = json.loads(request["app_store"])
-                self.app.store = _store_response
+                if request.get("app_store") is not None:
+                    with self.tracer.span("apply"):
+                        _store_response : dict = json.loads(request["app_store"])
+                        self.app.restore(_store_response)
+                    self.store_version = request.get("store_version")
             else:
                 response["ack"] = 0
                 response["sync"] = False
@@ -467,90 +879,416 @@ class RaftNode:
     def vote(self, json_request: str) -> str:
         request = self.message_parser.deserialize(json_request)
         self.__print_log(f"Received vote request from {request['candidate_addr']} with election term {request['election_term']}")
-        
-        ## TO DO: FIXXXX THE RESPONSE! TEMPOARY RESPONSE to allow the voting
+        candidate_addr = Address(**request["candidate_addr"])
 
-        # randomize response status generator
-        _response_status : ResponseStatus = ResponseStatus.SUCCESS if (self.election_term < int(request["election_term"]))\
-                                                                   else ResponseStatus.FAILED
-        response = {
-            "status": _response_status.value,
-            "election_term": max(int(request["election_term"]),self.election_term),
+        with self.stable_storage as stable_vars:
+            if self.type == NodeType.LEARNER:
+                return self.message_parser.serialize({
+                    "status": ResponseStatus.FAILED.value,
+                    "election_term": stable_vars["election_term"],
+                    "address": self.address,
+                    "reason": "Learners don't vote",
+                })
+
+            if self.__in_leader_lease() and not request.get("leadership_transfer", False):
+                # still hearing from a live leader, ignore the candidate without bumping our term
+                return self.message_parser.serialize({
+                    "status": ResponseStatus.FAILED.value,
+                    "election_term": stable_vars["election_term"],
+                    "address": self.address,
+                    "reason": "Current leader is still alive",
+                })
+
+            if request["election_term"] > stable_vars["election_term"]:
+                stable_vars.update({
+                    "election_term": request["election_term"],
+                    "voted_for": None,
+                })
+                self.election_term = request["election_term"]
+                self.type = NodeType.FOLLOWER
+
+            voted_for = stable_vars["voted_for"]
+            log_ok = self.__is_log_up_to_date(request.get("last_term", 0), request.get("last_index", 0), stable_vars["log"])
+            granted = (
+                request["election_term"] == stable_vars["election_term"]
+                and (voted_for is None or Address(**voted_for) == candidate_addr)
+                and log_ok
+            )
+            if granted:
+                stable_vars["voted_for"] = candidate_addr
+                self.voted_for = candidate_addr
+                self.randomize_timeout()
+            self.stable_storage.storeAll(stable_vars)
+
+            if granted:
+                reason = ""
+            elif not log_ok:
+                reason = "Candidate's log is not up-to-date"
+            elif request["election_term"] < stable_vars["election_term"]:
+                reason = "Candidate's election term is outdated"
+            else:
+                reason = "Already voted for another candidate"
+            response = {
+                "status": (ResponseStatus.SUCCESS if granted else ResponseStatus.FAILED).value,
+                "election_term": stable_vars["election_term"],
+                "address": self.address,
+                "reason": reason,
+            }
+        self.__print_log(f"Sending vote response to {candidate_addr} : {response}")
+        return self.message_parser.serialize(response)
+
+    """
+    RPC Method for the pre-vote phase. Answers whether this node would vote for the
+    candidate in its next term, without touching any state, so a partitioned node
+    can't force elections by inflating its term
+    """
+    def pre_vote(self, json_request: str) -> str:
+        request = self.message_parser.deserialize(json_request)
+        self.__print_log(f"Received pre-vote request from {request['candidate_addr']} for election term {request['election_term']}")
+        with self.stable_storage as stable_vars:
+            if self.type == NodeType.LEARNER:
+                reason = "Learners don't vote"
+            elif self.__in_leader_lease():
+                reason = "Current leader is still alive"
+            elif request["election_term"] <= stable_vars["election_term"]:
+                reason = "Candidate's election term is outdated"
+            elif not self.__is_log_up_to_date(request.get("last_term", 0), request.get("last_index", 0), stable_vars["log"]):
+                reason = "Candidate's log is not up-to-date"
+            else:
+                reason = ""
+            response = {
+                "status": (ResponseStatus.FAILED if reason else ResponseStatus.SUCCESS).value,
+                "election_term": stable_vars["election_term"],
+                "address": self.address,
+                "reason": reason,
+            }
+        return self.message_parser.serialize(response)
+
+    async def __pre_vote(self) -> bool:
+        with self.stable_storage as stable_vars:
+            last_term, last_index = self.__last_log_info(stable_vars["log"])
+            request = {
+                "candidate_addr": self.address,
+                "election_term": stable_vars["election_term"] + 1,
+                "last_term": last_term,
+                "last_index": last_index,
+            }
+        granted = {self.address}
+
+        async def ask(addr: Address):
+            try:
+                response = await self.__send_request(request, "pre_vote", addr)
+            except Exception as e:
+                self.__print_log(f"Failed to get response from {addr} for pre-vote request")
+                return
+            if response["status"] == ResponseStatus.SUCCESS.value:
+                granted.add(addr)
+
+        await self.__gather_until(lambda: self.__has_quorum(granted), (ask(addr) for addr in self.__voter_addrs() if addr != self.address))
+        self.__print_log(f"Pre-vote results: {granted}")
+        return self.__has_quorum(granted)
+
+    """
+    RPC Method to hand leadership over to another member of the cluster. The leader
+    stops accepting writes, catches the target up to its last index and then tells
+    it to start an election right away with timeout_now
+    """
+    def transfer_leadership(self, json_request: str) -> str:
+        request = self.message_parser.deserialize(json_request)
+        if self.type != NodeType.LEADER:
+            return self.message_parser.serialize(BaseResponse({
+                "status": ResponseStatus.REDIRECTED.value,
+                "address": self.cluster_leader_addr,
+                "reason": "NOT LEADER",
+            }))
+
+        target = Address(**request["address"])
+        if target == self.address:
+            reason, status = "Already the leader", ResponseStatus.SUCCESS
+        elif target not in self.cluster_addr_list:
+            reason, status = "Target is not a member of the cluster", ResponseStatus.FAILED
+        elif self.transfer_target is not None:
+            reason, status = f"Leadership transfer to {self.transfer_target} already in progress", ResponseStatus.FAILED
+        else:
+            self.transfer_target = target
+            self.transfer_task = asyncio.create_task(self.__transfer_leadership(target))
+            reason, status = "Leadership transfer started", ResponseStatus.SUCCESS
+        return self.message_parser.serialize(BaseResponse({
+            "status": status.value,
+            "address": self.address,
+            "reason": reason,
+        }))
+
+    async def __transfer_leadership(self, target: Address):
+        self.__print_log(ColorLog.colorize(f"Transferring leadership to {target}...", ColorLog._MAGENTA))
+        deadline = self.clock() + self.election_timeout_min
+        try:
+            caught_up = False
+            while self.type == NodeType.LEADER and self.clock() < deadline:
+                with self.stable_storage as stable_vars:
+                    log_length = len(stable_vars["log"])
+                    election_term = stable_vars["election_term"]
+                if self.ack_length.get(target, 0) >= log_length:
+                    caught_up = True
+                    break
+                acked_at = self.last_ack_time.get(target)
+                await self.send_heartbeat_msg(target)
+                if self.last_ack_time.get(target) == acked_at:
+                    # no answer from the target, retry at the heartbeat pace instead of spinning
+                    await asyncio.sleep(self.heartbeat_interval)
+            if self.type != NodeType.LEADER:
+                self.__print_log(f"Leadership transfer to {target} aborted, no longer the leader")
+                return
+            if not caught_up:
+                self.__print_log(f"Leadership transfer to {target} aborted, target did not catch up")
+                return
+
+            await self.__send_request({
+                "leader_addr": self.address,
+                "election_term": election_term,
+            }, "timeout_now", target)
+
+            # keep writes blocked until the target's election deposes us
+            while self.type == NodeType.LEADER and self.clock() < deadline:
+                await asyncio.sleep(self.rpc_timeout / 10)
+            if self.type == NodeType.LEADER:
+                self.__print_log(f"Leadership transfer to {target} timed out, resuming as leader")
+        except Exception as e:
+            self.__print_log(f"Leadership transfer to {target} failed: {e}")
+        finally:
+            self.transfer_target = None
+
+    """
+    RPC Method sent by the leader at the end of a leadership transfer, the receiver
+    starts an election immediately instead of waiting for its election timeout
+    """
+    def timeout_now(self, json_request: str) -> str:
+        request = self.message_parser.deserialize(json_request)
+        with self.stable_storage as stable_vars:
+            election_term = stable_vars["election_term"]
+        if request["election_term"] < election_term or self.type != NodeType.FOLLOWER:
+            status = ResponseStatus.FAILED
+        else:
+            self.__print_log(f"Received timeout_now from {Address(**request['leader_addr'])}")
+            self.transfer_election = True
+            status = ResponseStatus.SUCCESS
+        return self.message_parser.serialize(BaseResponse({
+            "status": status.value,
             "address": self.address,
             "reason": "",
-        }
+        }))
 
-        # with self.stable_storage as stable_vars:
-        #     self.__print_log(ColorLog._MAGENTA.value + f"CP PPPPPP" + ColorLog._ENDC.value)
-        #     if request["election_term"] < stable_vars["election_term"]:
-        #         self.__print_log(ColorLog._MAGENTA.value + f"CP 1" + ColorLog._ENDC.value)
-        #         response = {
-        #             "status": ResponseStatus.SUCCESS.value,
-        #             "election_term": stable_vars["election_term"],
-        #             "address": self.address,
-        #             "reason": "Already voted for a candidate with higher term",
-        #         }
-        #     elif request["last_log_term"] < stable_vars["log"][-1]["term"]:
-        #         self.__print_log(ColorLog._MAGENTA.value + f"CP 2" + ColorLog._ENDC.value)
-        #         response = {
-        #             "status": ResponseStatus.SUCCESS.value,
-        #             "election_term": stable_vars["election_term"],
-        #             "address": self.address,
-        #             "reason": "Candidate's log is not up-to-date",
-        #         }
-        #     else:
-        #         self.__print_log(ColorLog._MAGENTA.value + f"CP else" + ColorLog._ENDC.value)
-        #         stable_vars.update({
-        #             "election_term": request["election_term"],
-        #             "voted_for": request["candidate_addr"],
-        #         })
-        #         self.__print_log(ColorLog._MAGENTA.value + f"CP" + ColorLog._ENDC.value)
-        #         self.stable_storage.storeAll(stable_vars)
-        #         self.__print_log(ColorLog._MAGENTA.value + f"CP" + ColorLog._ENDC.value)
-        #         response = {
-        #             "status": ResponseStatus.SUCCESS.value,
-        #             "election_term": request["election_term"],
-        #             "address": self.address,
-        #             "reason": "",
-        #         }
-        # self.__print_log(f"Sending vote response to {request['candidate_addr']} : {response}")
-        return self.message_parser.serialize(response)
+    """
+    Admin RPC to control hot path tracing on this node: start, stop, clear, or dump
+    the recorded spans, as a list ("spans", optionally only the last limit) or as
+    folded stacks of self time for flamegraph tools ("folded")
+    """
+    def trace(self, json_request: str) -> str:
+        request = self.message_parser.deserialize(json_request)
+        action = request.get("action", "dump")
+        data: Any = ""
+        if action == "start":
+            self.tracer.enabled = True
+        elif action == "stop":
+            self.tracer.enabled = False
+        elif action == "clear":
+            self.tracer.clear()
+        elif action == "dump":
+            data = self.tracer.folded() if request.get("format") == "folded" else self.tracer.dump(request.get("limit"))
+        else:
+            return self.message_parser.serialize(BaseResponse({
+                "status": ResponseStatus.FAILED.value,
+                "address": self.address,
+                "reason": f"Unknown trace action {action}",
+            }))
+        return self.message_parser.serialize({
+            "status": ResponseStatus.SUCCESS.value,
+            "address": self.address,
+            "tracing": self.tracer.enabled,
+            "data": data,
+        })
+
+    """
+    RPC Method to read a page of this node's own log, at most limit entries from
+    index start on, optionally only those of one election term. Any node answers,
+    so replicas can be compared. Continue from the returned next index
+    """
+    def read_log(self, json_request: str) -> str:
+        request: ReadLogRequest = self.message_parser.deserialize(json_request)
+        with self.stable_storage as stable_vars:
+            entries, next_index = self.__log_page(stable_vars["log"], request.get("start", 0), request.get("limit"), request.get("term"))
+            commit_length = stable_vars["commit_length"]
+        return self.message_parser.serialize(ReadLogResponse({
+            "status": ResponseStatus.SUCCESS.value,
+            "address": self.address,
+            "entries": entries,
+            "next": next_index,
+            "commit_length": commit_length,
+        }))
+
+    def __log_page(self, log: LogStore, start: int, limit: int | None, term: int | None):
+        limit = min(max(1, limit or RaftNode.LOG_PAGE_SIZE), RaftNode.MAX_LOG_PAGE_SIZE)
+        start = max(0, start)
+        end = len(log)
+        if term is not None:
+            # terms never decrease along the log, so the entries of a term are one contiguous run
+            start = bisect.bisect_left(log.terms, term, lo=min(start, end))
+            end = bisect.bisect_right(log.terms, term, lo=start)
+        stop = min(end, start + limit)
+        entries = [LogEntry({
+            "index": index,
+            "term": entry["term"],
+            "command": entry["command"],
+            "value": entry["value"],
+        }) for index, entry in enumerate(log[start:stop], start)]
+        return entries, (stop if stop < end else None)
+
+    """
+    RPC Method to subscribe to committed changes: the committed entries that change
+    the store from index start on, optionally only those changing the given keys
+    or keys with a prefix. Keys an entry evicted or imported count as changed, keys
+    of writes that failed or were rolled back don't. With wait set the call is a long poll that answers as
+    soon as a matching entry commits. Continue with the returned next index as the
+    resume token. Any node answers from its committed log, so watchers can be
+    spread over the followers
+    """
+    def watch(self, json_request: str) -> str | Awaitable[str]:
+        request: WatchRequest = self.message_parser.deserialize(json_request)
+        limit = min(max(1, request.get("limit") or RaftNode.LOG_PAGE_SIZE), RaftNode.MAX_LOG_PAGE_SIZE)
+        keys = set(request.get("keys") or [])
+        prefix = request.get("prefix")
+        deadline = self.clock() + min(max(0, request.get("wait", 0)), RaftNode.MAX_WATCH_WAIT)
+        # the catch-up scan runs right here, the long poll only scans what commits while it waits
+        commit_event = self.commit_event
+        entries, next_index, commit_length = self.__scan_changes(max(0, request.get("start", 0)), limit, keys, prefix)
+        if entries or next_index < commit_length or deadline <= self.clock():
+            return self.__watch_response(entries, next_index, commit_length)
+        return self.__wait_for_changes(commit_event, next_index, limit, keys, prefix, deadline)
+
+    async def __wait_for_changes(self, commit_event: asyncio.Event, next_index: int, limit: int, keys: Set[str],
+                                 prefix: str | None, deadline: float) -> str:
+        while True:
+            try:
+                await asyncio.wait_for(commit_event.wait(), deadline - self.clock())
+            except asyncio.TimeoutError:
+                pass
+            commit_event = self.commit_event
+            entries, next_index, commit_length = self.__scan_changes(next_index, limit, keys, prefix)
+            if entries or next_index < commit_length or deadline <= self.clock():
+                return self.__watch_response(entries, next_index, commit_length)
+
+    def __scan_changes(self, next_index: int, limit: int, keys: Set[str], prefix: str | None):
+        """ Up to limit matching changes from next_index on, the index to continue from and the commit length """
+        with self.stable_storage as stable_vars:
+            log = stable_vars["log"]
+            commit_length = stable_vars["commit_length"]
+            entries: List[ChangeEntry] = []
+            stop = min(commit_length, next_index + RaftNode.WATCH_SCAN_LIMIT)
+            while next_index < stop and len(entries) < limit:
+                command = log.command(next_index)
+                # only writes are decoded, most entries of a busy log are skipped on their command
+                if command != RaftNode.CONFIG_COMMAND and KVStore.written_keys(command) is not None:
+                    entry = log[next_index]
+                    changed = KVStore.changed_keys(entry)
+                    # writes that changed nothing (a failed cas, an aborted batch) aren't changes
+                    if changed and (not (keys or prefix) or any(
+                            key in keys or (prefix is not None and key.startswith(prefix)) for key in changed)):
+                        change = ChangeEntry({
+                            "index": next_index,
+                            "term": entry["term"],
+                            "command": command,
+                            "value": entry["value"],
+                            "keys": changed,
+                        })
+                        if "evicted" in entry:
+                            change["evicted"] = entry["evicted"]
+                        entries.append(change)
+                next_index += 1
+
+        return entries, next_index, commit_length
+
+    def __watch_response(self, entries: List[ChangeEntry], next_index: int, commit_length: int) -> str:
+        return self.message_parser.serialize(WatchResponse({
+            "status": ResponseStatus.SUCCESS.value,
+            "address": self.address,
+            "entries": entries,
+            "next": next_index,
+            "commit_length": commit_length,
+        }))
+
+    def __notify_commit(self):
+        self.commit_event.set()
+        self.commit_event = asyncio.Event()
+
+    def __last_log_info(self, log: LogStore):
+        return log.last_term(), len(log)
+
+    def __is_log_up_to_date(self, last_term: int, last_index: int, log: LogStore) -> bool:
+        own_last_term, own_last_index = self.__last_log_info(log)
+        return last_term > own_last_term or (last_term == own_last_term and last_index >= own_last_index)
+
+    def __has_quorum(self, addrs: Set[Address]) -> bool:
+        # during joint consensus both the old and the new voters need a majority
+        for voters in (self.cluster_addr_list, self.joint_addr_list):
+            if voters is not None and len(set(addrs) & set(voters)) < math.floor(len(voters) / 2) + 1:
+                return False
+        return True
+
+    def __in_leader_lease(self) -> bool:
+        if self.type == NodeType.LEADER:
+            return True
+        return self.cluster_leader_addr is not None and self.clock() - self.leader_contact_time < self.election_timeout_min
+
+    def __check_quorum(self) -> bool:
+        now = self.clock()
+        if now - self.leader_since < self.election_timeout_min:
+            return True
+        active = {self.address} | {addr for addr, ack_time in self.last_ack_time.items() if now - ack_time < self.election_timeout_min}
+        return self.__has_quorum(active)
 
     def __commit_log(self, stable_var: StableVars):
-        min_ack = math.floor(len(self.cluster_addr_list) / 2) + 1
+        with self.tracer.span("commit"):
+            self.__commit_log_entries(stable_var)
+
+    def __commit_log_entries(self, stable_var: StableVars):
         log = stable_var["log"]
-        
-        latest_ack = 0
-        for i in range(len(log)):
-            ack_count = 0
-            for addr in self.cluster_addr_list:
-                if self.ack_length.get(addr, 0) >= i:
-                    ack_count += 1
-            if ack_count >= min_ack:
-                latest_ack = i
-            
-        if latest_ack > stable_var["commit_length"] and log[latest_ack].get('term') == stable_var["election_term"]:
-            # for i in range(stable_var["commit_length"], latest_ack + 1):
-                # self.app.executing_log(log[i])
-                # print("Dari commit", log[i]["value"])
-                                              
-            stable_var["commit_length"] = latest_ack
-            self.stable_storage.storeAll(stable_var)
-            self.__print_log(f"Committed up to index {latest_ack}")
+
+        # highest log length replicated on a majority, only entries of the current term commit directly
+        for length in range(len(log), stable_var["commit_length"], -1):
+            if log.term(length - 1) != stable_var["election_term"]:
+                break
+            acked = {addr for addr in self.__voter_addrs()
+                     if (self.durable_length if addr == self.address else self.ack_length.get(addr, 0)) >= length}
+            if self.__has_quorum(acked):
+                # not stored on its own, the next write of the log carries it. Raft can lose
+                # the commit index in a crash, the leader's heartbeats restore it
+                stable_var["commit_length"] = length
+                for index in [index for index in self.append_times if index < length]:
+                    self.commit_latency.observe(self.clock() - self.append_times.pop(index))
+                self.__notify_commit()
+                self.__print_log(f"Committed up to index {length}")
+                self.__on_commit(stable_var)
+                break
 
     def __append_entries(self, entries, prev_last_index, leader_commit, stable_var):
         log = stable_var["log"]
 
+        config_changed = False
         if len(entries) > 0 and len(log) > prev_last_index:
             idx = min(len(log), prev_last_index + len(entries)) - 1
-            if log[idx]["term"] != entries[idx - prev_last_index]["term"]:
-                log = log[:prev_last_index]
+            if log.term(idx) != entries[idx - prev_last_index]["term"]:
+                config_changed = any(log.command(i) == RaftNode.CONFIG_COMMAND for i in range(prev_last_index, len(log)))
+                log.truncate(prev_last_index)
         
         if prev_last_index + len(entries) > len(log):
             for i in range(len(log) - prev_last_index, len(entries)):
                 log.append(entries[i])
+                config_changed = config_changed or entries[i]["command"] == RaftNode.CONFIG_COMMAND
         
         stable_var["log"] = log
+        self.durable_length = min(self.durable_length, len(log))
+        if config_changed:
+            self.__apply_config(log)
 
         commit_length = stable_var["commit_length"]
         if leader_commit > commit_length:
@@ -558,15 +1296,37 @@ class RaftNode:
                 # self.app.executing_log(log[i])
                 # print("Dari append entries", log[i]["value"])
             stable_var["commit_length"] = leader_commit
+            self.__notify_commit()
 
                 # Add an indented block here
                 # to fix the "Expected indented block" error
 
         self.stable_storage.storeAll(stable_var)
+        self.durable_length = len(log)
 
     # Client RPCs
-    def execute(self, json_request: str) -> str:
-        request: ExecuteRequest = self.message_parser.deserialize(json_request)
+    def execute(self, json_request: str) -> str | Awaitable[str]:
+        """ The response, or for an appended entry a coroutine answering once it is committed """
+        start = time.perf_counter()
+        with self.tracer.span("execute"):
+            with self.tracer.span("deserialize"):
+                request: ExecuteRequest = self.message_parser.deserialize(json_request)
+            response = self.__execute(request)
+        command = request["command"].split(" ", 1)[0].lower()
+        if command not in self.app.ALLOWED_COMMANDS and command != "request_log":
+            command = "other"
+        if not isinstance(response, str):
+            return self.__observe_execute(response, start, command)
+        self.execute_latency.observe(time.perf_counter() - start, command=command)
+        return response
+
+    async def __observe_execute(self, response: Awaitable[str], start: float, command: str) -> str:
+        try:
+            return await response
+        finally:
+            self.execute_latency.observe(time.perf_counter() - start, command=command)
+
+    def __execute(self, request: ExecuteRequest) -> str | Awaitable[str]:
         if (self.type != NodeType.LEADER) : # Redirect to leader if not leader
             response = ExecuteResponse({
                 "status": ResponseStatus.REDIRECTED.value,
@@ -574,36 +1334,78 @@ class RaftNode:
                 "data": ""
             })
             return self.message_parser.serialize(response)
+        if self.transfer_target is not None:
+            return self.message_parser.serialize(ExecuteResponse({
+                "status": ResponseStatus.ONPROCESS.value,
+                "address": self.address,
+                "reason": f"Leadership transfer to {self.transfer_target} in progress",
+                "data": ""
+            }))
         try:
             with self.stable_storage as stable_vars:
                 self.__print_log(f"Received command: {request['command']}")
-                if(request["command"] == "request_log"):
+                if request["command"].split(" ", 1)[0] == "request_log":
+                    # request_log [start] [limit] [term], one page of the log as JSON
+                    args = [int(arg) for arg in request["command"].split()[1:4]]
+                    start, limit, term = args + [None] * (3 - len(args))
+                    entries, next_index = self.__log_page(stable_vars["log"], start or 0, limit, term)
                     response = ExecuteResponse({
                         "status": ResponseStatus.SUCCESS.value,
                         "address": self.address,
-                        "data": str(stable_vars["log"])
+                        "data": json.dumps({"entries": entries, "next": next_index})
                     })
                     return self.message_parser.serialize(response)
+                if KVStore.is_read_only(request["command"]):
+                    # range pages are a pure read of the leader's store, which is the state at the
+                    # end of its log, so they answer once that is committed instead of being logged
+                    return self.__reply_when_committed(len(stable_vars["log"]), stable_vars["log"].last_term(), ExecuteResponse({
+                        "status": ResponseStatus.SUCCESS.value,
+                        "address": self.address,
+                        "data": self.app.read(request["command"])
+                    }))
                 log = Log({
                     "term": stable_vars["election_term"],
                     "command": request["command"],
                     "value": "",
                 })
-                self.app.executing_log(log)
-                request["value"] = log["value"]
-                stable_vars["log"].append(log)
-                self.log.append(log)
-                self.stable_storage.storeAll(stable_vars)
-                self.ack_length[self.address] = len(stable_vars["log"])
-                self.sent_length[self.address] = len(stable_vars["log"])
+                if request.get("client_id") is not None:
+                    if self.app.is_stale(request["client_id"], request["seq"]):
+                        # the client acknowledged this response already, there is nothing to answer with
+                        return self.message_parser.serialize(ExecuteResponse({
+                            "status": ResponseStatus.FAILED.value,
+                            "address": self.address,
+                            "reason": f"Stale request, seq {request['seq']} was already acknowledged",
+                            "data": ""
+                        }))
+                    cached = self.app.session_response(request["client_id"], request["seq"])
+                    if cached is not None:
+                        # retry of a request that was already applied, don't append it again but
+                        # answer only once its entry, somewhere in the log, is committed
+                        self.execute_duplicates.inc()
+                        return self.__reply_when_committed(len(stable_vars["log"]), stable_vars["log"].last_term(), ExecuteResponse({
+                            "status": ResponseStatus.SUCCESS.value,
+                            "address": self.address,
+                            "data": cached
+                        }))
+                    log.update({
+                        "client_id": request["client_id"],
+                        "seq": request["seq"],
+                        "acked": request.get("acked", 0),
+                    })
+                rejection = self.__admit(stable_vars, request.get("client_id"))
+                if rejection is not None:
+                    return self.message_parser.serialize(ExecuteResponse({**rejection, "data": ""}))
+                with self.tracer.span("apply"):
+                    self.app.executing_log(log)
+                self.__propose(log, stable_vars)
+                length = len(stable_vars["log"])
 
-            response = ExecuteResponse({
+            return self.__reply_when_committed(length, log["term"], ExecuteResponse({
                 "status": ResponseStatus.SUCCESS.value,
                 "address": self.address,
-                "data": request["value"]
-            })
-            return self.message_parser.serialize(response)
-        
+                "data": log["value"]
+            }))
+
         except Exception as e:
             self.__print_log(str(e))
             return self.message_parser.serialize(ExecuteResponse({
@@ -612,5 +1414,290 @@ class RaftNode:
                 "reason": str(e), 
             }))
 
+    async def __reply_when_committed(self, length: int, term: int, response: BaseResponse) -> str:
+        """
+        Sends the response once the log up to length is committed, so a client only
+        hears of a write that survives a leader crash. Concurrent requests wait on the
+        same commit, one disk write and replication round answers all of them
+        """
+        if not await self.__wait_committed(length, term):
+            response = ExecuteResponse({
+                "status": ResponseStatus.ONPROCESS.value,
+                "address": self.address,
+                "reason": "The entry was not committed in time, retry to get its result",
+                "data": "",
+            })
+        return self.message_parser.serialize(response)
+
+    async def __wait_committed(self, length: int, term: int) -> bool:
+        """
+        Waits until the log up to length, with its last entry from term, is committed.
+        False if it was overwritten, or didn't commit while we led or within an election timeout
+        """
+        deadline = self.clock() + self.election_timeout_max
+        while True:
+            commit_event = self.commit_event
+            with self.stable_storage as stable_vars:
+                log = stable_vars["log"]
+                if len(log) < length or (length > 0 and log.term(length - 1) != term):
+                    return False
+                if stable_vars["commit_length"] >= length:
+                    return True
+            if self.type != NodeType.LEADER or self.clock() >= deadline:
+                return False
+            try:
+                await asyncio.wait_for(commit_event.wait(), deadline - self.clock())
+            except asyncio.TimeoutError:
+                pass
+
+    def __propose(self, log: Log, stable_vars: StableVars):
+        """ Appends an entry the leader already applied and starts persisting and replicating it """
+        with self.tracer.span("log.append"):
+            stable_vars["log"].append(log)
+        length = len(stable_vars["log"])
+        self.append_times[length - 1] = self.clock()
+        # the write runs on the storage thread while the entry goes out to the followers
+        self.stable_storage.store_async(stable_vars).add_done_callback(
+            lambda write: self.__on_durable(write, length, log["term"]))
+        self.replicate_event.set()
+
+    def __admit(self, stable_vars: StableVars, client_id: str | None = None) -> BaseResponse | None:
+        """
+        Admission control for a new entry, None if it may be appended or else a busy
+        response with a retry hint. The uncommitted tail grows when followers or our
+        own disk fall behind, so bounding it bounds the latency of admitted writes
+        """
+        log, commit_length = stable_vars["log"], stable_vars["commit_length"]
+        reason, retry_after = None, 0.0
+        if 0 < self.config.max_uncommitted_entries <= len(log) - commit_length:
+            reason = f"{len(log) - commit_length} entries are waiting to commit"
+        elif 0 < self.config.max_uncommitted_bytes <= log.payload_bytes(commit_length):
+            reason = f"{log.payload_bytes(commit_length)} bytes are waiting to commit"
+        if reason is not None:
+            # roughly one replication round for the backlog to shrink
+            retry_after = self.rpc_timeout
+        elif client_id is not None and self.config.client_rate_limit > 0:
+            bucket = self.client_buckets.pop(client_id, None) or \
+                TokenBucket(self.config.client_rate_limit, self.config.client_burst, self.clock())
+            self.client_buckets[client_id] = bucket
+            while len(self.client_buckets) > RaftNode.MAX_RATE_LIMITED_CLIENTS:
+                self.client_buckets.popitem(last=False)
+            retry_after = bucket.take(self.clock())
+            if retry_after > 0:
+                reason = f"Client {client_id} is over its rate limit"
+        if reason is None:
+            return None
+
+        self.execute_rejected.inc(reason="rate_limit" if reason.startswith("Client") else "capacity")
+        return BaseResponse({
+            "status": ResponseStatus.ONPROCESS.value,
+            "address": self.address,
+            "reason": reason,
+            "retry_after": retry_after,
+        })
+
+    def __leader_only(self) -> str | None:
+        """ The response for a client RPC this node can't serve as leader right now, None if it can """
+        if self.type != NodeType.LEADER:
+            return self.message_parser.serialize(BaseResponse({
+                "status": ResponseStatus.REDIRECTED.value,
+                "address": self.cluster_leader_addr,
+            }))
+        if self.transfer_target is not None:
+            return self.message_parser.serialize(BaseResponse({
+                "status": ResponseStatus.ONPROCESS.value,
+                "address": self.address,
+                "reason": f"Leadership transfer to {self.transfer_target} in progress",
+            }))
+        return None
+
+    """
+    RPC Method to bulk load [key, value] pairs. The leader installs them into the
+    store all or nothing and appends a single import entry holding the pairs,
+    instead of one set entry per key. Like every write, the keys reach the
+    followers with the store snapshot that comes with AppendEntries, and the call
+    answers once the entry is committed
+    """
+    def import_data(self, json_request: str) -> str | Awaitable[str]:
+        request: ImportRequest = self.message_parser.deserialize(json_request)
+        redirect = self.__leader_only()
+        if redirect is not None:
+            return redirect
+        with self.stable_storage as stable_vars:
+            client_id = request.get("client_id")
+            if client_id is not None:
+                if self.app.is_stale(client_id, request["seq"]):
+                    return self.message_parser.serialize(ImportResponse({
+                        "status": ResponseStatus.FAILED.value,
+                        "address": self.address,
+                        "reason": f"Stale request, seq {request['seq']} was already acknowledged",
+                    }))
+                cached = self.app.session_response(client_id, request["seq"])
+                if cached is not None:
+                    # installing the pairs again would overwrite writes made since the first try
+                    self.execute_duplicates.inc()
+                    index = len(stable_vars["log"])
+                    return self.__reply_when_committed(index, stable_vars["log"].last_term(), ImportResponse({
+                        "status": ResponseStatus.SUCCESS.value,
+                        "address": self.address,
+                        "reason": "",
+                        "data": cached,
+                        "index": index,
+                    }))
+            rejection = self.__admit(stable_vars)
+            if rejection is not None:
+                return self.message_parser.serialize(rejection)
+            try:
+                items = KVStore.import_items(request["items"])
+                with self.tracer.span("apply"):
+                    result = self.app.install(items, client_id, request.get("seq", 0), request.get("acked", 0))
+            except ValueError as e:
+                return self.message_parser.serialize(ImportResponse({
+                    "status": ResponseStatus.FAILED.value,
+                    "address": self.address,
+                    "reason": str(e),
+                }))
+            if result != "OOM":
+                # the entry carries the pairs, so the log alone can rebuild the store
+                log = Log({
+                    "term": stable_vars["election_term"],
+                    "command": f"{KVStore.IMPORT_COMMAND} {len(items)}",
+                    "value": json.dumps(items, separators=(",", ":")),
+                })
+                if self.app.evicted:
+                    log["evicted"] = self.app.evicted
+                if client_id is not None:
+                    log.update({"client_id": client_id, "seq": request["seq"], "acked": request.get("acked", 0)})
+                self.bulk_keys.inc(len(items), direction="import")
+                self.__propose(log, stable_vars)
+            index, term = len(stable_vars["log"]), stable_vars["log"].last_term()
+        if result == "OOM":
+            return self.message_parser.serialize(ImportResponse({
+                "status": ResponseStatus.FAILED.value,
+                "address": self.address,
+                "reason": "Imported keys don't fit in maxmemory",
+                "data": result,
+                "index": index,
+            }))
+        return self.__reply_when_committed(index, term, ImportResponse({
+            "status": ResponseStatus.SUCCESS.value,
+            "address": self.address,
+            "reason": "",
+            "data": result,
+            "index": index,
+        }))
+
+    """
+    RPC Method to page through a consistent copy of the store. A request without
+    export_id copies the store on the leader and answers once every entry applied
+    to that copy is committed, so the export is the state at a committed index.
+    Pages of that copy follow with export_id and the returned cursor
+    """
+    def export_data(self, json_request: str) -> str | Awaitable[str]:
+        request: ExportRequest = self.message_parser.deserialize(json_request)
+        redirect = self.__leader_only()
+        if redirect is not None:
+            return redirect
+        export_id = request.get("export_id")
+        if export_id is None:
+            # the store is copied right here, only the wait for its commit is left to the coroutine
+            export_id, export, term = self.__start_export()
+            return self.__first_export_page(request, export_id, export, term)
+        export = self.exports.get(export_id)
+        if export is None:
+            return self.message_parser.serialize(ExportResponse({
+                "status": ResponseStatus.FAILED.value,
+                "address": self.address,
+                "reason": f"Unknown or expired export {export_id}",
+            }))
+        return self.__export_page(request, export_id, export)
+
+    async def __first_export_page(self, request: ExportRequest, export_id: str, export: Dict, term: int) -> str:
+        if not await self.__wait_committed(export["index"], term):
+            return self.message_parser.serialize(ExportResponse({
+                "status": ResponseStatus.ONPROCESS.value,
+                "address": self.address,
+                "reason": "The exported state did not commit in time, retry",
+            }))
+        self.exports[export_id] = export
+        return self.__export_page(request, export_id, export)
+
+    def __export_page(self, request: ExportRequest, export_id: str, export: Dict) -> str:
+        cursor = max(0, request.get("cursor", 0))
+        limit = min(max(1, request.get("limit") or RaftNode.EXPORT_PAGE_SIZE), RaftNode.MAX_EXPORT_PAGE_SIZE)
+        items = export["items"][cursor:cursor + limit]
+        next_cursor = cursor + len(items) if cursor + len(items) < len(export["items"]) else None
+        export["time"] = self.clock()
+        if next_cursor is None:
+            self.exports.pop(export_id, None)
+        self.bulk_keys.inc(len(items), direction="export")
+        return self.message_parser.serialize(ExportResponse({
+            "status": ResponseStatus.SUCCESS.value,
+            "address": self.address,
+            "export_id": export_id,
+            "index": export["index"],
+            "items": items,
+            "next": next_cursor,
+        }))
+
+    def __start_export(self):
+        now = self.clock()
+        for export_id in [export_id for export_id, export in self.exports.items() if now - export["time"] > RaftNode.EXPORT_TTL]:
+            del self.exports[export_id]
+        while len(self.exports) >= RaftNode.MAX_EXPORTS:
+            self.exports.popitem(last=False)
+
+        # the leader applies entries when it appends them, so its store is the state at the end of its log
+        with self.stable_storage as stable_vars:
+            index, term = len(stable_vars["log"]), stable_vars["log"].last_term()
+            export = {"index": index, "items": self.app.export(), "time": now}
+        export_id = f"{self.address.port}-{index}-{self.rng.getrandbits(32):08x}"
+        return export_id, export, term
+
+    def __on_durable(self, write: asyncio.Future, length: int, term: int):
+        if write.exception() is not None:
+            self.__print_log(f"Failed to persist the log up to index {length}: {write.exception()}")
+            return
+        with self.stable_storage as stable_vars:
+            log = stable_vars["log"]
+            # the entry may have been overwritten by a new leader in the meantime
+            if len(log) < length or log.term(length - 1) != term:
+                return
+            self.durable_length = max(self.durable_length, length)
+            if self.type == NodeType.LEADER:
+                self.__commit_log(stable_vars)
+
+    def __tune_timing(self):
+        if not self.config.adaptive:
+            return
+        # a majority of voters is enough to make progress, so the deadlines follow the
+        # RTT of the slowest peer still needed for a quorum rather than the slowest peer
+        peers = [addr for addr in self.__voter_addrs() if addr != self.address and len(self.rtt.get(addr, ())) > 0]
+        needed = math.floor(len(self.__voter_addrs()) / 2)
+        if needed == 0 or len(peers) < needed:
+            return
+        percentiles = sorted(self.rtt[addr].percentile(self.config.rtt_percentile) for addr in peers)
+        rtt = percentiles[needed - 1]
+
+        self.rpc_timeout = self.__clamp(self.config.rpc_rtt_factor * rtt, self.config.min_rpc_timeout, self.config.max_rpc_timeout)
+        self.__set_heartbeat_interval(self.config.heartbeat_rtt_factor * rtt)
+
+    def __set_heartbeat_interval(self, interval: float):
+        interval = self.__clamp(interval, self.config.min_heartbeat_interval, self.config.max_heartbeat_interval)
+        if abs(interval - self.heartbeat_interval) > 0.1 * self.heartbeat_interval:
+            self.__print_log(f"Heartbeat interval tuned to {interval:.3f}s")
+        self.heartbeat_interval = interval
+        election_timeout = self.config.election_heartbeat_factor * interval
+        self.election_timeout_min = self.__clamp(election_timeout, self.config.min_election_timeout, self.config.max_election_timeout)
+        self.election_timeout_max = self.__clamp(2 * election_timeout, self.election_timeout_min, self.config.max_election_timeout)
+
+    def __clamp(self, value: float, low: float, high: float) -> float:
+        return min(max(value, low), high)
+
     def randomize_timeout(self):
-        self.timeout_time = time.time() + RaftNode.ELECTION_TIMEOUT_MIN + (RaftNode.ELECTION_TIMEOUT_MAX - RaftNode.ELECTION_TIMEOUT_MIN) * random.random()
\ No newline at end of file
+        low, high = self.election_timeout_min, self.election_timeout_max
+        if self.initial_members and self.cluster_leader_addr is None:
+            # a bootstrapping cluster has no leader yet to wait for, elect one soon
+            low = self.config.min_election_timeout
+            high = min(2 * low, self.config.max_election_timeout)
+        self.timeout_time = self.clock() + low + (high - low) * self.rng.random()
\ No newline at end of file
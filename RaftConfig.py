@@ -0,0 +1,99 @@
+from typing import Any, Dict
+from utils import Compression
+import json
+import os
+
+class RaftConfig:
+    """
+    Configuration of a Raft node. The plain timing values are used as they are while
+    adaptive timing is off, and until the first round trip times have been observed.
+    With adaptive timing the node derives them from the observed RTT percentile
+    instead, clamped to the min/max bounds:
+
+        rpc_timeout        = rpc_rtt_factor * rtt
+        heartbeat_interval = heartbeat_rtt_factor * rtt
+        election_timeout   = [1, 2] * election_heartbeat_factor * heartbeat_interval
+
+    Every value can be overridden per deployment from a JSON file and/or from
+    RAFT_<NAME> environment variables, see load()
+    """
+    DEFAULTS: Dict[str, Any] = {
+        "heartbeat_interval": 1.0,
+        "election_timeout_min": 35.0,
+        "election_timeout_max": 60.0,
+        "rpc_timeout": 0.5,
+        "adaptive": True,
+        "min_heartbeat_interval": 0.1,
+        "max_heartbeat_interval": 1.0,
+        "min_election_timeout": 1.0,
+        "max_election_timeout": 60.0,
+        "min_rpc_timeout": 0.1,
+        "max_rpc_timeout": 0.5,
+        # RTT samples kept per peer and the percentile the timing is derived from
+        "rtt_window": 100,
+        "rtt_percentile": 99.0,
+        "rpc_rtt_factor": 4.0,
+        "heartbeat_rtt_factor": 10.0,
+        "election_heartbeat_factor": 10.0,
+        # hot path tracing spans kept in a ring buffer, can also be toggled with the trace RPC
+        "tracing": False,
+        "trace_capacity": 10000,
+        # codec for replication payloads and the stable storage file ("none" to disable),
+        # only payloads of at least compression_threshold bytes are compressed
+        "compression": "zlib",
+        "compression_threshold": 1024,
+        # admission control on the leader: new writes are turned away with a retry hint while
+        # this many entries or payload bytes are uncommitted (0 disables a limit), and each
+        # client session may send client_rate_limit requests per second with bursts of client_burst
+        "max_uncommitted_entries": 1000,
+        "max_uncommitted_bytes": 16_000_000,
+        "client_rate_limit": 0.0,
+        "client_burst": 100,
+        # client RPCs handled at once by the RPC server, 0 for no limit, internode RPCs never wait for them
+        "client_workers": 4,
+        # "ip:port,ip:port" of a cluster that is started all at once, each listed node starts
+        # with this configuration and a leader is elected right away, no node joins
+        "initial_members": "",
+    }
+
+    def __init__(self, **overrides):
+        for name, value in RaftConfig.DEFAULTS.items():
+            setattr(self, name, value)
+        for name, value in overrides.items():
+            if name not in RaftConfig.DEFAULTS:
+                raise ValueError(f"Unknown config option {name}")
+            default = RaftConfig.DEFAULTS[name]
+            setattr(self, name, value if isinstance(default, bool) else type(default)(value))
+
+        if self.election_timeout_min > self.election_timeout_max or self.min_election_timeout > self.max_election_timeout \
+                or self.min_heartbeat_interval > self.max_heartbeat_interval or self.min_rpc_timeout > self.max_rpc_timeout:
+            raise ValueError("Config min values must not exceed the max values")
+        # raises ValueError for unknown codecs
+        Compression.get_codec(self.compression)
+
+    def __str__(self):
+        return json.dumps(self.data())
+
+    def data(self) -> Dict[str, Any]:
+        return {name: getattr(self, name) for name in RaftConfig.DEFAULTS}
+
+    @staticmethod
+    def load(path: str | None = None) -> "RaftConfig":
+        """ Defaults, overridden by the JSON file at path (or $RAFT_CONFIG), then by $RAFT_<NAME> """
+        overrides: Dict[str, Any] = {}
+        path = path or os.environ.get("RAFT_CONFIG")
+        if path:
+            with open(path, 'r') as f:
+                overrides.update(json.load(f))
+
+        for name, default in RaftConfig.DEFAULTS.items():
+            value = os.environ.get(f"RAFT_{name.upper()}")
+            if value is None:
+                continue
+            if isinstance(default, bool):
+                overrides[name] = value.lower() in ("1", "true", "yes", "on")
+            elif isinstance(default, str):
+                overrides[name] = value
+            else:
+                overrides[name] = type(default)(float(value))
+        return RaftConfig(**overrides)
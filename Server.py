@@ -1,43 +1,50 @@
 from Address       import Address
 from Raft          import RaftNode
-from xmlrpc.server import SimpleXMLRPCServer
-from xmlrpc.server import SimpleXMLRPCRequestHandler
+from utils.AsyncRPCServer import AsyncRPCServer
 from app           import KVStore
+from RaftConfig    import RaftConfig
 import sys
-import threading
+import asyncio
 
 
-def start_serving(addr: Address, contact_node_addr: Address):
-    print(f"Starting Raft Server at {addr.ip}:{addr.port}")
-    _raftNode = RaftNode(KVStore(), addr, contact_node_addr)
-    
-    class PrintRequestHandler(SimpleXMLRPCRequestHandler):
-        def do_POST(self):
-            print(f"Received POST request from {self.client_address}")
-            # print received data
-            return SimpleXMLRPCRequestHandler.do_POST(self)
+async def serve(addr: Address, contact_node_addr: Address, members: str = None):
+    config = RaftConfig.load()
+    if members is not None:
+        config.initial_members = members
+    _raftNode = RaftNode(KVStore(), addr, contact_node_addr, config)
+    server = AsyncRPCServer(addr, _raftNode, {
+        "/metrics": _raftNode.metrics.render,
+        "/trace": _raftNode.tracer.folded,
+    }, RaftNode.CLIENT_RPCS, config.client_workers)
+
+    # the RPC server and the node's role loop share one event loop
+    _ip, _port = await server.start()
+    print(f"\nServer started at {_ip}:{_port}\n")
+    try:
+        await _raftNode.run()
+    finally:
+        await server.close()
 
+
+def start_serving(addr: Address, contact_node_addr: Address, members: str = None):
+    print(f"Starting Raft Server at {addr.ip}:{addr.port}")
     try:
-        with SimpleXMLRPCServer((addr.ip, addr.port), requestHandler=PrintRequestHandler) as server:
-            #print server address
-            _ip = server.server_address[0]
-            _port = server.server_address[1]
-            print(f"\nServer started at {_ip}:{_port}\n")
-            server.register_introspection_functions()
-            server.register_instance(_raftNode)
-            server.serve_forever()
+        asyncio.run(serve(addr, contact_node_addr, members))
     except KeyboardInterrupt:
-        _raftNode.election_term = 0xDEAD
+        pass
    
 
 if __name__ == "__main__":
     if len(sys.argv) < 3:
         print("Usage: Server.py ip port [contact_ip] [contact_port]")
+        print("       Server.py ip port --members ip:port,ip:port,...")
         exit()
 
-    contact_addr = None
-    if len(sys.argv) == 5:
+    contact_addr, members = None, None
+    if len(sys.argv) == 5 and sys.argv[3] == "--members":
+        members = sys.argv[4]
+    elif len(sys.argv) == 5:
         contact_addr = Address(sys.argv[3], int(sys.argv[4]))
     server_addr = Address(sys.argv[1], int(sys.argv[2]))
 
-    start_serving(server_addr, contact_addr)
+    start_serving(server_addr, contact_addr, members)
@@ -1,19 +1,61 @@
-from typing import TypedDict, TypeVar, Generic, Any
+from typing import TypedDict, TypeVar, Generic, Any, Callable
 from Address import Address
+from utils.Metrics import MetricsRegistry
+from utils.Tracer import Tracer
+from utils import Compression
 import threading
+import time
 import json
 import asyncio
 T = TypeVar('T', bound=TypedDict)
 
 class StableStorage(Generic[T]):
-    def __init__(self, addr: Address):
+    """
+    Files are written by a dedicated writer thread. A store freezes the state on
+    the caller's thread and queues it, live objects with a snapshot() method are
+    replaced by what it returns so the caller can keep changing them, and the
+    writer serializes, compresses and writes it. storeAll() then blocks until it
+    is on disk while store_async() returns a future instead, so the event loop can
+    send the same entries to the followers during the write. Only the newest
+    queued state is written, a later store supersedes the ones still waiting
+    """
+    def __init__(self, addr: Address, metrics: MetricsRegistry = None, in_memory: bool = False, tracer: Tracer = None):
         self.id = self.__id_from_addr(addr)
         self.path = f"storage/{self.id}.json"
         self.lock = threading.Lock()
+        # in memory storage keeps the serialized state instead of writing the file, for simulations
+        self.in_memory = in_memory
+        self.memory_data: bytes = None
+        self.tracer = tracer or Tracer()
+        # state of at least compression_threshold bytes is stored compressed, as a
+        # "#<codec>" line followed by the compressed JSON, loading accepts both forms
+        self.codec: Compression.Codec | None = None
+        self.compression_threshold: int = 0
+        # The state is read from the file once and then served from memory, every
+        # store writes it through. decoder turns the loaded JSON into the live state,
+        # live objects with a to_data() method are saved as what it returns
+        self.decoder: Callable[[Any], T] | None = None
+        self.cache: T | None = None
+        # writer thread state, guarded by write_cond. Stores are numbered, a store is
+        # durable once written_seq reaches its number
+        self.write_cond = threading.Condition()
+        self.writer: threading.Thread | None = None
+        self.submitted_seq = 0
+        self.written_seq = 0
+        self.pending: tuple | None = None
+        self.write_error: Exception | None = None
+        self.waiters: list = []
+        self.write_latency = None
+        self.write_bytes = None
+        if metrics is not None:
+            self.write_latency = metrics.histogram("raft_storage_write_latency_seconds", "Time to write the stable storage file")
+            self.write_bytes = metrics.counter("raft_storage_write_bytes_total", "Bytes written to the stable storage file")
 
     def __enter__(self):
-        self.lock.acquire()
-        return self.load()
+        with self.tracer.span("storage.lock"):
+            self.lock.acquire()
+        with self.tracer.span("storage.load"):
+            return self.load()
     
     def __exit__(self, exc_type, exc_value, traceback):
         self.lock.release()
@@ -21,21 +63,139 @@ class StableStorage(Generic[T]):
     def __id_from_addr(self, addr: Address):
         return f"{addr.ip}_{addr.port}"
 
-    def __store(self, data: str):
-        with open(self.path, 'w') as f:
-            f.write(data)
+    def __store(self, data: bytes):
+        start = time.perf_counter()
+        if self.in_memory:
+            self.memory_data = data
+        else:
+            with open(self.path, 'wb') as f:
+                f.write(data)
+        if self.write_latency is not None:
+            self.write_latency.observe(time.perf_counter() - start)
+            self.write_bytes.inc(len(data))
     
-    def __load(self):
-        with open(self.path, 'r') as f:
+    def __load(self) -> bytes:
+        if self.in_memory:
+            if self.memory_data is None:
+                raise FileNotFoundError(self.path)
+            return self.memory_data
+        with open(self.path, 'rb') as f:
             return f.read()
+
+    def __encode(self, str_data: str) -> bytes:
+        data = str_data.encode()
+        compressed = Compression.compress(data, self.codec, self.compression_threshold)
+        if compressed is None:
+            return data
+        return b"#" + self.codec.name.encode() + b"\n" + compressed
+
+    def __decode(self, data: bytes) -> str:
+        if not data.startswith(b"#"):
+            return data.decode()
+        header, _, compressed = data.partition(b"\n")
+        return Compression.get_codec(header[1:].decode()).decompress(compressed).decode()
     
     def load(self) -> T:
-        return json.loads(self.__load())
+        if self.cache is None:
+            data = json.loads(self.__decode(self.__load()))
+            self.cache = self.decoder(data) if self.decoder is not None else data
+        return self.cache
+
+    def drop_cache(self):
+        """ Forget the in memory state, the next load reads it back like after a restart """
+        self.cache = None
 
     def storeAll(self, data: T) -> T:
-        str_data = json.dumps(data)
-        self.__store(str_data)
+        """ Stores the state and returns once it is durable """
+        with self.tracer.span("storage.write"):
+            seq = self.__submit(data)
+            with self.write_cond:
+                while self.written_seq < seq:
+                    self.write_cond.wait()
+                if self.write_error is not None:
+                    raise self.write_error
         return data
+
+    def store_async(self, data: T) -> asyncio.Future:
+        """ Stores the state in the background, the future resolves once it is durable """
+        future = asyncio.get_running_loop().create_future()
+        with self.tracer.span("storage.snapshot"):
+            seq = self.__submit(data)
+        with self.write_cond:
+            if self.written_seq >= seq:
+                self.__resolve(future, self.write_error)
+            else:
+                self.waiters.append((seq, future))
+        return future
+
+    def flush(self):
+        """ Waits until everything stored so far is durable """
+        with self.write_cond:
+            while self.written_seq < self.submitted_seq:
+                self.write_cond.wait()
+
+    @staticmethod
+    def __freeze(data: T) -> T:
+        return {key: value.snapshot() if hasattr(value, "snapshot") else value for key, value in data.items()}
+
+    @staticmethod
+    def __serialize(frozen: T) -> str:
+        return json.dumps(frozen, default=lambda value: value.to_data())
+
+    def __submit(self, data: T) -> int:
+        self.cache = data
+        frozen = None if self.in_memory else self.__freeze(data)
+        with self.write_cond:
+            self.submitted_seq += 1
+            seq = self.submitted_seq
+            if self.in_memory:
+                # no thread for simulations, their clock is virtual and must stay deterministic
+                self.__store(self.__encode(self.__serialize(data)))
+                self.written_seq = seq
+                return seq
+            self.pending = (seq, frozen)
+            if self.writer is None:
+                self.writer = threading.Thread(target=self.__run_writer, name=f"storage-writer-{self.id}", daemon=True)
+                self.writer.start()
+            self.write_cond.notify_all()
+        return seq
+
+    def __run_writer(self):
+        while True:
+            with self.write_cond:
+                while self.pending is None:
+                    self.write_cond.wait()
+                seq, frozen = self.pending
+                self.pending = None
+
+            error = None
+            try:
+                # zlib and file writes release the GIL, the event loop keeps running meanwhile
+                self.__store(self.__encode(self.__serialize(frozen)))
+            except Exception as e:
+                error = e
+
+            with self.write_cond:
+                self.written_seq = seq
+                self.write_error = error
+                done = [future for waiter_seq, future in self.waiters if waiter_seq <= seq]
+                self.waiters = [(waiter_seq, future) for waiter_seq, future in self.waiters if waiter_seq > seq]
+                self.write_cond.notify_all()
+            for future in done:
+                try:
+                    future.get_loop().call_soon_threadsafe(self.__resolve, future, error)
+                except RuntimeError:
+                    # the loop closed while the write was running, nobody is waiting anymore
+                    pass
+
+    @staticmethod
+    def __resolve(future: asyncio.Future, error: Exception | None):
+        if future.done():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(None)
     
     def try_load(self):
         try:
@@ -1,19 +1,32 @@
 import time
+import json
+import asyncio
 import subprocess
 import sys
 import unittest
 import os
 import signal
 import warnings
+import threading
 
 import requests
 from Address import Address
 from Raft import RaftNode
 from Server import start_serving
+from RaftConfig import RaftConfig
 from app import KVStore
 from structs.ColorLog import ColorLog
 from structs.NodeType import NodeType
+from structs.LatencyWindow import LatencyWindow
+from structs.TokenBucket import TokenBucket
 from utils.RPCHandler import RPCHandler
+from utils.AsyncRPCServer import AsyncRPCServer
+from utils.Metrics import MetricsRegistry
+from utils.SimNetwork import SimCluster, simulate
+from utils.Tracer import Tracer
+from utils import Compression
+from StableStorage import StableStorage
+from structs.LogStore import LogStore
 
 # Suppress ResourceWarning
 warnings.simplefilter("ignore", ResourceWarning)
@@ -85,6 +98,829 @@ class TestKVStore(unittest.TestCase):
         self.assertEqual(log_transaction['value'], "value123")
         print("✅ Unit test transaction passed")
 
+    def test_conditional_commands(self):
+        kv_store = KVStore()
+        def run(command):
+            log = {'term': 1, 'command': command, 'value': ''}
+            kv_store.executing_log(log)
+            return log['value']
+
+        self.assertEqual(run('incr counter'), 1)
+        self.assertEqual(run('incr counter 10'), 11)
+        self.assertEqual(run('decr counter 20'), -9)
+        self.assertEqual(run('set name raft'), "OK")
+        self.assertEqual(run('incr name'), "Not an integer")
+        self.assertEqual(run('incr counter x'), "Invalid command")
+        self.assertEqual(run('incr counter ²'), "Invalid command")
+        self.assertFalse(KVStore.is_valid_command('incr counter ²'))
+        self.assertFalse(KVStore.is_valid_command('maxmemory ²'))
+
+        self.assertEqual(run('cas lock free held by a'), "MISMATCH")
+        run('set lock free')
+        self.assertEqual(run('cas lock free held by a'), "OK")
+        self.assertEqual(run('cas lock free held by b'), "MISMATCH")
+        self.assertEqual(run('get lock'), "held by a")
+        self.assertFalse(KVStore.is_valid_command('cas lock free'))
+        self.assertFalse(KVStore.is_valid_command('guard lock equals free'))
+        self.assertTrue(KVStore.is_valid_command('guard lock missing; incr counter -1'))
+        print("✅ Unit test conditional commands passed")
+
+    def test_guarded_transaction(self):
+        kv_store = KVStore()
+        def run(command):
+            log = {'term': 1, 'command': command, 'value': ''}
+            kv_store.executing_log(log)
+            return log['value']
+
+        run('set from 100; set to 0')
+        transfer = 'guard from ne 0; decr from 60; incr to 60; get to'
+        self.assertEqual(run(transfer), "60")
+        # the second transfer overdraws, nothing of it is applied
+        self.assertEqual(run('guard from exists; decr from 60; cas to 0 1; incr to 60'), "MISMATCH")
+        self.assertEqual(kv_store.data(), {"from": "40", "to": "60"})
+        self.assertEqual(run('guard new missing; set new 1; del from; guard to eq 0'), "ABORTED")
+        self.assertEqual(kv_store.data(), {"from": "40", "to": "60"})
+        self.assertEqual(kv_store.memory_used, sum(kv_store.memory_usage().values()))
+        # an aborted batch changed nothing, whatever its commands name
+        log = {'term': 1, 'command': 'guard from eq 0; set from 1', 'value': ''}
+        kv_store.executing_log(log)
+        self.assertEqual(KVStore.changed_keys(log), [])
+        log = {'term': 1, 'command': 'set to 60; del gone', 'value': ''}
+        kv_store.executing_log(log)
+        self.assertEqual(KVStore.changed_keys(log), ["to"])
+        log = {'term': 1, 'command': 'set to 60', 'value': ''}
+        kv_store.executing_log(log)
+        self.assertNotIn('changed', log)
+        self.assertEqual(run('set from 0; incr to ²'), "Invalid command")
+        self.assertEqual(kv_store.data(), {"from": "40", "to": "60"})
+        # values that read like failures don't fail a batch
+        run('set status OOM')
+        self.assertEqual(run('set y 1; del status'), "OOM")
+        self.assertEqual(run('get y'), "1")
+        run('del y')
+
+        # keys evicted by a failed batch come back too
+        kv_store.executing_log({'term': 1, 'command': f'maxmemory {kv_store.memory_used}', 'value': ''})
+        self.assertEqual(run('set big ' + 'x' * 50 + '; guard big missing'), "ABORTED")
+        self.assertEqual(kv_store.data(), {"from": "40", "to": "60"})
+        print("✅ Unit test guarded transaction passed")
+
+    def test_install(self):
+        kv_store = KVStore()
+        self.assertEqual(kv_store.install([["b", "2"], ["a", "1"]]), 2)
+        self.assertEqual(kv_store.export(), [["a", "1"], ["b", "2"]])
+        kv_store.executing_log({'term': 1, 'command': f'maxmemory {kv_store.memory_used + 100}', 'value': ''})
+        self.assertEqual(kv_store.install([["a", "x"], ["c", "y" * 200]]), "OOM")
+        self.assertEqual(kv_store.export(), [["a", "1"], ["b", "2"]])
+        for malformed in ([["a", "x"], ["c", 1, 2]], [["a", "x"], ["two words", "1"]], [["a", "x"], [3, "1"]]):
+            with self.assertRaises(ValueError):
+                KVStore.import_items(malformed)
+        self.assertEqual(kv_store.install(KVStore.import_items([["c", 3], ["d", {"n": 1}]]), "importer", 1), 2)
+        self.assertEqual(kv_store.data()["c"], "3")
+        self.assertEqual(kv_store.data()["d"], '{"n": 1}')
+        self.assertEqual(kv_store.session_response("importer", 1), 2)
+        print("✅ Unit test bulk install passed")
+
+    def test_memory(self):
+        kv_store = KVStore()
+        kv_store.executing_log({'term': 1, 'command': 'set kunci value', 'value': ''})
+        log_memory = {'term': 2, 'command': 'memory kunci', 'value': ''}
+        kv_store.executing_log(log_memory)
+        self.assertEqual(log_memory['value'], len("kunci") + len("value") + KVStore.ENTRY_OVERHEAD)
+
+        log_total = {'term': 3, 'command': 'memory', 'value': ''}
+        kv_store.executing_log(log_total)
+        self.assertEqual(log_total['value'], log_memory['value'])
+        print("✅ Unit test memory passed")
+
+    def test_lru_eviction(self):
+        kv_store = KVStore()
+        entry_size = len("k0") + len("v") + KVStore.ENTRY_OVERHEAD
+        log_maxmemory = {'term': 1, 'command': f'maxmemory {3 * entry_size} lru', 'value': ''}
+        kv_store.executing_log(log_maxmemory)
+        self.assertEqual(log_maxmemory['value'], "OK")
+
+        kv_store.executing_log({'term': 1, 'command': 'set k0 v; set k1 v; set k2 v; get k0; set k3 v', 'value': ''})
+        self.assertEqual(list(kv_store.data().keys()), ["k2", "k0", "k3"])
+        print("✅ Unit test lru eviction passed")
+
+    def test_oom_keeps_old_value(self):
+        kv_store = KVStore()
+        def run(command):
+            log = {'term': 1, 'command': command, 'value': ''}
+            kv_store.executing_log(log)
+            return log['value']
+
+        run('maxmemory 200')
+        run('set a hello; set b world')
+        before = kv_store.data()
+        # neither the key written nor the keys that would have been evicted are lost
+        self.assertEqual(run('set a ' + 'x' * 300), "OOM")
+        self.assertEqual(run('append b ' + 'x' * 300), "OOM")
+        self.assertEqual(run('incr a'), "Not an integer")
+        self.assertEqual(kv_store.data(), before)
+        self.assertEqual(run('append fresh ' + 'x' * 300), "OOM")
+        self.assertEqual(kv_store.data(), before)
+        self.assertEqual(kv_store.memory_used, sum(kv_store.memory_usage().values()))
+        print("✅ Unit test OOM keeps old value passed")
+
+    def test_lfu_eviction(self):
+        kv_store = KVStore()
+        entry_size = len("k0") + len("v") + KVStore.ENTRY_OVERHEAD
+        kv_store.executing_log({'term': 1, 'command': f'maxmemory {3 * entry_size} lfu', 'value': ''})
+        kv_store.executing_log({'term': 1, 'command': 'set k0 v; set k1 v; get k1; set k2 v; get k0; get k0; set k3 v', 'value': ''})
+        self.assertEqual(sorted(kv_store.data().keys()), ["k0", "k1", "k3"])
+
+        # A replica restored from the snapshot must pick the same victim
+        replica = KVStore()
+        replica.restore(kv_store.snapshot())
+        for store in (kv_store, replica):
+            store.executing_log({'term': 2, 'command': 'set k4 v', 'value': ''})
+        self.assertEqual(kv_store.data(), replica.data())
+        print("✅ Unit test lfu eviction passed")
+
+    def test_scan_and_prefix(self):
+        kv_store = KVStore()
+        kv_store.executing_log({'term': 1, 'command': 'set user:1 a; set user:2 b; set user:3 c; set other d', 'value': ''})
+        log_scan = {'term': 2, 'command': 'scan user:1 user:9 2', 'value': ''}
+        kv_store.executing_log(log_scan)
+        self.assertEqual(json.loads(log_scan['value']), {"items": [["user:1", "a"], ["user:2", "b"]], "cursor": "user:3"})
+
+        log_next = {'term': 3, 'command': 'prefix user: 2 user:3', 'value': ''}
+        kv_store.executing_log(log_next)
+        self.assertEqual(json.loads(log_next['value']), {"items": [["user:3", "c"]], "cursor": None})
+        self.assertEqual(json.loads(kv_store.read('prefix user: 1')), {"items": [["user:1", "a"]], "cursor": "user:2"})
+        self.assertTrue(KVStore.is_read_only('scan a z'))
+        self.assertFalse(KVStore.is_read_only('scan a z; del a'))
+        print("✅ Unit test scan and prefix passed")
+
+    def test_sessions(self):
+        kv_store = KVStore()
+        first = {'term': 1, 'command': 'append k a', 'value': '', 'client_id': 'c1', 'seq': 1}
+        kv_store.executing_log(first)
+        retry = {'term': 1, 'command': 'append k a', 'value': '', 'client_id': 'c1', 'seq': 1}
+        kv_store.executing_log(retry)
+        self.assertEqual(retry['value'], first['value'])
+        self.assertEqual(kv_store.data()['k'], 'a')
+
+        # the session table is replicated with the store
+        replica = KVStore()
+        replica.restore(json.loads(json.dumps(kv_store.snapshot())))
+        self.assertEqual(replica.session_response('c1', 1), 'OK')
+        self.assertIsNone(replica.session_response('c1', 2))
+
+        # acknowledged responses are dropped and can't be replayed
+        kv_store.executing_log({'term': 1, 'command': 'append k b', 'value': '', 'client_id': 'c1', 'seq': 2, 'acked': 1})
+        self.assertTrue(kv_store.is_stale('c1', 1))
+        self.assertIsNone(kv_store.session_response('c1', 1))
+        stale = {'term': 1, 'command': 'append k a', 'value': '', 'client_id': 'c1', 'seq': 1}
+        kv_store.executing_log(stale)
+        self.assertEqual(kv_store.data()['k'], 'ab')
+        print("✅ Unit test client sessions passed")
+
+class TestLogStore(unittest.TestCase):
+    def test_columnar_log(self):
+        entries = [{"term": i // 3, "command": f"set key{i} välue{i}", "value": "OK"} for i in range(10)]
+        entries.append({"term": 3, "command": "append k x", "value": "OK", "client_id": "c1", "seq": 4, "acked": 3})
+        log = LogStore(entries)
+        self.assertEqual(len(log), 11)
+        self.assertEqual(list(log), entries)
+        self.assertEqual(log[-1], entries[-1])
+        self.assertEqual(log[4:6], entries[4:6])
+        self.assertEqual((log.term(7), log.last_term(), log.command(2)), (2, 3, "set key2 välue2"))
+        self.assertLess(log.nbytes, len(json.dumps(entries)))
+
+        # saved columns and the older list of dicts load back the same
+        self.assertEqual(LogStore.from_data(json.loads(json.dumps(log.to_data()))), entries)
+        self.assertEqual(LogStore.from_data(entries), entries)
+
+        log.append({"term": 3, "command": "strln key1", "value": 6})
+        self.assertEqual(log[-1]["value"], "6")
+
+        log.truncate(5)
+        log.append({"term": 4, "command": "del key1", "value": "value1"})
+        self.assertEqual(list(log), entries[:5] + [{"term": 4, "command": "del key1", "value": "value1"}])
+        print("✅ Unit test columnar log passed")
+
+class TestStorageWriter(unittest.TestCase):
+    def test_async_store(self):
+        async def store(storage: StableStorage):
+            # the writer thread only writes the newest state, every future resolves
+            writes = [storage.store_async({"log": list(range(i))}) for i in range(50)]
+            await asyncio.gather(*writes)
+            storage.storeAll({"log": [1, 2, 3]})
+
+        storage = StableStorage(Address("localhost", 0))
+        try:
+            asyncio.run(store(storage))
+            storage.drop_cache()
+            self.assertEqual(storage.load(), {"log": [1, 2, 3]})
+            self.assertEqual(storage.written_seq, storage.submitted_seq)
+        finally:
+            os.remove(storage.path)
+        print("✅ Unit test background storage writes passed")
+
+    def test_serialize_on_writer(self):
+        threads = []
+        class RecordingLog(LogStore):
+            def snapshot(self):
+                frozen = RecordingLog()
+                frozen.__dict__.update(LogStore.snapshot(self).__dict__)
+                return frozen
+            def to_data(self):
+                threads.append(threading.current_thread())
+                return super().to_data()
+
+        async def store(storage: StableStorage, log: LogStore):
+            written = storage.store_async({"log": log})
+            # the loop keeps changing the log while the snapshot is written
+            log.truncate(1)
+            log.append({"term": 2, "command": "set key2 value2", "value": "OK"})
+            await written
+
+        entries = [{"term": 1, "command": f"set key{i} value{i}", "value": "OK"} for i in range(3)]
+        storage = StableStorage(Address("localhost", 0))
+        try:
+            asyncio.run(store(storage, RecordingLog(entries)))
+            self.assertEqual(threads, [storage.writer])
+            storage.drop_cache()
+            self.assertEqual(list(LogStore.from_data(storage.load()["log"])), entries)
+        finally:
+            os.remove(storage.path)
+        print("✅ Unit test storage serialization on the writer thread passed")
+
+class TestCompression(unittest.TestCase):
+    def test_pack_and_storage(self):
+        codec = Compression.get_codec("zlib")
+        text = json.dumps([{"term": 1, "command": f"set key{i} value", "value": "OK"} for i in range(100)])
+        packed = Compression.pack(text, codec, 1024)
+        self.assertIsInstance(packed, dict)
+        self.assertLess(len(packed["data"]), len(text) / 4)
+        self.assertEqual(Compression.unpack(packed), text)
+        self.assertEqual(Compression.pack("short", codec, 1024), "short")
+        with self.assertRaises(ValueError):
+            RaftConfig(compression="snappy")
+
+        storage = StableStorage(Address("localhost", 0), in_memory=True)
+        storage.storeAll({"log": json.loads(text)})
+        plain = storage.memory_data
+        storage.codec, storage.compression_threshold = codec, 1024
+        storage.storeAll({"log": json.loads(text)})
+        self.assertLess(len(storage.memory_data), len(plain) / 4)
+        storage.drop_cache()
+        self.assertEqual(storage.load(), {"log": json.loads(text)})
+        # files written before compression was enabled still load
+        storage.memory_data = plain
+        storage.drop_cache()
+        self.assertEqual(storage.load(), {"log": json.loads(text)})
+        print("✅ Unit test compression passed")
+
+class TestTiming(unittest.TestCase):
+    def test_latency_window(self):
+        window = LatencyWindow(4)
+        self.assertEqual(window.percentile(99), 0.0)
+        for rtt in [0.5, 0.1, 0.2, 0.3, 0.4]:
+            window.record(rtt)
+        self.assertEqual(len(window), 4)
+        self.assertEqual(window.percentile(50), 0.2)
+        self.assertEqual(window.percentile(99), 0.4)
+        print("✅ Unit test latency window passed")
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(rate=10, burst=2, now=0)
+        self.assertEqual(bucket.take(0), 0)
+        self.assertEqual(bucket.take(0), 0)
+        self.assertAlmostEqual(bucket.take(0), 0.1)
+        self.assertAlmostEqual(bucket.take(0.05), 0.05)
+        self.assertEqual(bucket.take(0.1), 0)
+        print("✅ Unit test token bucket passed")
+
+    def test_config_overrides(self):
+        os.environ["RAFT_HEARTBEAT_INTERVAL"] = "0.25"
+        os.environ["RAFT_ADAPTIVE"] = "false"
+        try:
+            config = RaftConfig.load()
+        finally:
+            del os.environ["RAFT_HEARTBEAT_INTERVAL"]
+            del os.environ["RAFT_ADAPTIVE"]
+        self.assertEqual(config.heartbeat_interval, 0.25)
+        self.assertFalse(config.adaptive)
+        self.assertEqual(config.rtt_window, RaftConfig.DEFAULTS["rtt_window"])
+        self.assertRaises(ValueError, RaftConfig, unknown_option=1)
+        self.assertRaises(ValueError, RaftConfig, min_rpc_timeout=1, max_rpc_timeout=0.5)
+        print("✅ Unit test config overrides passed")
+
+class TestMetrics(unittest.TestCase):
+    def test_render(self):
+        metrics = MetricsRegistry()
+        requests_total = metrics.counter("requests_total", "Requests")
+        latency = metrics.histogram("latency_seconds", "Latency", buckets=(0.1, 1))
+        keys = metrics.gauge("keys", "Keys")
+        metrics.add_collector(lambda: keys.set(3))
+        requests_total.inc(command="get")
+        requests_total.inc(2, command="get")
+        latency.observe(0.05, peer="localhost:1")
+        latency.observe(5, peer="localhost:1")
+
+        lines = metrics.render().splitlines()
+        self.assertIn('requests_total{command="get"} 3', lines)
+        self.assertIn('latency_seconds_bucket{peer="localhost:1",le="0.1"} 1', lines)
+        self.assertIn('latency_seconds_bucket{peer="localhost:1",le="1"} 1', lines)
+        self.assertIn('latency_seconds_bucket{peer="localhost:1",le="+Inf"} 2', lines)
+        self.assertIn('latency_seconds_count{peer="localhost:1"} 2', lines)
+        self.assertIn("keys 3", lines)
+        self.assertIn("# TYPE latency_seconds histogram", lines)
+        print("✅ Unit test metrics render passed")
+
+class TestTracing(unittest.TestCase):
+    def test_spans(self):
+        tracer = Tracer(capacity=3)
+        with tracer.span("execute"):
+            pass
+        self.assertEqual(tracer.dump(), [])
+
+        tracer.enabled = True
+        with tracer.span("execute"):
+            with tracer.span("storage.write"):
+                time.sleep(0.01)
+        spans = tracer.dump()
+        self.assertEqual([span["stack"] for span in spans], ["execute;storage.write", "execute"])
+        self.assertGreaterEqual(spans[0]["duration_us"], 10000)
+        self.assertLess(spans[1]["self_us"], spans[1]["duration_us"])
+
+        folded = dict(line.rsplit(" ", 1) for line in tracer.folded().splitlines())
+        self.assertEqual(set(folded), {"execute", "execute;storage.write"})
+
+        for _ in range(5):
+            with tracer.span("apply"):
+                pass
+        self.assertEqual(len(tracer.dump()), 3)
+        print("✅ Unit test tracing spans passed")
+
+class TestSimulation(unittest.TestCase):
+    async def failover(self, cluster: SimCluster):
+        leader = await cluster.wait_for_leader()
+        self.assertEqual((await cluster.execute("set kunci value"))["data"], "OK")
+        await asyncio.sleep(1)
+        cluster.crash(leader)
+        crash_time = asyncio.get_running_loop().time()
+        new_leader = await cluster.wait_for_leader(timeout=30, exclude={leader})
+        failover_time = asyncio.get_running_loop().time() - crash_time
+        return str(new_leader), failover_time, (await cluster.execute("get kunci"))["data"]
+
+    def test_failover(self):
+        for seed in range(10):
+            new_leader, failover_time, value = simulate(self.failover, size=3, seed=seed)
+            self.assertLess(failover_time, 5)
+            self.assertEqual(value, "value")
+        print("✅ Unit test simulated failover passed")
+
+    def test_compressed_replication(self):
+        # every payload above 0 bytes is compressed, replication must behave the same
+        for compression in ("none", "zlib"):
+            config = RaftConfig(compression=compression, compression_threshold=0)
+            new_leader, failover_time, value = simulate(self.failover, size=3, seed=1, config=config)
+            self.assertEqual(value, "value")
+        print("✅ Unit test simulated compressed replication passed")
+
+    def test_admission_control(self):
+        async def overload(cluster: SimCluster):
+            leader = await cluster.wait_for_leader()
+            session = {"client_id": "greedy", "acked": 0}
+            answers = [await cluster.execute(f"set k{seq} v", seq=seq, **session) for seq in range(1, 4)]
+            # a write is confirmed only once it is committed
+            stable_vars = cluster.nodes[leader].stable_storage.load()
+            self.assertEqual(stable_vars["commit_length"], len(stable_vars["log"]))
+            self.assertEqual([answer["status"] for answer in answers], ["success", "success", "onprocess"])
+            self.assertGreater(answers[2]["retry_after"], 0)
+            await asyncio.sleep(answers[2]["retry_after"])
+            self.assertEqual((await cluster.execute("set k3 v", seq=3, **session))["status"], "success")
+
+            # with no follower to commit them, writes stop being admitted at the uncommitted limit
+            cluster.network.partition([leader], [addr for addr in cluster.addrs if addr != leader])
+            answers = await asyncio.gather(*[cluster.execute(f"set other{i} v", leader) for i in range(6)])
+            reasons = [answer.get("reason", "") for answer in answers if answer is not None]
+            self.assertEqual(sum("waiting to commit" in reason for reason in reasons), 2)
+            # and the admitted ones are never confirmed
+            self.assertNotIn("success", [answer["status"] for answer in answers if answer is not None])
+
+        config = RaftConfig(client_rate_limit=1, client_burst=2, max_uncommitted_entries=4)
+        simulate(overload, size=3, seed=0, config=config)
+        print("✅ Unit test simulated admission control passed")
+
+    def test_bootstrap(self):
+        async def cold_start(cluster: SimCluster):
+            started = asyncio.get_running_loop().time()
+            leader = await cluster.wait_for_leader()
+            elected = asyncio.get_running_loop().time() - started
+            self.assertEqual((await cluster.execute("set kunci value"))["data"], "OK")
+            await asyncio.sleep(1)
+            voters = [set(node.cluster_addr_list) for node in cluster.nodes.values()]
+            self.assertEqual(voters, [set(cluster.addrs)] * 5)
+            self.assertEqual(sum(node.election_term for node in cluster.nodes.values()), 5 * cluster.nodes[leader].election_term)
+            # a restarted member keeps its configuration and rejoins as a follower
+            follower = next(addr for addr in cluster.addrs if addr != leader)
+            cluster.crash(follower)
+            cluster.start_node(follower)
+            await asyncio.sleep(3)
+            self.assertEqual(cluster.nodes[follower].type, NodeType.FOLLOWER)
+            self.assertEqual(cluster.nodes[follower].app.data(), {"kunci": "value"})
+            return elected
+
+        config = RaftConfig()
+        for seed in range(3):
+            elected = simulate(cold_start, size=5, seed=seed, bootstrap=True)
+            self.assertLess(elected, 2 * config.min_election_timeout + 1)
+        print("✅ Unit test simulated static bootstrap passed")
+
+    def test_transfer_leadership(self):
+        async def transfer(cluster: SimCluster):
+            leader = await cluster.wait_for_leader()
+            self.assertEqual((await cluster.execute("set kunci value"))["data"], "OK")
+            target, crashed = [addr for addr in cluster.addrs if addr != leader][:2]
+            response = await cluster.client.request(leader, "transfer_leadership", {"address": target})
+            self.assertEqual(response["status"], "success")
+            self.assertEqual(await cluster.wait_for_leader(timeout=5, exclude={leader}), target)
+            self.assertEqual((await cluster.execute("get kunci", target))["data"], "value")
+
+            # a target that doesn't answer is retried at the heartbeat pace until the transfer gives up
+            cluster.crash(crashed)
+            self.assertEqual((await cluster.execute("set missed 1", target))["data"], "OK")
+            node = cluster.nodes[target]
+            started = asyncio.get_running_loop().time()
+            await cluster.client.request(target, "transfer_leadership", {"address": crashed})
+            while node.transfer_target is not None:
+                await asyncio.sleep(0.1)
+            elapsed = asyncio.get_running_loop().time() - started
+            self.assertEqual(node.type, NodeType.LEADER)
+            # the regular heartbeats and the transfer's retries, about one of each per interval
+            failures = node.append_entries_failures.values[(("peer", str(crashed)),)]
+            self.assertLess(failures, 3 * elapsed / node.heartbeat_interval + 10)
+            self.assertEqual((await cluster.execute("set after transfer", target))["data"], "OK")
+
+        for seed in range(3):
+            simulate(transfer, size=5, seed=seed)
+        print("✅ Unit test simulated leadership transfer passed")
+
+    def test_learner_promotion(self):
+        async def late_join(cluster: SimCluster):
+            leader = await cluster.wait_for_leader()
+            for i in range(100):
+                await cluster.execute(f"set key{i} value{i}")
+            newcomer = Address("sim", 5100)
+            cluster.start_node(newcomer, leader)
+            states = set()
+            while newcomer not in cluster.nodes[leader].cluster_addr_list:
+                node = cluster.nodes[newcomer]
+                states.add((node.type, newcomer in cluster.nodes[leader].cluster_learner_list))
+                await asyncio.sleep(0.01)
+            # it joined as a learner and was promoted only once it had caught up
+            self.assertIn((NodeType.LEARNER, True), states)
+            self.assertGreaterEqual(cluster.nodes[leader].ack_length[newcomer],
+                                    len(cluster.nodes[leader].stable_storage.load()["log"]) - RaftNode.LEARNER_PROMOTION_THRESHOLD - 1)
+            await asyncio.sleep(2)
+            self.assertEqual(cluster.nodes[newcomer].type, NodeType.FOLLOWER)
+            self.assertEqual(cluster.nodes[newcomer].app.data(), cluster.nodes[leader].app.data())
+            for node in cluster.nodes.values():
+                self.assertEqual(set(node.cluster_addr_list), set(cluster.addrs) | {newcomer})
+                self.assertEqual(node.cluster_learner_list, [])
+                self.assertIsNone(node.joint_addr_list)
+
+        for seed in range(3):
+            simulate(late_join, size=3, seed=seed)
+        print("✅ Unit test simulated learner catch-up and promotion passed")
+
+    def test_remove_membership(self):
+        async def shrink(cluster: SimCluster):
+            leader = await cluster.wait_for_leader()
+            follower = next(addr for addr in cluster.addrs if addr != leader)
+            response = await cluster.client.request(leader, "remove_membership", {"address": follower})
+            self.assertEqual(response["status"], "success")
+            await asyncio.sleep(2)
+            remaining = [addr for addr in cluster.addrs if addr != follower]
+            for addr in remaining:
+                self.assertEqual(set(cluster.nodes[addr].cluster_addr_list), set(remaining))
+                self.assertIsNone(cluster.nodes[addr].joint_addr_list)
+            self.assertEqual((await cluster.execute("set kunci value", leader))["data"], "OK")
+            # the removed node stays quiet instead of starting elections
+            await asyncio.sleep(10)
+            self.assertEqual(cluster.leader(), leader)
+
+            # a leader removing itself steps down once the new configuration commits
+            response = await cluster.client.request(leader, "remove_membership", {"address": leader})
+            self.assertEqual(response["status"], "success")
+            new_leader = await cluster.wait_for_leader(timeout=30, exclude={leader})
+            self.assertNotEqual(cluster.nodes[leader].type, NodeType.LEADER)
+            voters = [addr for addr in remaining if addr != leader]
+            self.assertEqual(set(cluster.nodes[new_leader].cluster_addr_list), set(voters))
+            self.assertEqual((await cluster.execute("get kunci", new_leader))["data"], "value")
+            await asyncio.sleep(10)
+            self.assertEqual(cluster.leader(), new_leader)
+
+        for seed in range(3):
+            simulate(shrink, size=5, seed=seed)
+        print("✅ Unit test simulated membership removal passed")
+
+    def test_deterministic(self):
+        self.assertEqual(simulate(self.failover, size=5, seed=7), simulate(self.failover, size=5, seed=7))
+        print("✅ Unit test simulation determinism passed")
+
+    def test_retry_after_failover(self):
+        async def retry(cluster: SimCluster):
+            leader = await cluster.wait_for_leader()
+            session = {"client_id": "client", "seq": 1}
+            self.assertEqual((await cluster.execute("append kunci a", **session))["data"], "OK")
+            await asyncio.sleep(1)
+            cluster.crash(leader)
+            new_leader = await cluster.wait_for_leader(timeout=30, exclude={leader})
+            # the response was lost, the retry must not append twice
+            self.assertEqual((await cluster.execute("append kunci a", new_leader, **session))["data"], "OK")
+            self.assertEqual((await cluster.execute("get kunci", new_leader))["data"], "a")
+
+            # once acknowledged, a replay is rejected instead of answered with a made up value
+            await cluster.execute("get kunci", new_leader, client_id="client", seq=2, acked=1)
+            stale = await cluster.execute("append kunci a", new_leader, **session)
+            self.assertEqual(stale["status"], "failed")
+            self.assertIn("Stale request", stale["reason"])
+            self.assertEqual((await cluster.execute("get kunci", new_leader))["data"], "a")
+
+        for seed in range(3):
+            simulate(retry, size=3, seed=seed)
+        print("✅ Unit test simulated retry after failover passed")
+
+    def test_read_log(self):
+        async def read_log(cluster: SimCluster):
+            leader = await cluster.wait_for_leader()
+            for i in range(25):
+                await cluster.execute(f"set k{i} {i}")
+            term = cluster.nodes[leader].election_term
+            entries, next_index = [], 0
+            while next_index is not None:
+                page = await cluster.client.request(leader, "read_log", {"start": next_index, "limit": 10, "term": term})
+                self.assertLessEqual(len(page["entries"]), 10)
+                entries += page["entries"]
+                next_index = page["next"]
+            return entries
+
+        entries = simulate(read_log, size=3, seed=0)
+        commands = [entry["command"] for entry in entries if entry["command"] != RaftNode.CONFIG_COMMAND]
+        self.assertEqual(commands, [f"set k{i} {i}" for i in range(25)])
+        self.assertEqual([entry["index"] for entry in entries], list(range(entries[0]["index"], entries[0]["index"] + len(entries))))
+        print("✅ Unit test paginated log read passed")
+
+    def test_unlogged_scan(self):
+        async def scan(cluster: SimCluster):
+            leader = await cluster.wait_for_leader()
+            await cluster.execute("set user:1 a; set user:2 b")
+            log = cluster.nodes[leader].stable_storage.load()["log"]
+            length = len(log)
+            page = await cluster.execute("prefix user: 1")
+            self.assertEqual(json.loads(page["data"]), {"items": [["user:1", "a"]], "cursor": "user:2"})
+            page = await cluster.execute("scan user:2 user:9")
+            self.assertEqual(json.loads(page["data"])["items"], [["user:2", "b"]])
+            self.assertEqual(len(log), length)
+
+        simulate(scan, size=3, seed=0)
+        print("✅ Unit test simulated unlogged range reads passed")
+
+    def test_watch(self):
+        async def watch(cluster: SimCluster):
+            leader = await cluster.wait_for_leader()
+            follower = next(addr for addr in cluster.addrs if addr != leader)
+            caught_up = await cluster.client.request(follower, "watch", {"start": 0, "prefix": "user:"})
+            self.assertEqual(caught_up["entries"], [])
+
+            # long poll from the resume token, answered once a matching write commits
+            loop = asyncio.get_running_loop()
+            poll = asyncio.create_task(cluster.client.request(follower, "watch", {
+                "start": caught_up["next"], "prefix": "user:", "wait": 30}, 40))
+            await cluster.execute("get user:1")
+            await cluster.execute("set other 1")
+            sent_time = loop.time()
+            await cluster.execute("set user:1 a; set other 2")
+            response = await poll
+            self.assertLess(loop.time() - sent_time, 5)
+            self.assertEqual([entry["keys"] for entry in response["entries"]], [["user:1", "other"]])
+
+            resumed = await cluster.client.request(follower, "watch", {"start": response["next"], "keys": ["other"], "wait": 1}, 5)
+            self.assertEqual(resumed["entries"], [])
+
+            # imported and evicted keys reach filtered watchers too
+            await cluster.client.request(leader, "import_data", {"items": [["user:2", "b"], ["x", "1"]]})
+            await cluster.execute(f"maxmemory {cluster.nodes[leader].app.memory_used}")
+            await cluster.execute("set y 1")
+            # writes that fail or roll back change nothing and aren't reported
+            self.assertEqual((await cluster.execute("cas user:2 nope x"))["data"], "MISMATCH")
+            self.assertEqual((await cluster.execute("guard user:2 missing; set user:3 c"))["data"], "ABORTED")
+            await asyncio.sleep(1)
+            changes = await cluster.client.request(follower, "watch", {"start": resumed["next"], "prefix": "user:"})
+            imported, evicting = changes["entries"]
+            self.assertEqual(imported["keys"], ["user:2", "x"])
+            self.assertEqual(json.loads(imported["value"]), [["user:2", "b"], ["x", "1"]])
+            self.assertEqual((evicting["command"], evicting["evicted"]), ("set y 1", ["user:1"]))
+
+        simulate(watch, size=3, seed=0)
+        print("✅ Unit test committed change watch passed")
+
+    def test_bulk_import_export(self):
+        async def bulk(cluster: SimCluster):
+            leader = await cluster.wait_for_leader()
+            await cluster.execute("set kept 1")
+            items = [[f"key{i:04d}", f"value{i}"] for i in range(2500)]
+            imported = await cluster.client.request(leader, "import_data", {"items": items})
+            self.assertEqual(imported["data"], 2500)
+            log = cluster.nodes[leader].stable_storage.load()["log"]
+            self.assertEqual(log.command(len(log) - 1), "import 2500")
+
+            # later writes don't leak into a running export
+            first = await cluster.client.request(leader, "export_data", {"limit": 1000})
+            self.assertGreaterEqual(cluster.nodes[leader].stable_storage.load()["commit_length"], first["index"])
+            await cluster.execute("set late 1")
+            exported, response = first["items"], first
+            while response["next"] is not None:
+                response = await cluster.client.request(leader, "export_data", {
+                    "export_id": first["export_id"], "cursor": response["next"], "limit": 1000})
+                exported += response["items"]
+            self.assertEqual(exported, sorted(items + [["kept", "1"]]))
+
+            await asyncio.sleep(1)
+            follower = next(addr for addr in cluster.addrs if addr != leader)
+            self.assertEqual(len(cluster.nodes[follower].app.store), 2502)
+            gone = await cluster.client.request(leader, "export_data", {"export_id": first["export_id"]})
+            self.assertEqual(gone["status"], "failed")
+
+            # a replayed import is answered from the session table, not installed over newer writes
+            session = {"items": [["late", "imported"]], "client_id": "importer", "seq": 1}
+            self.assertEqual((await cluster.client.request(leader, "import_data", session))["data"], 1)
+            await cluster.execute("set late 2")
+            length = len(cluster.nodes[leader].stable_storage.load()["log"])
+            replay = await cluster.client.request(leader, "import_data", session)
+            self.assertEqual((replay["status"], replay["data"]), ("success", 1))
+            self.assertEqual(len(cluster.nodes[leader].stable_storage.load()["log"]), length)
+            self.assertEqual(cluster.nodes[leader].app.data()["late"], "2")
+            await cluster.client.request(leader, "import_data", {**session, "items": [["next", "1"]], "seq": 2, "acked": 1})
+            stale = await cluster.client.request(leader, "import_data", session)
+            self.assertEqual(stale["status"], "failed")
+            self.assertEqual(cluster.nodes[leader].app.data()["late"], "2")
+
+        simulate(bulk, size=3, seed=0)
+        print("✅ Unit test bulk import and export passed")
+
+    def test_partition(self):
+        async def partition(cluster: SimCluster):
+            leader = await cluster.wait_for_leader()
+            cluster.network.partition([leader], [addr for addr in cluster.addrs if addr != leader])
+            new_leader = await cluster.wait_for_leader(timeout=30, exclude={leader})
+            self.assertEqual((await cluster.execute("set kunci value", new_leader))["data"], "OK")
+            await asyncio.sleep(5)
+            self.assertEqual(cluster.nodes[leader].type, NodeType.FOLLOWER)
+
+            cluster.network.heal()
+            await asyncio.sleep(5)
+            leaders = [addr for addr, node in cluster.nodes.items() if node.type == NodeType.LEADER]
+            self.assertEqual(leaders, [new_leader])
+            self.assertEqual(cluster.nodes[leader].app.data().get("kunci"), "value")
+
+        for seed in range(5):
+            simulate(partition, size=5, seed=seed)
+        print("✅ Unit test simulated partition passed")
+
+class TestRPCServer(unittest.TestCase):
+    def test_peer_priority(self):
+        class Node:
+            def __init__(self):
+                self.done = []
+            def execute(self, json_request: str) -> str:
+                time.sleep(0.01)  # a busy leader
+                self.done.append("execute")
+                return json.dumps({"status": "success"})
+            def heartbeat(self, json_request: str) -> str:
+                self.done.append("heartbeat")
+                return json.dumps({"status": "success"})
+
+        async def burst():
+            node = Node()
+            server = AsyncRPCServer(Address("localhost", 0), node, client_methods={"execute"}, client_workers=2)
+            ip, port = await server.start()
+            addr, rpc_handler = Address(ip, port), RPCHandler("Test")
+            try:
+                executes = [asyncio.create_task(rpc_handler.async_request(addr, "execute", {}, 5)) for _ in range(30)]
+                await asyncio.sleep(0.02)
+                self.assertEqual((await rpc_handler.async_request(addr, "heartbeat", {}, 5))["status"], "success")
+                await asyncio.gather(*executes)
+            finally:
+                await rpc_handler.close()
+                await server.close()
+            return node.done
+
+        done = asyncio.run(burst())
+        self.assertEqual(len(done), 31)
+        # the heartbeat only waited for the executes already holding a worker
+        self.assertLess(done.index("heartbeat"), 10)
+        print("✅ Unit test RPC server peer priority passed")
+
+    def test_client_slots(self):
+        class Node:
+            async def export_data(self, json_request: str) -> str:
+                await asyncio.sleep(0.3)  # work split over several steps
+                return json.dumps({"status": "success"})
+            def watch(self, json_request: str):
+                # answered later, without work left to do
+                return asyncio.sleep(0.3, json.dumps({"status": "success"}))
+            def execute(self, json_request: str) -> str:
+                return json.dumps({"status": "success"})
+
+        async def queued_behind(rpc_name: str) -> float:
+            server = AsyncRPCServer(Address("localhost", 0), Node(), client_methods={"export_data", "watch", "execute"}, client_workers=1)
+            addr, rpc_handler = Address(*await server.start()), RPCHandler("Test")
+            loop = asyncio.get_running_loop()
+            try:
+                first = asyncio.create_task(rpc_handler.async_request(addr, rpc_name, {}, 5))
+                await asyncio.sleep(0.05)
+                start = loop.time()
+                await rpc_handler.async_request(addr, "execute", {}, 5)
+                elapsed = loop.time() - start
+                await first
+                return elapsed
+            finally:
+                await rpc_handler.close()
+                await server.close()
+
+        # a coroutine method holds the only slot to the end, a returned awaitable doesn't
+        self.assertGreater(asyncio.run(queued_behind("export_data")), 0.15)
+        self.assertLess(asyncio.run(queued_behind("watch")), 0.15)
+        print("✅ Unit test RPC server client slots passed")
+
+    def test_deadlines(self):
+        async def silent(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+            # accepts connections and never answers, like a hung peer
+            await reader.read()
+            writer.close()
+
+        async def calls():
+            server = await asyncio.start_server(silent, "localhost", 0)
+            addr = Address(*server.sockets[0].getsockname()[:2])
+            rpc_handler = RPCHandler("Test")
+            loop = asyncio.get_running_loop()
+            try:
+                start = loop.time()
+                self.assertIsNone(await rpc_handler.async_request(addr, "heartbeat", {}, 0.2))
+                self.assertLess(loop.time() - start, 0.5)
+                # the hung peer doesn't hold up a call to a peer that answers
+                node = AsyncRPCServer(Address("localhost", 0), type("Node", (), {
+                    "vote": lambda self, json_request: json.dumps({"status": "success"})})())
+                live = Address(*await node.start())
+                start = loop.time()
+                hung, answered = await asyncio.gather(rpc_handler.async_request(addr, "vote", {}),
+                                                      rpc_handler.async_request(live, "vote", {}))
+                self.assertIsNone(hung)
+                self.assertEqual(answered["status"], "success")
+                self.assertAlmostEqual(loop.time() - start, RPCHandler.RPC_TIMEOUTS["vote"], delta=0.3)
+                await node.close()
+
+                # a cancelled call gives up its connection
+                call = asyncio.create_task(rpc_handler.async_request(addr, "execute", {}))
+                await asyncio.sleep(0.1)
+                call.cancel()
+                with self.assertRaises(asyncio.CancelledError):
+                    await call
+            finally:
+                await rpc_handler.close()
+                server.close()
+
+        asyncio.run(calls())
+        # the blocking call has a deadline too
+        silent_server = subprocess.Popen([sys.executable, "-c", "import socket, time; s = socket.create_server(('localhost', 3999)); "
+                                          "print(flush=True); c = s.accept(); time.sleep(5)"], stdout=subprocess.PIPE)
+        try:
+            silent_server.stdout.readline()
+            start = time.monotonic()
+            self.assertIsNone(RPCHandler("Test").request(Address("localhost", 3999), "vote", {}, 0.3))
+            self.assertLess(time.monotonic() - start, 1)
+        finally:
+            silent_server.kill()
+            silent_server.stdout.close()
+
+        # a node that knows no leader ends the call, blocking or not
+        leaderless = subprocess.Popen([sys.executable, "-c", "from xmlrpc.server import SimpleXMLRPCServer; "
+                                       "s = SimpleXMLRPCServer(('localhost', 3998), logRequests=False); "
+                                       "s.register_function(lambda r: '{\"status\": \"redirected\", \"address\": null}', 'execute'); "
+                                       "print(flush=True); s.serve_forever()"], stdout=subprocess.PIPE)
+        try:
+            leaderless.stdout.readline()
+            self.assertIsNone(RPCHandler("Test").request(Address("localhost", 3998), "execute", {}, 1))
+            async def leaderless_call():
+                rpc_handler = RPCHandler("Test")
+                try:
+                    return await rpc_handler.async_request(Address("localhost", 3998), "execute", {}, 1)
+                finally:
+                    await rpc_handler.close()
+            self.assertIsNone(asyncio.run(leaderless_call()))
+        finally:
+            leaderless.kill()
+            leaderless.stdout.close()
+        print("✅ Unit test RPC deadlines passed")
+
 class TestMembership(unittest.TestCase):
     def test_fail_to_apply_membership(self):
         print(ColorLog.colorize("Running test fail to apply membership for 45 seconds", ColorLog._HEADER))
@@ -1,91 +1,607 @@
 from structs.Log import Log
+from structs.ChunkedValue import ChunkedValue
+from structs.SortedIndex import SortedIndex
+from collections import OrderedDict
+from typing import Dict, List, Tuple
+import heapq
+import json
 import unittest
 import subprocess
 import asyncio
 
 class KVStore:
-    ALLOWED_COMMANDS = ["ping", "get", "set", "strln", "del", "append"]
+    ALLOWED_COMMANDS = ["ping", "get", "set", "strln", "del", "append", "memory", "maxmemory", "scan", "prefix",
+                        "cas", "incr", "decr", "guard"]
+    EVICTION_POLICIES = ["lru", "lfu"]
+    # Commands that change the store, with the position of the key they write (None if
+    # the keys are not in the command, see changed_keys)
+    WRITE_COMMANDS = {"set": 1, "del": 1, "append": 1, "maxmemory": None, "cas": 1, "incr": 1, "decr": 1,
+                      # bulk imports are installed through install(), not executed as a command
+                      "import": None}
+    IMPORT_COMMAND = "import"
+    # Commands that change neither the store nor its access counters, served by the leader without a log entry
+    READ_ONLY_COMMANDS = {"scan", "prefix"}
+    # Minimum number of arguments of each command, used to reject malformed commands without running them
+    MIN_ARGS = {"ping": 0, "get": 1, "set": 2, "strln": 1, "del": 1, "append": 2, "memory": 0, "maxmemory": 1, "scan": 2, "prefix": 1,
+                "cas": 3, "incr": 1, "decr": 1, "guard": 2}
+    # Conditions a guard can check, eq and ne compare against the rest of the command
+    GUARD_CONDITIONS = {"eq": 1, "ne": 1, "exists": 0, "missing": 0}
+    # Rough per-key bookkeeping cost (dict slot, buffer object) counted on top of key and value bytes
+    ENTRY_OVERHEAD = 64
+    # Range queries answer in bounded pages, a cursor is returned to fetch the next one
+    DEFAULT_PAGE_SIZE = 100
+    MAX_PAGE_SIZE = 1000
+    # Client sessions kept for deduplication, the least recently active is dropped first
+    MAX_SESSIONS = 10000
+    # Cached responses a client may leave unacknowledged before the oldest are dropped
+    MAX_SESSION_RESPONSES = 1000
 
-    def __init__(self):
-        self.store = {}
+    def __init__(self, max_memory: int = 0, eviction_policy: str = "lru"):
+        # Ordered from least to most recently used, so LRU eviction pops from the front
+        self.store: OrderedDict[str, ChunkedValue] = OrderedDict()
+        self.index: SortedIndex = SortedIndex()
+        self.max_memory: int = max_memory  # 0 means unbounded
+        self.eviction_policy: str = eviction_policy
+        self.memory_used: int = 0
+        # LFU bookkeeping. The clock is logical (one tick per applied command) so that
+        # every replica applying the same log picks the same eviction victims.
+        self.frequency: Dict[str, int] = {}
+        self.__clock: int = 0
+        self.__last_access: Dict[str, int] = {}
+        self.__lfu_heap: List[Tuple[int, int, str]] = []
+        # client_id -> {"acked": seq, "responses": {seq: result}}. Replicated with the
+        # store, so a retried request is answered from here instead of applied twice
+        self.sessions: OrderedDict[str, Dict] = OrderedDict()
+        # Value of every key before the running batch first changed it (None if it didn't
+        # exist), so a failed batch can be undone. None outside a batch
+        self.__journal: Dict[str, str | None] | None = None
+        # Set by a command that failed, which fails the batch it runs in. Results can't
+        # tell, a get may return a value that reads like a failure
+        self.__failed: bool = False
+        # Keys the last command or install evicted to stay within max_memory
+        self.evicted: List[str] = []
+        # Keys the running command or install changed, in order, evicted keys included
+        self.__changed: Dict[str, None] = {}
 
+    # Memory accounting
+    def __entry_size(self, key: str, value: ChunkedValue) -> int:
+        return len(key.encode()) + value.nbytes + KVStore.ENTRY_OVERHEAD
+
+    def key_memory(self, key: str) -> int:
+        value = self.store.get(key)
+        return self.__entry_size(key, value) if value is not None else 0
+
+    def memory_usage(self) -> Dict[str, int]:
+        return {key: self.__entry_size(key, value) for key, value in self.store.items()}
+
+    def __touch(self, key: str):
+        self.__clock += 1
+        self.store.move_to_end(key)
+        self.frequency[key] = self.frequency.get(key, 0) + 1
+        self.__last_access[key] = self.__clock
+        heapq.heappush(self.__lfu_heap, (self.frequency[key], self.__clock, key))
+        if len(self.__lfu_heap) > 4 * len(self.store) + 64:
+            self.__rebuild_lfu_heap()
+
+    def __rebuild_lfu_heap(self):
+        self.__lfu_heap = [(self.frequency[key], self.__last_access[key], key) for key in self.store]
+        heapq.heapify(self.__lfu_heap)
+
+    def __record(self, key: str):
+        self.__changed[key] = None
+        if self.__journal is not None and key not in self.__journal:
+            self.__journal[key] = str(self.store[key]) if key in self.store else None
+
+    def __fail(self, result: str) -> str:
+        self.__failed = True
+        return result
+
+    def __remove(self, key: str) -> ChunkedValue:
+        self.__record(key)
+        value = self.store.pop(key)
+        self.index.remove(key)
+        self.memory_used -= self.__entry_size(key, value)
+        self.frequency.pop(key, None)
+        self.__last_access.pop(key, None)
+        return value
+
+    def __next_victim(self, protected_key: str | None) -> str:
+        if self.eviction_policy == "lfu":
+            # Heap entries go stale when a key is touched again or removed, skip those lazily
+            held = None
+            while self.__lfu_heap:
+                entry = heapq.heappop(self.__lfu_heap)
+                freq, tick, key = entry
+                if key not in self.store or self.frequency[key] != freq or self.__last_access[key] != tick:
+                    continue
+                if key == protected_key:
+                    held = entry
+                    continue
+                if held is not None:
+                    heapq.heappush(self.__lfu_heap, held)
+                return key
+        return next(key for key in self.store if key != protected_key)
+
+    def __evict(self, protected_key: str | None = None) -> bool:
+        if self.max_memory <= 0:
+            return True
+        if protected_key in self.store and self.key_memory(protected_key) > self.max_memory:
+            return False
+        while self.memory_used > self.max_memory:
+            if len(self.store) - (1 if protected_key in self.store else 0) <= 0:
+                return False
+            victim = self.__next_victim(protected_key)
+            self.__remove(victim)
+            self.evicted.append(victim)
+        return True
+
+    # Commands
     def __ping(self):
         return "PONG"
 
     def __get(self, key):
-        return self.store.get(key, "")
+        if key not in self.store:
+            return ""
+        self.__touch(key)
+        return str(self.store[key])
+
+    def __fits(self, key: str, nbytes: int) -> bool:
+        """ Whether a value of nbytes for key fits in max_memory once every other key is evicted """
+        return self.max_memory <= 0 or len(key.encode()) + nbytes + KVStore.ENTRY_OVERHEAD <= self.max_memory
 
     def __set(self, key, value):
-        self.store[key] = value
+        # fail before anything changes, the old value and the other keys stay
+        if not self.__fits(key, len(value.encode())):
+            return self.__fail("OOM")
+        self.__record(key)
+        if key in self.store:
+            self.__remove(key)
+        self.store[key] = ChunkedValue(value)
+        self.index.add(key)
+        self.memory_used += self.__entry_size(key, self.store[key])
+        self.__touch(key)
+        # the value fits on its own, so evicting other keys always makes room
+        self.__evict(key)
         return "OK"
 
     def __strln(self, key):
-        return len(self.store.get(key, ""))
+        if key not in self.store:
+            return 0
+        self.__touch(key)
+        return len(self.store[key])
 
     def __delete(self, key):
-        return self.store.pop(key, "")
+        if key not in self.store:
+            return ""
+        return str(self.__remove(key))
 
     def __append(self, key, value):
-        self.store[key] = self.store.get(key, "") + value
+        if key not in self.store:
+            return self.__set(key, value)
+        if not self.__fits(key, self.store[key].nbytes + len(value.encode())):
+            return self.__fail("OOM")
+        self.__record(key)
+        before = self.store[key].nbytes
+        self.store[key].append(value)
+        self.memory_used += self.store[key].nbytes - before
+        self.__touch(key)
+        self.__evict(key)
+        return "OK"
+
+    def __memory(self, key: str | None):
+        if key is None:
+            return self.memory_used
+        return self.key_memory(key)
+
+    def __maxmemory(self, max_memory: int, eviction_policy: str):
+        self.max_memory = max_memory
+        if eviction_policy != self.eviction_policy:
+            self.eviction_policy = eviction_policy
+            self.__rebuild_lfu_heap()
+        self.__evict()
         return "OK"
 
+    def __cas(self, key, expected, value):
+        if key not in self.store or self.store[key] != expected:
+            return self.__fail("MISMATCH")
+        return self.__set(key, value)
+
+    def __incr(self, key, delta: int):
+        current = str(self.store[key]) if key in self.store else "0"
+        if not KVStore.__is_int(current):
+            return self.__fail("Not an integer")
+        value = int(current) + delta
+        result = self.__set(key, str(value))
+        return value if result == "OK" else result
+
+    def __guard(self, key, condition: str, expected: str):
+        if condition == "exists":
+            passed = key in self.store
+        elif condition == "missing":
+            passed = key not in self.store
+        else:
+            passed = (key in self.store and self.store[key] == expected) == (condition == "eq")
+        return "OK" if passed else self.__fail("ABORTED")
+
+    def __page(self, keys, limit: int) -> str:
+        # Fetch one extra key to know where the next page starts
+        items = []
+        cursor = None
+        for key in keys:
+            if len(items) == limit:
+                cursor = key
+                break
+            items.append([key, str(self.store[key])])
+        return json.dumps({"items": items, "cursor": cursor})
+
+    def __scan(self, start: str, end: str, limit: int):
+        return self.__page(self.index.irange(start, end), limit)
+
+    def __prefix(self, prefix: str, cursor: str | None, limit: int):
+        def keys():
+            for key in self.index.irange(max(prefix, cursor or "")):
+                if not key.startswith(prefix):
+                    return
+                yield key
+        return self.__page(keys(), limit)
+
+    def __page_size(self, arg: str | None) -> int | None:
+        if arg is None:
+            return KVStore.DEFAULT_PAGE_SIZE
+        if not KVStore.__is_count(arg) or int(arg) < 1:
+            return None
+        return min(int(arg), KVStore.MAX_PAGE_SIZE)
+
     def _execute_single_command(self, command : str | None):
         command_parts = command.split()
         if len(command_parts) < 1:
-            return "Invalid command"
+            return self.__fail("Invalid command")
 
         command_name = command_parts[0]
         if command_name not in self.ALLOWED_COMMANDS:
-            return "Invalid command"
+            return self.__fail("Invalid command")
 
         if command_name == "ping":
             return self.__ping()
-            
+
         elif command_name == "get":
             if len(command_parts) < 2:
-                return "Invalid command"
+                return self.__fail("Invalid command")
             key = command_parts[1]
             return self.__get(key)
-            
+
         elif command_name == "set":
             if len(command_parts) < 3:
-                return "Invalid command"
+                return self.__fail("Invalid command")
             key = command_parts[1]
             value = " ".join(command_parts[2:])
             return self.__set(key, value)
-        
+
         elif command_name == "strln":
             if len(command_parts) < 2:
-                return "Invalid command"
+                return self.__fail("Invalid command")
             key = command_parts[1]
             return self.__strln(key)
-        
+
         elif command_name == "del":
             if len(command_parts) < 2:
-                return "Invalid command"
+                return self.__fail("Invalid command")
             key = command_parts[1]
             return self.__delete(key)
-        
+
         elif command_name == "append":
             if len(command_parts) < 3:
-                return "Invalid command"
+                return self.__fail("Invalid command")
             key = command_parts[1]
             value = " ".join(command_parts[2:])
             return self.__append(key, value)
-        
+
+        elif command_name == "memory":
+            key = command_parts[1] if len(command_parts) > 1 else None
+            return self.__memory(key)
+
+        elif command_name == "maxmemory":
+            if len(command_parts) < 2 or not KVStore.__is_count(command_parts[1]):
+                return self.__fail("Invalid command")
+            eviction_policy = command_parts[2] if len(command_parts) > 2 else self.eviction_policy
+            if eviction_policy not in self.EVICTION_POLICIES:
+                return self.__fail("Invalid command")
+            return self.__maxmemory(int(command_parts[1]), eviction_policy)
+
+        elif command_name == "scan":
+            if len(command_parts) < 3:
+                return self.__fail("Invalid command")
+            limit = self.__page_size(command_parts[3] if len(command_parts) > 3 else None)
+            if limit is None:
+                return self.__fail("Invalid command")
+            return self.__scan(command_parts[1], command_parts[2], limit)
+
+        elif command_name == "prefix":
+            if len(command_parts) < 2:
+                return self.__fail("Invalid command")
+            limit = self.__page_size(command_parts[2] if len(command_parts) > 2 else None)
+            if limit is None:
+                return self.__fail("Invalid command")
+            cursor = command_parts[3] if len(command_parts) > 3 else None
+            return self.__prefix(command_parts[1], cursor, limit)
+
+        elif command_name == "cas":
+            if len(command_parts) < 4:
+                return self.__fail("Invalid command")
+            key = command_parts[1]
+            value = " ".join(command_parts[3:])
+            return self.__cas(key, command_parts[2], value)
+
+        elif command_name in ("incr", "decr"):
+            if len(command_parts) < 2 or not KVStore.__is_int(command_parts[2] if len(command_parts) > 2 else "1"):
+                return self.__fail("Invalid command")
+            delta = int(command_parts[2]) if len(command_parts) > 2 else 1
+            return self.__incr(command_parts[1], delta if command_name == "incr" else -delta)
+
+        elif command_name == "guard":
+            if len(command_parts) < 3 or command_parts[2] not in self.GUARD_CONDITIONS:
+                return self.__fail("Invalid command")
+            if len(command_parts) - 3 < self.GUARD_CONDITIONS[command_parts[2]]:
+                return self.__fail("Invalid command")
+            return self.__guard(command_parts[1], command_parts[2], " ".join(command_parts[3:]))
+
+    @staticmethod
+    def __is_count(arg: str) -> bool:
+        # str.isdigit() also takes digits like '²' that int() rejects
+        return arg.isascii() and arg.isdigit()
+
+    @staticmethod
+    def __is_int(arg: str) -> bool:
+        return KVStore.__is_count(arg.removeprefix("-"))
+
+    @staticmethod
+    def is_valid_command(command: str) -> bool:
+        """ Cheap syntax check of a command or '; ' batch, nothing is executed """
+        for single_command in command.split('; '):
+            command_parts = single_command.split()
+            if len(command_parts) < 1 or command_parts[0] not in KVStore.MIN_ARGS:
+                return False
+            if len(command_parts) - 1 < KVStore.MIN_ARGS[command_parts[0]]:
+                return False
+            if command_parts[0] == "maxmemory" and (not KVStore.__is_count(command_parts[1]) or
+                    (len(command_parts) > 2 and command_parts[2] not in KVStore.EVICTION_POLICIES)):
+                return False
+            if command_parts[0] in ("incr", "decr") and len(command_parts) > 2 and not KVStore.__is_int(command_parts[2]):
+                return False
+            if command_parts[0] == "guard" and (command_parts[2] not in KVStore.GUARD_CONDITIONS or
+                    len(command_parts) - 3 < KVStore.GUARD_CONDITIONS[command_parts[2]]):
+                return False
+        return True
+
+    # Client sessions
+    def session_response(self, client_id: str, seq: int) -> str | int | None:
+        """ Result of an already applied request, None if it wasn't applied yet or is stale """
+        session = self.sessions.get(client_id)
+        if session is None or seq <= session["acked"]:
+            return None
+        return session["responses"].get(seq)
+
+    def is_stale(self, client_id: str, seq: int) -> bool:
+        """ Whether the client already acknowledged seq, its response is gone and it must not be applied again """
+        session = self.sessions.get(client_id)
+        return session is not None and seq <= session["acked"]
+
+    def __record_session(self, client_id: str, seq: int, acked: int, result: str | int):
+        session = self.sessions.setdefault(client_id, {"acked": 0, "responses": {}})
+        self.sessions.move_to_end(client_id)
+        responses: Dict[int, str | int] = session["responses"]
+        responses[seq] = result
+        if acked > session["acked"]:
+            session["acked"] = acked
+            for done in [done for done in responses if done <= acked]:
+                del responses[done]
+        while len(responses) > KVStore.MAX_SESSION_RESPONSES:
+            del responses[min(responses)]
+        while len(self.sessions) > KVStore.MAX_SESSIONS:
+            self.sessions.popitem(last=False)
+
+    @staticmethod
+    def written_keys(command: str) -> List[str] | None:
+        """ Keys a command or '; ' batch writes, None if it doesn't change the store """
+        keys, writes = [], False
+        for single_command in command.split('; '):
+            command_parts = single_command.split()
+            if len(command_parts) < 1 or command_parts[0] not in KVStore.WRITE_COMMANDS:
+                continue
+            writes = True
+            position = KVStore.WRITE_COMMANDS[command_parts[0]]
+            if position is not None and len(command_parts) > position and command_parts[position] not in keys:
+                keys.append(command_parts[position])
+        return keys if writes else None
+
+    @staticmethod
+    def is_read_only(command: str) -> bool:
+        """ Whether the command can be answered with read() instead of a log entry """
+        return "; " not in command and command.split(" ", 1)[0] in KVStore.READ_ONLY_COMMANDS
+
+    def read(self, command: str):
+        """ Result of a read only command, nothing is changed or recorded """
+        return self._execute_single_command(command.strip())
+
+    @staticmethod
+    def changed_keys(log: Log) -> List[str] | None:
+        """
+        Keys a log entry changed: those its commands write, the keys it imported and
+        the keys it evicted. None if it doesn't change the store
+        """
+        if 'changed' in log:
+            # the entry changed less than its commands name, e.g. a failed cas or an aborted batch
+            return log['changed']
+        keys = KVStore.written_keys(log['command'])
+        if keys is None:
+            return None
+        if log['command'].split()[0] == KVStore.IMPORT_COMMAND:
+            # the entry's value holds the imported pairs
+            items = json.loads(log['value'] or "[]")
+            keys = [key for key, _ in items] if isinstance(items, list) else []
+        return keys + [key for key in log.get('evicted', []) if key not in keys]
+
     def executing_log(self, log: Log):
-        commands = log['command'].split('; ')
-        result = ""
-        for command in commands:
-            result = self._execute_single_command(command.strip())
-            if result == "Invalid command":
-                break
-        log['value'] = result
+        client_id = log.get('client_id')
+        if client_id is not None:
+            if self.is_stale(client_id, log['seq']):
+                # the leader rejects stale requests before appending them, never apply one twice
+                log['value'] = ""
+                log['changed'] = []
+                return
+            cached = self.session_response(client_id, log['seq'])
+            if cached is not None:
+                log['value'] = cached
+                log['changed'] = []
+                return
+
+        log['value'] = result = self.__execute_batch(log['command'].split('; '))
+        self.__settle_evictions()
+        if self.evicted:
+            log['evicted'] = self.evicted
+        # recorded only when it differs from what the command names, most entries don't need it
+        changed = list(self.__changed)
+        if set(changed) != set(KVStore.changed_keys(log) or []):
+            log['changed'] = changed
+        if client_id is not None:
+            self.__record_session(client_id, log['seq'], log.get('acked', 0), result)
+
+    def __execute_batch(self, commands: List[str]):
+        """
+        Runs a '; ' batch as one transaction, the result is the last command's. If
+        a command fails (a guard that doesn't hold, a cas mismatch, OOM, ...) the
+        batch stops, every change it made is undone and the failure is the result,
+        so guards and writes in one entry apply all or nothing
+        """
+        self.evicted = []
+        self.__changed = {}
+        if len(commands) == 1:
+            return self._execute_single_command(commands[0].strip())
+
+        self.__journal = {}
+        settings = (self.max_memory, self.eviction_policy)
+        try:
+            result = ""
+            for command in commands:
+                self.__failed = False
+                result = self._execute_single_command(command.strip())
+                if self.__failed:
+                    self.__rollback(settings)
+                    break
+            return result
+        except BaseException:
+            self.__rollback(settings)
+            raise
+        finally:
+            self.__journal = None
+
+    @staticmethod
+    def import_items(items: List) -> List[List[str]]:
+        """
+        [key, value] pairs of an import with every value as text (JSON for numbers and
+        the like). Raises ValueError if an item isn't a pair or its key isn't one word
+        """
+        pairs = []
+        for item in items:
+            if not isinstance(item, list) or len(item) != 2 or not isinstance(item[0], str) or item[0].split() != [item[0]]:
+                raise ValueError(f"Not a [key, value] pair with a one word key: {json.dumps(item)[:100]}")
+            key, value = item
+            pairs.append([key, value if isinstance(value, str) else json.dumps(value)])
+        return pairs
+
+    def install(self, items: List[List[str]], client_id: str = None, seq: int = 0, acked: int = 0) -> int | str:
+        """
+        Bulk import of [key, value] pairs as returned by import_items, all or nothing
+        like a batch. Returns the number of keys installed, or "OOM" if they didn't fit
+        and nothing changed. A successful import of a client session is recorded like
+        an executed request, the caller checks the session table before installing
+        """
+        self.evicted = []
+        self.__changed = {}
+        self.__journal = {}
+        self.__failed = False
+        settings = (self.max_memory, self.eviction_policy)
+        try:
+            for key, value in items:
+                self.__set(key, value)
+                if self.__failed:
+                    self.__rollback(settings)
+                    return "OOM"
+            self.__settle_evictions()
+            if client_id is not None:
+                self.__record_session(client_id, seq, acked, len(items))
+            return len(items)
+        except BaseException:
+            self.__rollback(settings)
+            raise
+        finally:
+            self.__journal = None
+
+    def __settle_evictions(self):
+        # a key evicted and then written again by the same entry was not evicted in the end
+        self.evicted = [key for key in self.evicted if key not in self.store]
+
+    def export(self) -> List[List[str]]:
+        """ Every [key, value] pair in key order, a copy that later writes don't change """
+        return [[key, str(self.store[key])] for key in self.index.irange()]
+
+    def __rollback(self, settings: Tuple[int, str]):
+        journal, self.__journal = self.__journal, None
+        self.evicted = []
+        for key, value in journal.items():
+            if key in self.store:
+                self.__remove(key)
+            if value is not None:
+                self.store[key] = ChunkedValue(value)
+                self.index.add(key)
+                self.memory_used += self.__entry_size(key, self.store[key])
+                self.__touch(key)
+        # restoring went through __remove, and in the end nothing changed
+        self.__changed = {}
+        self.max_memory = settings[0]
+        if settings[1] != self.eviction_policy:
+            self.eviction_policy = settings[1]
+            self.__rebuild_lfu_heap()
 
     def data(self):
-        return self.store
+        return {key: str(value) for key, value in self.store.items()}
+
+    """
+    Full replicated state of the store, including the eviction settings and access
+    counters, so a follower that takes over evicts exactly like the old leader would
+    """
+    def snapshot(self) -> dict:
+        return {
+            "store": self.data(),
+            "max_memory": self.max_memory,
+            "eviction_policy": self.eviction_policy,
+            "frequency": self.frequency,
+            "sessions": self.sessions,
+        }
+
+    def restore(self, snapshot: dict):
+        self.store = OrderedDict()
+        self.index = SortedIndex(snapshot.get("store", {}).keys())
+        self.memory_used = 0
+        self.frequency = {}
+        self.__last_access = {}
+        self.max_memory = snapshot.get("max_memory", 0)
+        self.eviction_policy = snapshot.get("eviction_policy", "lru")
+        frequency = snapshot.get("frequency", {})
+        for key, value in snapshot.get("store", {}).items():
+            self.store[key] = ChunkedValue(value)
+            self.memory_used += self.__entry_size(key, self.store[key])
+            self.__clock += 1
+            self.frequency[key] = frequency.get(key, 1)
+            self.__last_access[key] = self.__clock
+        self.__rebuild_lfu_heap()
+        # JSON turned the sequence numbers into strings
+        self.sessions = OrderedDict((client_id, {
+            "acked": session["acked"],
+            "responses": {int(seq): result for seq, result in session["responses"].items()},
+        }) for client_id, session in snapshot.get("sessions", {}).items())
 
 
 if __name__ == '__main__':
     print("Running unit tests...")
-    unittest.main(verbosity=0)
\ No newline at end of file
+    unittest.main(verbosity=0)
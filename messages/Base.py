@@ -1,4 +1,4 @@
-from typing import TypedDict
+from typing import NotRequired, TypedDict
 from Address import Address
 from enum import Enum
 
@@ -17,4 +17,6 @@ class ResponseStatus(Enum):
 class BaseResponse(BaseMessage):
     status: ResponseStatus
     address: Address
-    reason: str
\ No newline at end of file
+    reason: str
+    # With ONPROCESS, seconds to wait before retrying
+    retry_after: NotRequired[float]
\ No newline at end of file
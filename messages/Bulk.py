@@ -0,0 +1,30 @@
+from typing import List, NotRequired
+from messages.Base import BaseRequest, BaseResponse
+
+class ImportRequest(BaseRequest):
+    # [key, value] pairs installed into the store as one log entry
+    items: List[List[str]]
+    # Optional client session, the same as ExecuteRequest's, a retried import that
+    # was already applied is answered from the session table instead of installed again
+    client_id: NotRequired[str]
+    seq: NotRequired[int]
+    acked: NotRequired[int]
+
+class ImportResponse(BaseResponse):
+    # Keys installed, or "OOM" if they didn't fit (then none were installed)
+    data: int | str
+    index: int
+
+class ExportRequest(BaseRequest):
+    # Continues an export started by a request without export_id
+    export_id: NotRequired[str]
+    cursor: NotRequired[int]
+    limit: NotRequired[int]
+
+class ExportResponse(BaseResponse):
+    export_id: str
+    # Log length the exported store is the state of, every entry before it is committed
+    index: int
+    items: List[List[str]]
+    # Cursor of the next page, None once every key was sent
+    next: int | None
@@ -1,8 +1,14 @@
+from typing import NotRequired
 from messages.Base import BaseRequest, BaseResponse
 
 class ExecuteRequest(BaseRequest):
     command: str
     value: str
+    # Optional client session: seq numbers a client's requests from 1, a retry reuses
+    # the seq, acked is the highest seq whose response (and all before it) arrived
+    client_id: NotRequired[str]
+    seq: NotRequired[int]
+    acked: NotRequired[int]
 
 class ExecuteResponse(BaseResponse):
-    data: dict
\ No newline at end of file
+    data: dict
@@ -0,0 +1,20 @@
+from typing import List, NotRequired, TypedDict
+from messages.Base import BaseRequest, BaseResponse
+
+class ReadLogRequest(BaseRequest):
+    start: int
+    limit: NotRequired[int]
+    # Only entries of this election term
+    term: NotRequired[int]
+
+class LogEntry(TypedDict):
+    index: int
+    term: int
+    command: str
+    value: str
+
+class ReadLogResponse(BaseResponse):
+    entries: List[LogEntry]
+    # Start of the next page, None once the end of the log (or of the term) is reached
+    next: int | None
+    commit_length: int
@@ -0,0 +1,29 @@
+from typing import List, NotRequired, TypedDict
+from messages.Base import BaseRequest, BaseResponse
+
+class WatchRequest(BaseRequest):
+    # Resume token, the log index to continue from
+    start: int
+    # Only changes of these keys, or of keys with this prefix
+    keys: NotRequired[List[str]]
+    prefix: NotRequired[str]
+    limit: NotRequired[int]
+    # Seconds to wait for a matching change before answering with no entries
+    wait: NotRequired[float]
+
+class ChangeEntry(TypedDict):
+    index: int
+    term: int
+    command: str
+    # Value of the entry, for an import the JSON [key, value] pairs it installed
+    value: str
+    # Keys the entry changed, evicted keys included
+    keys: List[str]
+    # Keys removed to stay within maxmemory
+    evicted: NotRequired[List[str]]
+
+class WatchResponse(BaseResponse):
+    entries: List[ChangeEntry]
+    # Resume token for the next watch call
+    next: int
+    commit_length: int
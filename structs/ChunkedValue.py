@@ -0,0 +1,38 @@
+from typing import List
+
+class ChunkedValue:
+    """
+    Compact value buffer for the KV store. Values are kept as utf-8 bytes and
+    appends are pushed as separate chunks, which are only joined when the value
+    is read, so repeated appends stay linear instead of quadratic.
+    """
+    __slots__ = ("chunks", "length", "nbytes")
+
+    def __init__(self, value: str = ""):
+        data = value.encode()
+        self.chunks: List[bytes] = [data] if data else []
+        self.length: int = len(value)
+        self.nbytes: int = len(data)
+
+    def append(self, value: str):
+        data = value.encode()
+        if data:
+            self.chunks.append(data)
+            self.length += len(value)
+            self.nbytes += len(data)
+
+    def __compact(self) -> bytes:
+        if len(self.chunks) > 1:
+            self.chunks = [b"".join(self.chunks)]
+        return self.chunks[0] if self.chunks else b""
+
+    def __len__(self):
+        return self.length
+
+    def __str__(self):
+        return self.__compact().decode()
+
+    def __eq__(self, other):
+        if isinstance(other, ChunkedValue):
+            return self.__compact() == other.__compact()
+        return str(self) == other
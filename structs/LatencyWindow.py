@@ -0,0 +1,25 @@
+from collections import deque
+import math
+
+class LatencyWindow:
+    """
+    Sliding window of the most recent round trip times to one peer, in seconds.
+    Percentiles are computed on demand with the nearest-rank method.
+    """
+    __slots__ = ("samples",)
+
+    def __init__(self, size: int):
+        self.samples: deque = deque(maxlen=size)
+
+    def __len__(self):
+        return len(self.samples)
+
+    def record(self, seconds: float):
+        self.samples.append(seconds)
+
+    def percentile(self, p: float) -> float:
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        rank = max(1, math.ceil(p / 100 * len(ordered)))
+        return ordered[rank - 1]
@@ -1,6 +1,14 @@
-from typing import TypedDict
+from typing import List, NotRequired, TypedDict
 
 class Log(TypedDict):
     term: int
     command: str
-    value: str
\ No newline at end of file
+    value: str
+    # Session of the client that sent the command, used to apply it only once
+    client_id: NotRequired[str]
+    seq: NotRequired[int]
+    acked: NotRequired[int]
+    # Keys the command evicted to stay within maxmemory
+    evicted: NotRequired[List[str]]
+    # Keys the entry actually changed, only when fewer than its commands name
+    changed: NotRequired[List[str]]
@@ -0,0 +1,138 @@
+from array import array
+from typing import Dict, Iterator, List
+from structs.Log import Log
+import json
+
+class LogStore:
+    """
+    The Raft log in columnar form. Terms and payload offsets live in packed
+    array('q') columns and every entry's command, value and optional session
+    fields are encoded back to back in one bytearray arena, so an entry costs
+    32 bytes plus its UTF-8 payload instead of a dict with its own key strings.
+    Term lookups read the terms column directly, indexing and slicing build Log
+    dicts only for the entries asked for.
+    """
+    # Log fields besides term, command and value, kept as a JSON suffix of the payload
+    EXTRA_FIELDS = ("client_id", "seq", "acked", "evicted", "changed")
+
+    def __init__(self, entries: List[Log] = None):
+        self.terms = array('q')
+        # payload of entry i is arena[offsets[i]:offsets[i + 1]], its value starts at
+        # value_starts[i] and its extra fields (if any) at extra_starts[i]
+        self.offsets = array('q', [0])
+        self.value_starts = array('q')
+        self.extra_starts = array('q')
+        self.arena = bytearray()
+        for entry in entries or []:
+            self.append(entry)
+
+    def __len__(self) -> int:
+        return len(self.terms)
+
+    def __iter__(self) -> Iterator[Log]:
+        for i in range(len(self)):
+            yield self.__entry(i)
+
+    def __getitem__(self, key: int | slice) -> Log | List[Log]:
+        if isinstance(key, slice):
+            return [self.__entry(i) for i in range(*key.indices(len(self)))]
+        if key < 0:
+            key += len(self)
+        if not 0 <= key < len(self):
+            raise IndexError("log index out of range")
+        return self.__entry(key)
+
+    def __eq__(self, other) -> bool:
+        return list(self) == list(other)
+
+    def __repr__(self) -> str:
+        return repr(list(self))
+
+    def term(self, index: int) -> int:
+        return self.terms[index]
+
+    def command(self, index: int) -> str:
+        return self.arena[self.offsets[index]:self.value_starts[index]].decode()
+
+    def last_term(self) -> int:
+        return self.terms[-1] if len(self.terms) > 0 else 0
+
+    def __entry(self, i: int) -> Log:
+        start, value_start, extra_start, end = self.offsets[i], self.value_starts[i], self.extra_starts[i], self.offsets[i + 1]
+        entry = Log({
+            "term": self.terms[i],
+            "command": self.arena[start:value_start].decode(),
+            "value": self.arena[value_start:extra_start].decode(),
+        })
+        if extra_start < end:
+            entry.update(json.loads(self.arena[extra_start:end]))
+        return entry
+
+    def append(self, entry: Log):
+        self.terms.append(entry["term"])
+        self.arena += entry["command"].encode()
+        self.value_starts.append(len(self.arena))
+        # strln and memory results are numbers, the log keeps every value as text
+        self.arena += ("" if entry["value"] is None else str(entry["value"])).encode()
+        self.extra_starts.append(len(self.arena))
+        extras = {field: entry[field] for field in LogStore.EXTRA_FIELDS if field in entry}
+        if extras:
+            self.arena += json.dumps(extras, separators=(",", ":")).encode()
+        self.offsets.append(len(self.arena))
+
+    def extend(self, entries: List[Log]):
+        for entry in entries:
+            self.append(entry)
+
+    def truncate(self, length: int):
+        """ Drops every entry from index length on, in place """
+        if length >= len(self):
+            return
+        del self.terms[length:]
+        del self.value_starts[length:]
+        del self.extra_starts[length:]
+        del self.offsets[length + 1:]
+        del self.arena[self.offsets[length]:]
+
+    def payload_bytes(self, start: int) -> int:
+        """ Payload bytes of the entries from index start on """
+        return len(self.arena) - self.offsets[min(start, len(self))]
+
+    @property
+    def nbytes(self) -> int:
+        columns = (self.terms, self.offsets, self.value_starts, self.extra_starts)
+        return sum(column.itemsize * len(column) for column in columns) + len(self.arena)
+
+    # Persistence, the columns are stored as they are so saving doesn't build a dict per entry
+
+    def snapshot(self) -> "LogStore":
+        """ Frozen copy for a background store, copying the columns is a memcpy per column """
+        log = LogStore()
+        log.terms = array('q', self.terms)
+        log.offsets = array('q', self.offsets)
+        log.value_starts = array('q', self.value_starts)
+        log.extra_starts = array('q', self.extra_starts)
+        log.arena = bytearray(self.arena)
+        return log
+
+    def to_data(self) -> Dict:
+        return {
+            "terms": self.terms.tolist(),
+            "offsets": self.offsets.tolist(),
+            "value_starts": self.value_starts.tolist(),
+            "extra_starts": self.extra_starts.tolist(),
+            "arena": self.arena.decode(),
+        }
+
+    @staticmethod
+    def from_data(data: Dict | List[Log]) -> "LogStore":
+        """ Inverse of to_data, also accepts the older list of Log dicts """
+        if isinstance(data, list):
+            return LogStore(data)
+        log = LogStore()
+        log.terms = array('q', data["terms"])
+        log.offsets = array('q', data["offsets"])
+        log.value_starts = array('q', data["value_starts"])
+        log.extra_starts = array('q', data["extra_starts"])
+        log.arena = bytearray(data["arena"].encode())
+        return log
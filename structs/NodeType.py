@@ -4,4 +4,5 @@ class NodeType(Enum):
     FOLLOWER = 1
     CANDIDATE = 2
     LEADER = 3
+    LEARNER = 4
     
\ No newline at end of file
@@ -0,0 +1,79 @@
+from bisect import bisect_left, insort
+from typing import Iterable, Iterator, List
+
+class SortedIndex:
+    """
+    Ordered set of keys kept next to the KV hash map for range queries.
+    Keys are split into bounded sorted chunks (a la sortedcontainers), so inserts
+    and removals only shift one small chunk instead of the whole key list.
+    """
+    CHUNK_SIZE = 512
+
+    def __init__(self, keys: Iterable[str] = ()):
+        self.__chunks: List[List[str]] = []
+        self.__maxes: List[str] = []
+        self.__length: int = 0
+        ordered = sorted(set(keys))
+        for i in range(0, len(ordered), SortedIndex.CHUNK_SIZE):
+            chunk = ordered[i:i + SortedIndex.CHUNK_SIZE]
+            self.__chunks.append(chunk)
+            self.__maxes.append(chunk[-1])
+        self.__length = len(ordered)
+
+    def __len__(self):
+        return self.__length
+
+    def __contains__(self, key: str):
+        pos = bisect_left(self.__maxes, key)
+        if pos == len(self.__maxes):
+            return False
+        chunk = self.__chunks[pos]
+        idx = bisect_left(chunk, key)
+        return idx < len(chunk) and chunk[idx] == key
+
+    def add(self, key: str):
+        if not self.__chunks:
+            self.__chunks.append([key])
+            self.__maxes.append(key)
+            self.__length = 1
+            return
+        if key in self:
+            return
+        pos = min(bisect_left(self.__maxes, key), len(self.__maxes) - 1)
+        chunk = self.__chunks[pos]
+        insort(chunk, key)
+        self.__maxes[pos] = chunk[-1]
+        self.__length += 1
+        if len(chunk) > 2 * SortedIndex.CHUNK_SIZE:
+            half = len(chunk) // 2
+            self.__chunks[pos:pos + 1] = [chunk[:half], chunk[half:]]
+            self.__maxes[pos:pos + 1] = [chunk[half - 1], chunk[-1]]
+
+    def remove(self, key: str):
+        pos = bisect_left(self.__maxes, key)
+        if pos == len(self.__maxes):
+            return
+        chunk = self.__chunks[pos]
+        idx = bisect_left(chunk, key)
+        if idx == len(chunk) or chunk[idx] != key:
+            return
+        del chunk[idx]
+        self.__length -= 1
+        if chunk:
+            self.__maxes[pos] = chunk[-1]
+        else:
+            del self.__chunks[pos]
+            del self.__maxes[pos]
+
+    def irange(self, start: str = "", end: str | None = None) -> Iterator[str]:
+        """ Keys in [start, end) in ascending order, end=None means unbounded """
+        pos = bisect_left(self.__maxes, start)
+        if pos == len(self.__maxes):
+            return
+        idx = bisect_left(self.__chunks[pos], start)
+        for chunk in self.__chunks[pos:]:
+            stop = len(chunk) if end is None else bisect_left(chunk, end, idx)
+            yield from chunk[idx:stop]
+            if stop < len(chunk):
+                return
+            idx = 0
@@ -0,0 +1,21 @@
+class TokenBucket:
+    """
+    Rate limiter refilled continuously at rate tokens per second up to burst tokens.
+    Time is passed in by the caller, so it follows whatever clock the node runs on.
+    """
+    __slots__ = ("rate", "burst", "tokens", "time")
+
+    def __init__(self, rate: float, burst: float, now: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.time = now
+
+    def take(self, now: float) -> float:
+        """ Takes a token, returns 0 if there was one or else the seconds until there is """
+        self.tokens = min(self.burst, self.tokens + (now - self.time) * self.rate)
+        self.time = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
@@ -0,0 +1,43 @@
+"""
+Minimal HTTP/1.1 framing shared by the asyncio XML-RPC server and client.
+Only what XML-RPC needs: one start line, headers and a Content-Length body,
+plus chunked responses for streaming with unknown length.
+"""
+import asyncio
+from typing import Dict, Tuple
+
+async def read_http_message(reader: asyncio.StreamReader) -> Tuple[str, Dict[str, str], bytes]:
+    start_line = await reader.readline()
+    if not start_line:
+        raise asyncio.IncompleteReadError(b"", None)
+
+    headers: Dict[str, str] = {}
+    while True:
+        line = await reader.readline()
+        if not line:
+            raise asyncio.IncompleteReadError(b"", None)
+        if line in (b"\r\n", b"\n"):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+    body = await reader.readexactly(int(headers.get("content-length", 0)))
+    return start_line.decode("latin-1").strip(), headers, body
+
+def build_http_message(start_line: str, headers: Dict[str, str], body: bytes) -> bytes:
+    head = start_line + "\r\n"
+    for name, value in headers.items():
+        head += f"{name}: {value}\r\n"
+    head += f"Content-Length: {len(body)}\r\n\r\n"
+    return head.encode("latin-1") + body
+
+def build_chunked_head(start_line: str, headers: Dict[str, str]) -> bytes:
+    head = start_line + "\r\n"
+    for name, value in headers.items():
+        head += f"{name}: {value}\r\n"
+    head += "Transfer-Encoding: chunked\r\n\r\n"
+    return head.encode("latin-1")
+
+def build_chunk(data: bytes) -> bytes:
+    """ One chunk of a chunked body, empty data ends the body """
+    return f"{len(data):X}\r\n".encode("latin-1") + data + b"\r\n"
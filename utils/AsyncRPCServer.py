@@ -0,0 +1,103 @@
+import asyncio
+import inspect
+import xmlrpc.client
+from typing import Callable, Dict, Set
+from Address import Address
+from utils.AsyncHTTP import read_http_message, build_http_message
+
+class AsyncRPCServer:
+    """
+    XML-RPC over HTTP served from the node's asyncio event loop, wire compatible with
+    SimpleXMLRPCServer so xmlrpc.client.ServerProxy callers keep working. Public
+    methods of the registered instance are exposed, coroutine methods are awaited.
+    Plain GET requests are served from routes, a path to a function returning text.
+
+    Calls of client_methods go through a pool of client_workers slots (0 for no
+    limit), everything else (internode RPCs) is run as soon as it is read. A burst
+    of client calls then only has a few handlers ready to run on the event loop at
+    any time, and heartbeats and votes don't queue up behind all of them.
+
+    A coroutine method holds its slot until it is done. A plain method may return
+    an awaitable for what it still has to wait on (a commit, a long poll), that is
+    awaited outside the pool, so waiting calls don't keep others from running
+    """
+    def __init__(self, addr: Address, instance: object, routes: Dict[str, Callable[[], str]] = None,
+                 client_methods: Set[str] = frozenset(), client_workers: int = 0):
+        self.address = addr
+        self.instance = instance
+        self.routes = routes or {}
+        self.server: asyncio.AbstractServer = None
+        self.client_methods = client_methods
+        self.client_slots = asyncio.Semaphore(client_workers) if client_workers > 0 else None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.__handle_connection, self.address.ip, self.address.port)
+        return self.server.sockets[0].getsockname()[:2]
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+
+    async def __handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            # keep-alive, a peer reuses its connection for every heartbeat
+            while True:
+                start_line, headers, body = await read_http_message(reader)
+                method, path = (start_line.split(" ") + ["", ""])[:2]
+                if method == "GET":
+                    writer.write(self.__get(path))
+                else:
+                    print(f"Received POST request from {writer.get_extra_info('peername')}")
+                    payload = await self.__dispatch(body)
+                    writer.write(build_http_message("HTTP/1.1 200 OK", {"Content-Type": "text/xml"}, payload))
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    def __get(self, path: str) -> bytes:
+        route = self.routes.get(path.split("?")[0])
+        if route is None:
+            return build_http_message("HTTP/1.1 404 Not Found", {"Content-Type": "text/plain"}, b"Not Found\n")
+        try:
+            body = route().encode()
+        except Exception as e:
+            return build_http_message("HTTP/1.1 500 Internal Server Error", {"Content-Type": "text/plain"}, f"{type(e).__name__}:{e}\n".encode())
+        return build_http_message("HTTP/1.1 200 OK", {"Content-Type": "text/plain; version=0.0.4"}, body)
+
+    def __resolve(self, method_name: str):
+        if method_name == "system.listMethods":
+            return self.__list_methods
+        if method_name.startswith("_") or "." in method_name:
+            raise AttributeError(f"method {method_name} is not supported")
+        method = getattr(self.instance, method_name)
+        if not callable(method):
+            raise AttributeError(f"method {method_name} is not supported")
+        return method
+
+    def __list_methods(self):
+        return sorted(name for name in dir(self.instance) if not name.startswith("_") and callable(getattr(self.instance, name)))
+
+    async def __dispatch(self, body: bytes) -> bytes:
+        try:
+            params, method_name = xmlrpc.client.loads(body)
+            method = self.__resolve(method_name)
+            if self.client_slots is not None and method_name in self.client_methods:
+                async with self.client_slots:
+                    # internode requests that arrived meanwhile go first
+                    await asyncio.sleep(0)
+                    result = method(*params)
+                    if inspect.iscoroutinefunction(method):
+                        result = await result
+            else:
+                result = method(*params)
+            if inspect.isawaitable(result):
+                result = await result
+            response = xmlrpc.client.dumps((result,), methodresponse=True)
+        except Exception as e:
+            response = xmlrpc.client.dumps(xmlrpc.client.Fault(1, f"{type(e).__name__}:{e}"))
+        return response.encode()
@@ -0,0 +1,85 @@
+"""
+Pluggable compression for replication payloads and the stable storage file. Both
+are JSON text dominated by repeated command strings, which compress well. A packed
+value is either the plain text, or an envelope naming the codec that compressed
+it, so a reader never has to know the writer's settings. zlib is always there,
+lz4 is used when the lz4 package is installed.
+"""
+from typing import Dict, List
+import base64
+import zlib
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+
+class Codec:
+    name: str
+
+    def compress(self, data: bytes) -> bytes:
+        raise NotImplementedError
+
+    def decompress(self, data: bytes) -> bytes:
+        raise NotImplementedError
+
+
+class ZlibCodec(Codec):
+    """ Level 1 by default, on these repetitive payloads it gets the ratio of level 6 in half the time """
+    name = "zlib"
+
+    def __init__(self, level: int = 1):
+        self.level = level
+
+    def compress(self, data: bytes) -> bytes:
+        return zlib.compress(data, self.level)
+
+    def decompress(self, data: bytes) -> bytes:
+        return zlib.decompress(data)
+
+
+class Lz4Codec(Codec):
+    """ Faster than zlib at a somewhat lower ratio """
+    name = "lz4"
+
+    def compress(self, data: bytes) -> bytes:
+        return lz4.frame.compress(data)
+
+    def decompress(self, data: bytes) -> bytes:
+        return lz4.frame.decompress(data)
+
+
+CODECS: Dict[str, Codec] = {"zlib": ZlibCodec()}
+if lz4 is not None:
+    CODECS["lz4"] = Lz4Codec()
+
+def available() -> List[str]:
+    return list(CODECS)
+
+def get_codec(name: str) -> Codec | None:
+    """ The codec registered under name, None for "none" """
+    if name == "none":
+        return None
+    if name not in CODECS:
+        raise ValueError(f"Unknown or unavailable compression codec {name}, available: none, {', '.join(CODECS)}")
+    return CODECS[name]
+
+def compress(data: bytes, codec: Codec | None, threshold: int) -> bytes | None:
+    """ Compressed data, or None when it's below the threshold or doesn't get smaller """
+    if codec is None or len(data) < threshold:
+        return None
+    compressed = codec.compress(data)
+    return compressed if len(compressed) < len(data) else None
+
+def pack(text: str, codec: Codec | None, threshold: int) -> str | Dict[str, str]:
+    """ text as it is, or a {"codec", "data"} envelope with the compressed text in base64 """
+    compressed = compress(text.encode(), codec, threshold)
+    if compressed is None:
+        return text
+    return {"codec": codec.name, "data": base64.b64encode(compressed).decode("ascii")}
+
+def unpack(value: str | Dict[str, str]) -> str:
+    if isinstance(value, dict):
+        return CODECS[value["codec"]].decompress(base64.b64decode(value["data"])).decode()
+    return value
@@ -1,20 +1,62 @@
 from utils.MessageParser import MessageParser
+from utils.AsyncHTTP import read_http_message, build_http_message
 from messages.Base import BaseMessage, BaseResponse, ResponseStatus
 import json
+import time
+import asyncio
+import xmlrpc.client
+from typing import Dict, List, Tuple
 from Address import Address
 from xmlrpc.client import ServerProxy
 
 
+class _TimeoutTransport(xmlrpc.client.Transport):
+    """ xmlrpc transport whose connections give up after timeout seconds, instead of the process wide socket default """
+    def __init__(self, timeout: float):
+        super().__init__()
+        self.timeout = timeout
+
+    def make_connection(self, host):
+        connection = super().make_connection(host)
+        connection.timeout = self.timeout
+        return connection
+
+
 class RPCHandler:
+    """
+    Sends RPCs to nodes. Every call has a deadline, the caller's timeout or else the
+    default for the RPC, which covers connecting, every redirect hop and reading the
+    response, so a dead or slow node fails its own call fast without holding up
+    other calls. Cancelling an async call closes its connection
+    """
+    DEFAULT_TIMEOUT = 5.0
+    # Defaults by RPC. Internode RPCs are retried on the next round anyway, long polls
+    # and bulk transfers legitimately take longer
+    RPC_TIMEOUTS: Dict[str, float] = {
+        "heartbeat": 0.5,
+        "vote": 0.5,
+        "pre_vote": 0.5,
+        "timeout_now": 0.5,
+        "import_data": 30.0,
+        "export_data": 30.0,
+        "watch": 65.0,
+    }
+
+    @staticmethod
+    def timeout_for(rpc_name: str, timeout: float | None = None) -> float:
+        return timeout if timeout is not None else RPCHandler.RPC_TIMEOUTS.get(rpc_name, RPCHandler.DEFAULT_TIMEOUT)
+
     def __init__(self, id: str | None = None):
         self.message_parser = MessageParser()
         self.id = id
-        
+        # Idle keep-alive connections per peer for the asyncio path
+        self.__pool: Dict[Tuple[str, int], List[Tuple[asyncio.StreamReader, asyncio.StreamWriter]]] = {}
+
     def __logging(self, message: str):
         print(f"[RPCHandler-{self.id}] {message}")
 
-    def __call(self, addr: Address, rpc_name: str, message: BaseMessage):
-        node = ServerProxy(f"http://{addr.ip}:{addr.port}")
+    def __call(self, addr: Address, rpc_name: str, message: BaseMessage, timeout: float):
+        node = ServerProxy(f"http://{addr.ip}:{addr.port}", transport=_TimeoutTransport(timeout))
         json_request = self.message_parser.serialize(message)
         self.__logging(f"Sending request to {addr.ip}:{addr.port}...")
         rpc_function = getattr(node, rpc_name)
@@ -26,22 +68,49 @@ class RPCHandler:
         except Exception as e:
             self.__logging(f"Error while sending request to {addr.ip}:{addr.port}: {e}")
             # TODO : Handle error
-    
-    async def __async_call(self, addr: Address, rpc_name: str, message: BaseMessage):
-        node = ServerProxy(f"http://{addr.ip}:{addr.port}")
+
+    async def __post(self, addr: Address, payload: bytes):
+        idle = self.__pool.setdefault((addr.ip, addr.port), [])
+        pooled = len(idle) > 0
+        reader, writer = idle.pop() if pooled else await asyncio.open_connection(addr.ip, addr.port)
+        try:
+            writer.write(build_http_message("POST /RPC2 HTTP/1.1", {
+                "Host": f"{addr.ip}:{addr.port}",
+                "Content-Type": "text/xml",
+            }, payload))
+            await writer.drain()
+            _, headers, body = await read_http_message(reader)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            writer.close()
+            if pooled:
+                # the peer closed the idle connection, retry once on a fresh one
+                return await self.__post(addr, payload)
+            raise
+        except BaseException:
+            # timed out or cancelled mid-request, the connection state is unknown
+            writer.close()
+            raise
+
+        if headers.get("connection", "").lower() == "close":
+            writer.close()
+        else:
+            idle.append((reader, writer))
+        (response,), _ = xmlrpc.client.loads(body)
+        return response
+
+    async def __async_call(self, addr: Address, rpc_name: str, message: BaseMessage, timeout: float):
         json_request = self.message_parser.serialize(message)
-        self.__logging(f"Sending request to {addr.ip}:{addr.port}...")
-        rpc_function = getattr(node, rpc_name)
+        payload = xmlrpc.client.dumps((json_request,), rpc_name).encode()
 
         try:
-            response = await rpc_function(json_request)
-            self.__logging(f"Response from {addr.ip}:{addr.port}: {response}")
-            return response
+            return await asyncio.wait_for(self.__post(addr, payload), timeout)
         except Exception as e:
-            self.__logging(f"Error while sending request to {addr.ip}:{addr.port}: {e}")
+            self.__logging(f"Error while sending request to {addr.ip}:{addr.port}: {type(e).__name__} {e}")
             # TODO : Handle error
 
-    def request(self, addr: Address, rpc_name: str, message: BaseMessage) -> BaseResponse:
+    def request(self, addr: Address, rpc_name: str, message: BaseMessage, timeout: float | None = None) -> BaseResponse | None:
+        """ Blocking call, None if no response arrived before the deadline or no node knows the leader """
+        deadline = time.monotonic() + RPCHandler.timeout_for(rpc_name, timeout)
         redirect_addr = addr
         response = BaseResponse({
             'status': ResponseStatus.REDIRECTED.value,
@@ -49,11 +118,18 @@ class RPCHandler:
         })
 
         while response["status"] == ResponseStatus.REDIRECTED.value:
+            if response["address"] is None:
+                # the node doesn't know a leader either, e.g. during an election
+                return None
             redirect_addr = Address(
                 response["address"]["ip"],
                 response["address"]["port"],
             )
-            response = self.message_parser.deserialize(self.__call(redirect_addr, rpc_name, message))
+            remaining = deadline - time.monotonic()
+            raw_response = self.__call(redirect_addr, rpc_name, message, remaining) if remaining > 0 else None
+            if raw_response is None:
+                return None
+            response = self.message_parser.deserialize(raw_response)
 
         # TODO: handle fail response
         if response["status"] == ResponseStatus.FAILED.value:
@@ -62,7 +138,10 @@ class RPCHandler:
         response["address"] = redirect_addr
         return response
 
-    async def async_request(self, addr: Address, rpc_name: str, message: BaseMessage) -> BaseResponse:
+    async def async_request(self, addr: Address, rpc_name: str, message: BaseMessage, timeout: float | None = None) -> BaseResponse | None:
+        """ None if no response arrived before the deadline or no node knows the leader """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + RPCHandler.timeout_for(rpc_name, timeout)
         redirect_addr = addr
         response = BaseResponse({
             'status': ResponseStatus.REDIRECTED.value,
@@ -70,8 +149,30 @@ class RPCHandler:
         })
 
         while response["status"] == ResponseStatus.REDIRECTED.value:
+            if response["address"] is None:
+                # the node doesn't know a leader either, e.g. during an election
+                return None
             redirect_addr = Address(
                 response["address"]["ip"],
                 response["address"]["port"],
             )
-            response = self.message_parser.deserialize(await self.__async_call(redirect_addr, rpc_name, message))
\ No newline at end of file
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                self.__logging(f"Deadline of {rpc_name} passed while following redirects")
+                return None
+            raw_response = await self.__async_call(redirect_addr, rpc_name, message, remaining)
+            if raw_response is None:
+                return None
+            response = self.message_parser.deserialize(raw_response)
+
+        if response["status"] == ResponseStatus.FAILED.value:
+            self.__logging("Failed to send request")
+
+        response["address"] = redirect_addr
+        return response
+
+    async def close(self):
+        for idle in self.__pool.values():
+            for _, writer in idle:
+                writer.close()
+        self.__pool = {}
@@ -0,0 +1,256 @@
+"""
+Deterministic in-process cluster simulator. Nodes are real RaftNodes talking over
+an in-memory SimNetwork instead of sockets, with in-memory stable storage, on an
+asyncio event loop whose clock is virtual: whenever every node is waiting, the
+clock jumps straight to the next timer, so minutes of cluster time run in well
+under a second. Latency, message drops and partitions are injected by the
+network and every random choice comes from the seed, so a scenario replays
+exactly for the same seed.
+
+    async def failover(cluster: SimCluster):
+        old_leader = await cluster.wait_for_leader()
+        cluster.crash(old_leader)
+        return await cluster.wait_for_leader(timeout=30)
+
+    new_leader = simulate(failover, size=5, seed=42)
+"""
+from Address import Address
+from app import KVStore
+from messages.Base import BaseMessage, BaseResponse, ResponseStatus
+from Raft import RaftNode
+from RaftConfig import RaftConfig
+from StableStorage import StableStorage
+from structs.NodeType import NodeType
+from utils.MessageParser import MessageParser
+from utils.RPCHandler import RPCHandler
+from utils.Transport import Transport
+from contextlib import redirect_stdout
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Set, Tuple
+import asyncio
+import inspect
+import os
+import random
+import selectors
+
+
+class VirtualClockLoop(asyncio.SelectorEventLoop):
+    """
+    Event loop that advances a virtual clock instead of sleeping while idle. Every
+    loop iteration also costs one TICK, so code waiting for the clock to pass a
+    deadline with tiny sleeps still makes progress
+    """
+    TICK = 1e-6
+
+    class _Selector(selectors.DefaultSelector):
+        def __init__(self):
+            super().__init__()
+            self.loop: "VirtualClockLoop" = None
+
+        def select(self, timeout: float | None = None):
+            events = super().select(0)
+            if not events:
+                self.loop.now += max(timeout or 0, VirtualClockLoop.TICK)
+            return events
+
+    def __init__(self):
+        selector = VirtualClockLoop._Selector()
+        super().__init__(selector)
+        selector.loop = self
+        self.now: float = 0.0
+
+    def time(self) -> float:
+        return self.now
+
+
+class SimNetwork:
+    """
+    Delivers RPCs between registered nodes by calling their handlers directly, with
+    the same JSON serialization as the real transport. Each direction of a call
+    takes a random latency and can be dropped, and nodes in different partition
+    groups can't reach each other. A lost request or response shows up at the
+    caller as a timeout, a call to a node that is down fails after one hop
+    """
+    def __init__(self, seed: int = 0, latency: Tuple[float, float] = (0.001, 0.005), drop_rate: float = 0.0):
+        self.rng = random.Random(seed)
+        self.latency = latency
+        self.drop_rate = drop_rate
+        self.nodes: Dict[Address, Any] = {}
+        self.groups: Dict[Address, int] = {}
+        self.delivered = 0
+        self.dropped = 0
+
+    def register(self, addr: Address, node: Any):
+        self.nodes[addr] = node
+
+    def unregister(self, addr: Address):
+        self.nodes.pop(addr, None)
+
+    def transport(self, addr: Address) -> "SimTransport":
+        return SimTransport(self, addr)
+
+    def partition(self, *groups: Iterable[Address]):
+        """ Nodes of different groups can't reach each other, unlisted nodes (like clients) reach everyone """
+        self.groups = {addr: i for i, group in enumerate(groups) for addr in group}
+
+    def heal(self):
+        self.groups = {}
+
+    def reachable(self, src: Address, dst: Address) -> bool:
+        if src not in self.groups or dst not in self.groups:
+            return True
+        return self.groups[src] == self.groups[dst]
+
+    def __lost(self, src: Address, dst: Address) -> bool:
+        if not self.reachable(src, dst) or self.rng.random() < self.drop_rate:
+            self.dropped += 1
+            return True
+        return False
+
+    async def __exchange(self, src: Address, dst: Address, rpc_name: str, payload: str) -> str | None:
+        if self.__lost(src, dst):
+            await asyncio.get_running_loop().create_future()
+        await asyncio.sleep(self.rng.uniform(*self.latency))
+        node = self.nodes.get(dst)
+        if node is None or rpc_name.startswith("_"):
+            return None
+
+        result = getattr(node, rpc_name)(payload)
+        if inspect.isawaitable(result):
+            result = await result
+        if self.__lost(dst, src):
+            await asyncio.get_running_loop().create_future()
+        await asyncio.sleep(self.rng.uniform(*self.latency))
+        self.delivered += 1
+        return result
+
+    async def deliver(self, src: Address, dst: Address, rpc_name: str, payload: str, timeout: float) -> str | None:
+        try:
+            return await asyncio.wait_for(self.__exchange(src, dst, rpc_name, payload), timeout)
+        except asyncio.TimeoutError:
+            return None
+        except Exception:
+            # the real server answers a handler exception with a fault, which the caller reports as no response
+            return None
+
+
+class SimTransport(Transport):
+    def __init__(self, network: SimNetwork, addr: Address):
+        self.network = network
+        self.address = addr
+        self.message_parser = MessageParser()
+
+    async def request(self, addr: Address, rpc_name: str, message: BaseMessage, timeout: float | None = None) -> BaseResponse | None:
+        payload = self.message_parser.serialize(message)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + RPCHandler.timeout_for(rpc_name, timeout)
+        while True:
+            if deadline <= loop.time():
+                return None
+            raw_response = await self.network.deliver(self.address, addr, rpc_name, payload, deadline - loop.time())
+            if raw_response is None:
+                return None
+            response = self.message_parser.deserialize(raw_response)
+            if response["status"] != ResponseStatus.REDIRECTED.value:
+                break
+            if response.get("address") is None:
+                return None
+            addr = Address(response["address"]["ip"], response["address"]["port"])
+        response["address"] = addr
+        return response
+
+
+class SimCluster:
+    """
+    A cluster of RaftNodes on one SimNetwork, the first node founds it and the rest
+    join. With bootstrap every node starts at once from the static member list
+    """
+    def __init__(self, size: int, seed: int = 0, latency: Tuple[float, float] = (0.001, 0.005), drop_rate: float = 0.0,
+                 config: RaftConfig = None, bootstrap: bool = False):
+        self.network = SimNetwork(seed, latency, drop_rate)
+        self.addrs: List[Address] = [Address("sim", 5000 + i) for i in range(size)]
+        self.config = config or RaftConfig()
+        if bootstrap:
+            self.config = RaftConfig(**{**self.config.data(), "initial_members": ",".join(map(str, self.addrs))})
+        self.nodes: Dict[Address, RaftNode] = {}
+        self.storages: Dict[Address, StableStorage] = {}
+        self.tasks: Dict[Address, asyncio.Task] = {}
+        self.client = self.network.transport(Address("client", 0))
+
+    async def start(self, join_delay: float = 1):
+        if self.config.initial_members:
+            for addr in self.addrs:
+                self.start_node(addr)
+            return
+        for i, addr in enumerate(self.addrs):
+            self.start_node(addr, None if i == 0 else self.addrs[0])
+            await asyncio.sleep(join_delay)
+
+    def start_node(self, addr: Address, contact_addr: Address = None):
+        """ Starts a node, or restarts a crashed one from its stable storage """
+        storage = self.storages.setdefault(addr, StableStorage[RaftNode.StableVars](addr, in_memory=True))
+        # a restarted node only gets what was written, not the crashed node's memory
+        storage.drop_cache()
+        node = RaftNode(KVStore(), addr, contact_addr, self.config, self.network.transport(addr), storage,
+                        asyncio.get_running_loop().time, random.Random(self.network.rng.random()))
+        self.nodes[addr] = node
+        self.network.register(addr, node)
+        self.tasks[addr] = asyncio.create_task(node.run())
+
+    def crash(self, addr: Address):
+        self.tasks.pop(addr).cancel()
+        self.nodes.pop(addr)
+        self.network.unregister(addr)
+
+    def live_addrs(self) -> List[Address]:
+        return list(self.nodes.keys())
+
+    def leader(self) -> Address | None:
+        leaders = [node for node in self.nodes.values() if node.type == NodeType.LEADER]
+        if not leaders:
+            return None
+        return max(leaders, key=lambda node: node.election_term).address
+
+    async def wait_for_leader(self, timeout: float = 120, exclude: Set[Address] = frozenset()) -> Address:
+        deadline = asyncio.get_running_loop().time() + timeout
+        while asyncio.get_running_loop().time() < deadline:
+            leader = self.leader()
+            if leader is not None and leader not in exclude:
+                return leader
+            await asyncio.sleep(0.05)
+        raise TimeoutError(f"No leader elected within {timeout}s of virtual time")
+
+    async def execute(self, command: str, addr: Address = None, timeout: float = 5, **session) -> BaseResponse | None:
+        """ session takes the optional client_id, seq and acked of ExecuteRequest """
+        return await self.client.request(addr or self.leader() or self.addrs[0], "execute", {
+            "command": command,
+            "value": "",
+            **session,
+        }, timeout)
+
+    async def stop(self):
+        tasks = list(self.tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.tasks = {}
+
+
+def simulate(scenario: Callable[[SimCluster], Awaitable[Any]], size: int = 3, seed: int = 0, verbose: bool = False,
+             join_delay: float = 1, **cluster_args) -> Any:
+    """ Runs a scenario against a freshly started simulated cluster and returns its result """
+    async def main():
+        cluster = SimCluster(size, seed, **cluster_args)
+        await cluster.start(join_delay)
+        try:
+            return await scenario(cluster)
+        finally:
+            await cluster.stop()
+
+    loop = VirtualClockLoop()
+    try:
+        if verbose:
+            return loop.run_until_complete(main())
+        with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            return loop.run_until_complete(main())
+    finally:
+        loop.close()
@@ -0,0 +1,73 @@
+"""
+Opt-in tracing of the node's hot paths. Spans are timed with perf_counter and kept
+in a fixed size ring buffer, so tracing a busy node never grows memory. Nested
+spans know their parent through a context variable, which asyncio copies into
+every task, so concurrent RPCs on the event loop don't mix up their stacks.
+While tracing is off span() returns a shared no-op context manager.
+"""
+from collections import deque
+from contextlib import nullcontext
+from contextvars import ContextVar
+from typing import Dict, List
+import time
+
+_NO_SPAN = nullcontext()
+
+class Span:
+    __slots__ = ("tracer", "name", "parent", "stack", "start", "child_time", "token")
+
+    def __init__(self, tracer: "Tracer", name: str):
+        self.tracer = tracer
+        self.name = name
+
+    def __enter__(self):
+        self.parent: Span | None = self.tracer.current.get()
+        self.stack = self.name if self.parent is None else f"{self.parent.stack};{self.name}"
+        self.child_time = 0.0
+        self.token = self.tracer.current.set(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        duration = time.perf_counter() - self.start
+        self.tracer.current.reset(self.token)
+        if self.parent is not None:
+            self.parent.child_time += duration
+        # children awaited concurrently can add up to more than the parent took
+        self.tracer.spans.append((self.stack, self.start, duration, max(0.0, duration - self.child_time)))
+
+
+class Tracer:
+    def __init__(self, capacity: int = 10000, enabled: bool = False):
+        self.enabled = enabled
+        # (stack, start, duration, self time) of finished spans, oldest first
+        self.spans: deque = deque(maxlen=capacity)
+        self.current: ContextVar[Span | None] = ContextVar("span", default=None)
+
+    def span(self, name: str):
+        if not self.enabled:
+            return _NO_SPAN
+        return Span(self, name)
+
+    def clear(self):
+        self.spans.clear()
+
+    def dump(self, limit: int | None = None) -> List[Dict]:
+        """ Finished spans, most recent last, durations in microseconds """
+        spans = list(self.spans)
+        if limit is not None:
+            spans = spans[-limit:]
+        return [{
+            "stack": stack,
+            "name": stack.rsplit(";", 1)[-1],
+            "start": start,
+            "duration_us": round(duration * 1e6, 1),
+            "self_us": round(self_time * 1e6, 1),
+        } for stack, start, duration, self_time in spans]
+
+    def folded(self) -> str:
+        """ Self time per stack in microseconds, in the folded format flamegraph.pl and speedscope read """
+        totals: Dict[str, float] = {}
+        for stack, _, _, self_time in self.spans:
+            totals[stack] = totals.get(stack, 0.0) + self_time
+        return "".join(f"{stack} {round(total * 1e6)}\n" for stack, total in sorted(totals.items()))
@@ -0,0 +1,27 @@
+from messages.Base import BaseMessage, BaseResponse
+from utils.RPCHandler import RPCHandler
+from Address import Address
+
+class Transport:
+    """
+    How a RaftNode reaches other nodes. request() sends one RPC, follows redirects
+    and returns the deserialized response, or None if no response arrived in time.
+    The timeout is the deadline of the whole call, None for the RPC's default
+    """
+    async def request(self, addr: Address, rpc_name: str, message: BaseMessage, timeout: float | None = None) -> BaseResponse | None:
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+class RPCTransport(Transport):
+    """ XML-RPC over HTTP with pooled keep-alive connections, used by Server.py """
+    def __init__(self, id: str | None = None):
+        self.rpc_handler = RPCHandler(id)
+
+    async def request(self, addr: Address, rpc_name: str, message: BaseMessage, timeout: float | None = None) -> BaseResponse | None:
+        return await self.rpc_handler.async_request(addr, rpc_name, message, timeout)
+
+    async def close(self):
+        await self.rpc_handler.close()